@@ -0,0 +1,179 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+from util.synthetic import synthetic_bison_data
+from util.dataloader import cached_bison_data, write_columnar_cache
+from util.preprocessing import threshold_filtering, find_closest_time, time_axis
+from util.calculations import calc_kWh_BBL, calc_perc_BEP, normalize_BEP
+from util.format_calculations import compute_kpis_for_sites
+
+
+# Benchmarks the util pipeline on synthetic telemetry (see util/synthetic.py)
+# usage (from Bison_Water/):
+#     python benchmarks/run_benchmarks.py                              # 10k, 1M, and 10M rows, compared to the saved baseline
+#     python benchmarks/run_benchmarks.py --sizes 10000 --save-baseline
+# every function is timed (best of --repeat runs) and, in a separate run under tracemalloc, measured for peak memory
+# a run more than --tolerance slower (or bigger) than the baseline is reported as a regression, and the exit code is 1
+
+SIZES = [10_000, 1_000_000, 10_000_000]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+CLOSEST_TIME_QUERIES = 100 # find_closest_time calls per run
+ALL_KPIS = ['kWh/BBL', 'Flow Rate', 'perc_from_BEP', 'norm_perc_from_BEP']
+
+
+def prepare_inputs(n_rows, workdir, seed=0):
+    # generates the synthetic fleet and every function's input, so setup isn't counted in the timings
+    # ------------------------------------------------
+    # n_rows: (int) rows of telemetry
+    # workdir: directory for the cache files cached_bison_data reads
+    # seed: (int) random seed for synthetic_bison_data
+    # output: dictionary of the inputs the benchmarks share
+    # ================================================
+    data, sites_info, site_pump_curves = synthetic_bison_data(n_rows, seed=seed)
+    csv_path = os.path.join(workdir, 'bench_{}.csv'.format(n_rows))
+    parquet_path = os.path.join(workdir, 'bench_{}.parquet'.format(n_rows))
+    data.to_csv(csv_path, index=False)
+    write_columnar_cache(data, parquet_path)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        loaded = cached_bison_data(parquet_path)
+    filtered = threshold_filtering(loaded)
+    filtered['frequency'] = filtered['frequency'].round()
+    site_id = filtered['site_id'].value_counts().idxmax() # the busiest site stands in for "one site"
+    site_data = filtered[filtered['site_id'] == site_id]
+    scored = calc_perc_BEP(site_data.copy(), site_pump_curves[site_id])
+
+    rng = np.random.default_rng(seed)
+    times = time_axis(loaded)
+    queries = pd.to_datetime(rng.integers(times.min().value, times.max().value, CLOSEST_TIME_QUERIES))
+    return {'n_rows': n_rows, 'csv_path': csv_path, 'parquet_path': parquet_path, 'loaded': loaded, 'filtered': filtered,
+            'site_id': site_id, 'site_data': site_data, 'scored': scored, 'queries': queries,
+            'sites_info': sites_info, 'site_pump_curves': site_pump_curves}
+
+
+def closest_times(site_data, queries):
+    for query in queries:
+        try:
+            find_closest_time(site_data, query.strftime('%Y-%m-%d'), query.strftime('%H:%M:%S'))
+        except IndexError: # a dropout covered the whole day
+            pass
+
+
+# name: (function of the inputs, number of rows it processes)
+BENCHMARKS = {
+    'cached_bison_data[csv]': (lambda inputs: cached_bison_data(inputs['csv_path']), lambda inputs: inputs['n_rows']),
+    'cached_bison_data[parquet]': (lambda inputs: cached_bison_data(inputs['parquet_path']), lambda inputs: inputs['n_rows']),
+    'cached_bison_data[csv,compact]': (lambda inputs: cached_bison_data(inputs['csv_path'], compact=True), lambda inputs: inputs['n_rows']),
+    'threshold_filtering': (lambda inputs: threshold_filtering(inputs['loaded']), lambda inputs: len(inputs['loaded'])),
+    'calc_kWh_BBL': (lambda inputs: calc_kWh_BBL(inputs['filtered']), lambda inputs: len(inputs['filtered'])),
+    'calc_perc_BEP': (lambda inputs: calc_perc_BEP(inputs['site_data'].copy(), inputs['site_pump_curves'][inputs['site_id']]),
+                      lambda inputs: len(inputs['site_data'])),
+    'normalize_BEP': (lambda inputs: normalize_BEP(inputs['scored'].copy(), inputs['sites_info'][inputs['site_id']]['calibration_stages']),
+                      lambda inputs: len(inputs['scored'])),
+    'compute_kpis_for_sites': (lambda inputs: compute_kpis_for_sites(inputs['site_data'].copy(), inputs['site_id'], sites_info=inputs['sites_info'],
+                                                                     site_pump_curves=inputs['site_pump_curves'][inputs['site_id']], kpis=ALL_KPIS),
+                               lambda inputs: len(inputs['site_data'])),
+    'find_closest_time': (lambda inputs: closest_times(inputs['site_data'], inputs['queries']), lambda inputs: len(inputs['site_data'])),
+}
+
+
+def run_benchmark(func, inputs, repeat):
+    # output: best wall time (s) over repeat runs, peak traced memory (bytes) of one more run
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(inputs)
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        func(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def run_suite(sizes, repeat=3, only=None, seed=0):
+    # output: dataframe with one row per (benchmark, size): seconds, rows/s, peak MB
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_rows in sizes:
+            print("Generating {:,} rows...".format(n_rows))
+            inputs = prepare_inputs(n_rows, workdir, seed=seed)
+            for name, (func, rows) in BENCHMARKS.items():
+                if only and not any(pattern in name for pattern in only):
+                    continue
+                seconds, peak = run_benchmark(func, inputs, repeat)
+                results.append({'benchmark': name, 'rows': n_rows, 'input_rows': rows(inputs), 'seconds': seconds,
+                                'rows_per_s': rows(inputs) / seconds if seconds > 0 else np.inf, 'peak_mb': peak / 2**20})
+                print("  {:<32} {:>10.4f} s {:>14,.0f} rows/s {:>10.1f} MB".format(name, seconds, results[-1]['rows_per_s'], results[-1]['peak_mb']))
+            del inputs
+    return pd.DataFrame(results)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    # output: list of regression messages (a benchmark is compared only at sizes the baseline has)
+    regressions = []
+    for row in results.itertuples(index=False):
+        base = baseline.get(row.benchmark, {}).get(str(row.rows))
+        if base is None:
+            continue
+        for metric, value in [('seconds', row.seconds), ('peak_mb', row.peak_mb)]:
+            if value > base[metric] * (1 + tolerance):
+                regressions.append("{} @ {:,} rows: {} {:.4g} vs baseline {:.4g}".format(row.benchmark, row.rows, metric, value, base[metric]))
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(results, path):
+    # merges into the existing baseline, so sizes can be recorded one at a time
+    baseline = load_baseline(path)
+    for row in results.itertuples(index=False):
+        baseline.setdefault(row.benchmark, {})[str(row.rows)] = {'seconds': row.seconds, 'peak_mb': row.peak_mb}
+    with open(path, 'w') as f:
+        json.dump({'machine': platform.platform(), 'python': platform.python_version(), 'pandas': pd.__version__,
+                   'numpy': np.__version__, 'results': baseline}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the util pipeline on synthetic SWD telemetry")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="row counts to benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per benchmark (the best is kept)")
+    parser.add_argument('--only', nargs='+', help="only run benchmarks whose name contains one of these")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline JSON to compare against / save to")
+    parser.add_argument('--save-baseline', action='store_true', help="record this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown / growth before flagging a regression")
+    parser.add_argument('--output', help="also write the results to this CSV")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, repeat=args.repeat, only=args.only, seed=args.seed)
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print("Saved baseline to {}".format(args.baseline))
+    else:
+        regressions = compare_to_baseline(results, load_baseline(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1 if regressions else 0)
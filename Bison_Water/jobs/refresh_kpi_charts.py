@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+from util.dataloader import cached_bison_data, cached_site_info, load_pump_curves, sync_bison_data, KPI_COLUMNS
+from util.preprocessing import threshold_filtering, time_axis
+from util.filters import threshold_filter_spec
+from util.partition import PartitionedDataset
+from util.format_calculations import compute_kpis_for_sites, kpi_charts
+from util.pipeline import compute_kpis_all_sites
+
+
+# Headless version of the notebooks' weekly KPI chart refresh (pumpcurve_kpis.ipynb / twopumps_simplekpis.ipynb): optionally
+# syncs the cache, computes every site's per-frequency KPI chart, and writes bison_kpi_charts/<site_id>_kpis_unnormalized.csv
+# -- with no plotting or IPython imports, so it runs from cron on a small VM
+# usage (from anywhere):
+#     python jobs/refresh_kpi_charts.py ~/bison_cache --sync                  # sync, then re-chart the sites whose data changed
+#     python jobs/refresh_kpi_charts.py syncdatabase.csv --sites 33404 33614 --force
+#     python jobs/refresh_kpi_charts.py ~/bison_cache --kpis kWh/BBL "Flow Rate" perc_from_BEP --dry-run
+# a site is re-charted only if its filtered telemetry, the KPIs asked for, the thresholds, or its calibration stages / pump
+# curve changed since the last run -- each site's fingerprint of those is kept in <output-dir>/refresh_state.json
+# exit code: 0, or 1 if some site failed (the others are still written)
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bison_kpi_charts')
+STATE_FILE = 'refresh_state.json'
+DEFAULT_KPIS = ['kWh/BBL', 'Flow Rate']
+BEP_KPIS = ['perc_from_BEP', 'norm_perc_from_BEP']
+
+
+def read_state(path):
+    # dictionary of site_id: fingerprint from the last run (empty if there wasn't one)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(site_id): fingerprint for site_id, fingerprint in json.load(f).items()}
+
+
+def write_state(path, state):
+    # written to a temporary file and moved into place, so a killed run never leaves a half-written state
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({str(site_id): fingerprint for site_id, fingerprint in sorted(state.items())}, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def site_fingerprint(site_data, kpis, spec, site_info):
+    # a hash of everything a site's chart depends on: its (filtered) rows, the KPIs, the thresholds, and for the BEP KPIs its
+    # calibration stages and pump curve file
+    # ------------------------------------------------
+    # site_data: the site's filtered rows
+    # kpis: list of KPIs being charted
+    # spec: the FilterSpec the data was filtered with
+    # site_info: the site's info in the Ryan sites_info format
+    # output: (str) hex digest
+    # ================================================
+    digest = hashlib.sha1()
+    digest.update(time_axis(site_data).to_numpy(dtype='datetime64[ns]').tobytes())
+    for col in KPI_COLUMNS:
+        if col in site_data.columns:
+            digest.update(site_data[col].to_numpy(dtype=float).tobytes())
+    digest.update(json.dumps([kpis, repr(spec)]).encode())
+    if any(kpi in kpis for kpi in BEP_KPIS):
+        curve_path = site_info.get('pump_curve_path')
+        curve_modified = os.path.getmtime(curve_path) if curve_path and os.path.exists(curve_path) else None
+        digest.update(json.dumps([site_info.get('calibration_stages', []), curve_path, curve_modified], default=str).encode())
+    return digest.hexdigest()
+
+
+def chartable(site_id, kpis, sites_info, site_pump_curves):
+    # None if the site can be charted for these KPIs, otherwise why not
+    if site_id not in sites_info:
+        return "not in the site registry"
+    if any(kpi in kpis for kpi in BEP_KPIS) and site_pump_curves[site_id] is None:
+        return "no pump curve for the BEP KPIs"
+    if 'norm_perc_from_BEP' in kpis and not sites_info[site_id]['calibration_stages']:
+        return "no calibration stages for norm_perc_from_BEP"
+    return None
+
+
+def refresh_kpi_charts(cache, site_ids=None, kpis=DEFAULT_KPIS, output_dir=DEFAULT_OUTPUT_DIR, sync=False, force=False,
+                       dry_run=False, n_workers=1):
+    # the job: sync (optionally), load, filter, and re-chart the sites whose inputs changed
+    # ------------------------------------------------
+    # cache: path of the cache cached_bison_data reads (a sync_bison_data directory, if sync)
+    # site_ids: (optional) list of (int) site_ids; defaults to every site in the cache
+    # kpis: the chart KPIs, as in compute_kpis_for_sites
+    # output_dir: where the CSVs and the refresh state go
+    # sync: run sync_bison_data on the cache first
+    # force: re-chart every site, changed or not
+    # dry_run: only report which sites would be re-charted
+    # n_workers: (int) worker processes; more than one computes the sites in parallel with compute_kpis_all_sites, falling
+        # back to one site at a time if a site fails there, so only the failing sites are reported
+    # output: dictionary with the 'refreshed', 'unchanged', 'skipped' (site_id: reason), and 'failed' (site_id: error) sites
+    # ================================================
+    started = time.perf_counter()
+    if sync:
+        sync_bison_data(cache)
+    data = cached_bison_data(cache, columns=KPI_COLUMNS, derived=[], site_ids=site_ids)
+    spec = threshold_filter_spec()
+    dataset = PartitionedDataset(threshold_filtering(data, spec=spec))
+    del data
+
+    sites_info = cached_site_info(dict=True)
+    site_ids = dataset.site_ids if site_ids is None else list(site_ids)
+    site_pump_curves = load_pump_curves(site_ids, models=True) if any(kpi in kpis for kpi in BEP_KPIS) else {site_id: None for site_id in site_ids}
+    state_path = os.path.join(output_dir, STATE_FILE)
+    state = read_state(state_path)
+
+    result = {'refreshed': [], 'unchanged': [], 'skipped': {}, 'failed': {}}
+    fingerprints = {}
+    for site_id in site_ids:
+        try:
+            reason = "no data after filtering" if site_id not in dataset.site_blocks else chartable(site_id, kpis, sites_info, site_pump_curves)
+        except Exception as error: # e.g. a missing or malformed pump curve file -- read here, on first lookup
+            result['failed'][site_id] = repr(error)
+            continue
+        if reason is not None:
+            result['skipped'][site_id] = reason
+            continue
+        fingerprints[site_id] = site_fingerprint(dataset.site(site_id), kpis, spec, sites_info[site_id])
+        if force or state.get(site_id) != fingerprints[site_id]:
+            result['refreshed'].append(site_id)
+        else:
+            result['unchanged'].append(site_id)
+    print("Sites to re-chart: {}; unchanged: {}; skipped: {}; failed: {}".format(result['refreshed'], result['unchanged'],
+                                                                              result['skipped'], result['failed']))
+    if dry_run or not result['refreshed']:
+        return result
+
+    kpis_all_sites = {}
+    if n_workers > 1:
+        try:
+            kpis_all_sites, _, _ = compute_kpis_all_sites(dataset.data, result['refreshed'], kpis=kpis, site_pump_curves=site_pump_curves,
+                                                          sites_info=sites_info, n_workers=n_workers)
+        except Exception as error: # the pool stops at the first bad site; find it (and finish the rest) one site at a time
+            print("Parallel run failed ({!r}); computing the sites one at a time".format(error))
+            kpis_all_sites = {}
+    for site_id in result['refreshed']:
+        if kpis_all_sites.get(site_id) is not None:
+            continue
+        try:
+            _, kpis_all_sites[site_id], _ = compute_kpis_for_sites(dataset.site(site_id), site_id, sites_info=sites_info,
+                                                                   site_pump_curves=site_pump_curves[site_id], kpis=kpis)
+        except Exception as error: # one bad site shouldn't stop the others' charts
+            result['failed'][site_id] = repr(error)
+    result['refreshed'] = [site_id for site_id in result['refreshed'] if kpis_all_sites.get(site_id) is not None]
+
+    os.makedirs(output_dir, exist_ok=True)
+    kpi_charts(kpis_all_sites, result['refreshed'], sites_info, kpis=kpis, save_csv=True, output_dir=output_dir)
+    state.update({site_id: fingerprints[site_id] for site_id in result['refreshed']})
+    write_state(state_path, state)
+    print("Re-charted {} site(s) in {:.1f} s; failed: {}".format(len(result['refreshed']), time.perf_counter() - started, result['failed']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refresh the per-site KPI charts (bison_kpi_charts/*.csv) without Jupyter")
+    parser.add_argument('cache', help="cache to read: a CSV / Parquet / Feather file, a site store, or a sync_bison_data directory")
+    parser.add_argument('--sync', action='store_true', help="sync new rows from the historian into the cache directory first")
+    parser.add_argument('--sites', type=int, nargs='+', help="only these site_ids (default: every site in the cache)")
+    parser.add_argument('--kpis', nargs='+', default=DEFAULT_KPIS, help="KPIs to chart (default: kWh/BBL and Flow Rate)")
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help="where the charts and the refresh state are written")
+    parser.add_argument('--force', action='store_true', help="re-chart every site, changed or not")
+    parser.add_argument('--dry-run', action='store_true', help="only report which sites would be re-charted")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes (default 1)")
+    args = parser.parse_args()
+
+    result = refresh_kpi_charts(args.cache, site_ids=args.sites, kpis=args.kpis, output_dir=args.output_dir, sync=args.sync,
+                                force=args.force, dry_run=args.dry_run, n_workers=args.workers)
+    sys.exit(1 if result['failed'] else 0)
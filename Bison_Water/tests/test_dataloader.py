@@ -0,0 +1,181 @@
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import psycopg2
+import psycopg2.pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+from util import dataloader
+from util.dataloader import (generate_sql_query, parallel_fetch_bison_data, stream_bison_data, build_site_store, cached_bison_data,
+                             open_site, BISON_MEASUREMENTS, SENSOR_COLUMNS, KPI_COLUMNS)
+from util.preprocessing import threshold_filtering
+from util.synthetic import synthetic_bison_data
+
+
+# Checks of the historian fetch path that run without a database (the query's shape, and the sharded fetch's retries
+# against a stand-in connection pool), and of the site store against the CSV cache it's built from
+# usage (from Bison_Water/):
+#     python -m pytest -q tests
+
+
+def test_postgres_query_aliases_match_the_schema():
+    # the PostgreSQL stand-in keeps a quoted alias's case, so the measurement columns must come back as SENSOR_COLUMNS names them
+    query, params = generate_sql_query([57740], [], 'UTC', BISON_MEASUREMENTS, datetime(2025, 1, 1), datetime(2025, 1, 2),
+                                       dialect='postgres')
+    for measurement_name in BISON_MEASUREMENTS:
+        assert 'AS "{}"'.format(measurement_name.lower()) in query
+        assert measurement_name.lower() in SENSOR_COLUMNS
+    assert "CONVERT_TIMEZONE" not in query
+    assert query.count('%s') == len(params)
+
+
+class FlakyPool:
+    # a stand-in for ThreadedConnectionPool whose first connects fail, like a historian that's briefly unreachable
+    def __init__(self, minconn, maxconn, failures=1, **kwargs):
+        self.failures = failures
+        self.connects = 0
+        self.returned = []
+
+    def getconn(self):
+        self.connects += 1
+        if self.connects <= self.failures:
+            raise psycopg2.OperationalError("could not connect to server")
+        return object()
+
+    def putconn(self, conn, close=False):
+        self.returned.append(conn)
+
+    def closeall(self):
+        pass
+
+
+def test_parallel_fetch_retries_a_failed_connect(monkeypatch):
+    pools = []
+    def make_pool(minconn, maxconn, **kwargs):
+        pools.append(FlakyPool(minconn, maxconn))
+        return pools[-1]
+    shard_rows = pd.DataFrame({'site_id': [57740], 'pump_id': [1], 'timestamp': [pd.Timestamp('2025-01-01')], 'flow rate': [1.0]})
+    monkeypatch.setattr(psycopg2.pool, 'ThreadedConnectionPool', make_pool)
+    monkeypatch.setattr(dataloader, 'query_bison_data', lambda conn, *args, **kwargs: shard_rows)
+
+    df = parallel_fetch_bison_data(datetime(2025, 1, 1), datetime(2025, 1, 2), device_ids=[57740], max_workers=1,
+                                   retry_wait=0, connection_kwargs={})
+    assert len(df) == 1
+    assert pools[0].connects == 2
+    assert None not in pools[0].returned # only connections that were actually obtained are handed back
+
+
+class FakeCursor:
+    # a stand-in for psycopg2's named (server-side) cursor over a fixed result
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.description = [(col,) for col in columns]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        self.position = 0
+
+    def fetchmany(self, size):
+        batch = self.rows[self.position:self.position + size]
+        self.position += size
+        return batch
+
+
+class FakeConnection:
+    def __init__(self, rows, columns):
+        self.rows, self.columns = rows, columns
+
+    def cursor(self, name=None):
+        return FakeCursor(self.rows, self.columns)
+
+    def commit(self):
+        pass
+
+
+HISTORIAN_COLUMNS = ['site_id', 'facility_name', 'timestamp', 'flow rate', 'frequency']
+HISTORIAN_ROWS = [(57740, 'Canadian', '2025-01-01 00:{:02d}:00'.format(minute), 12000.0 + minute, 55.0) for minute in range(25)]
+
+
+def test_streaming_twice_to_a_csv_writes_it_over(tmp_path):
+    # a second fetch into the same CSV starts the file over, like the non-streaming write, instead of duplicating every row
+    csv_path = str(tmp_path / 'syncdatabase.csv')
+    for _ in range(2):
+        rows_written, _ = stream_bison_data(FakeConnection(HISTORIAN_ROWS, HISTORIAN_COLUMNS), [57740], datetime(2025, 1, 1),
+                                            datetime(2025, 1, 2), csv_path, chunksize=10)
+        assert rows_written == len(HISTORIAN_ROWS)
+        cached = pd.read_csv(csv_path)
+        assert len(cached) == len(HISTORIAN_ROWS)
+        assert list(cached.columns[:3]) == ['site_id', 'pump_id', 'timestamp']
+    assert cached['flow rate'].tolist() == [row[3] for row in HISTORIAN_ROWS]
+
+
+def test_reading_a_cache_directory_with_no_parts(tmp_path):
+    # a fresh sync_bison_data directory whose first sync returned nothing
+    cache_dir = str(tmp_path / 'bison_cache')
+    os.makedirs(cache_dir)
+    df = cached_bison_data(cache_dir, columns=KPI_COLUMNS)
+    assert len(df) == 0
+    assert all(col in df.columns for col in ['site_id', 'pump_id', 'timestamp'] + KPI_COLUMNS)
+    assert len(threshold_filtering(df)) == 0 # an empty fleet filters to nothing rather than failing on a missing column
+
+
+def test_streaming_to_a_new_directory_creates_it(tmp_path):
+    cache_dir = str(tmp_path / 'bison_cache')
+    stream_bison_data(FakeConnection(HISTORIAN_ROWS, HISTORIAN_COLUMNS), [57740], datetime(2025, 1, 1), datetime(2025, 1, 2),
+                      cache_dir, chunksize=10)
+    assert os.path.isdir(cache_dir)
+    assert len([name for name in os.listdir(cache_dir) if name.startswith('part-')]) == 3
+
+
+@pytest.fixture
+def two_pump_store(tmp_path):
+    # a two-pump site sampled every 5 minutes, cached as a CSV and built into a site store
+    data, _, _ = synthetic_bison_data(4000, n_sites=1, pumps_per_site=(2,), sampling_minutes=(5,))
+    csv_path = str(tmp_path / 'syncdatabase.csv')
+    data.set_index(['site_id', 'pump_id', 'timestamp']).to_csv(csv_path, index=True)
+    store_dir = str(tmp_path / 'store')
+    build_site_store(csv_path, store_dir)
+    return csv_path, store_dir, int(data['site_id'].iloc[0])
+
+
+def test_site_store_round_trips_a_multi_pump_site(two_pump_store):
+    csv_path, store_dir, _ = two_pump_store
+    from_csv = cached_bison_data(csv_path, columns=KPI_COLUMNS)
+    from_store = cached_bison_data(store_dir, columns=KPI_COLUMNS)
+    assert from_store['pump_id'].tolist() == from_csv['pump_id'].tolist()
+    for pump_id in [1, 2]: # delta_t stays within a pump, as in the CSV
+        csv_deltas = from_csv.loc[from_csv['pump_id'] == pump_id, 'delta_t'].iloc[1:]
+        store_deltas = from_store.loc[from_store['pump_id'] == pump_id, 'delta_t'].iloc[1:]
+        assert store_deltas.median() == csv_deltas.median() == pd.Timedelta(minutes=5)
+        assert (store_deltas.to_numpy() == csv_deltas.to_numpy()).all()
+    assert np.allclose(from_store['flow rate'].to_numpy(dtype=float), from_csv['flow rate'].to_numpy(dtype=float), rtol=1e-6, equal_nan=True)
+
+
+def test_open_site_time_window_covers_every_pump(two_pump_store):
+    csv_path, store_dir, site_id = two_pump_store
+    from_csv = cached_bison_data(csv_path)
+    start, end = from_csv['timestamp_datetime'].quantile([0.25, 0.5])
+    site = open_site(store_dir, site_id, start_time=start, end_time=end)
+    in_window = from_csv['timestamp_datetime'].between(start, end)
+    assert len(site) == in_window.sum()
+    assert sorted(site['pump_id'].unique()) == [1, 2]
+    assert site['timestamp'].between(start, end).all()
+
+
+def test_open_site_is_writable_unless_memory_mapped(two_pump_store):
+    _, store_dir, site_id = two_pump_store
+    site = open_site(store_dir, site_id)
+    site.loc[site.index[:10], 'flow rate'] = 0.0 # in place, like the preprocessing functions
+    assert (site['flow rate'].iloc[:10] == 0).all()
+    mapped = open_site(store_dir, site_id, mmap=True)
+    with pytest.raises(ValueError, match="read-only"):
+        mapped['flow rate'].to_numpy()[0] = 0.0
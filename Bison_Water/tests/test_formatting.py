@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+from util.formatting import detect_sites_calibration_stages, detect_calibration_stages
+from util.synthetic import synthetic_bison_data
+
+
+# Checks of calibration stage detection on synthetic telemetry, whose sites_info holds each site's true calibration stages
+# usage (from Bison_Water/):
+#     python -m pytest -q tests
+
+
+def two_pump_site():
+    # two single-pump synthetic sites merged into one two-pump site, the second pump's sweep 12 hours after the first's,
+    # in the time order the historian returns them in
+    data, sites_info, _ = synthetic_bison_data(20000, n_sites=2, pumps_per_site=(1,), sampling_minutes=(1,))
+    first, second = sorted(sites_info)
+    pump_2 = data[data['site_id'] == second].assign(site_id=first, pump_id=2)
+    pump_2['timestamp'] = (pd.to_datetime(pump_2['timestamp']) + pd.Timedelta(hours=12)).dt.strftime('%Y-%m-%d %H:%M:%S')
+    site = pd.concat([data[data['site_id'] == first], pump_2], ignore_index=True)
+    site = site.iloc[pd.to_datetime(site['timestamp']).argsort(kind='stable')].reset_index(drop=True)
+    return site, {first: dict(sites_info[first], calibration_stages=[])}, sites_info[first]['calibration_stages']
+
+
+def test_two_pump_site_gets_a_pumps_calibration_stages():
+    site, sites_info, pump_1_stages = two_pump_site()
+    site_id = next(iter(sites_info))
+    assert len(detect_calibration_stages(site)) < len(pump_1_stages) # the pumps' interleaved frequencies hide the plateaus
+    detected = detect_sites_calibration_stages(site, sites_info)[site_id]['calibration_stages']
+    assert [stage['frequency'] for stage in detected] == [stage['frequency'] for stage in pump_1_stages]
+    assert detected == detect_calibration_stages(site, pump_id=1)
+
+
+def test_pump_id_picks_the_pump():
+    site, sites_info, _ = two_pump_site()
+    site_id = next(iter(sites_info))
+    detected = detect_sites_calibration_stages(site, sites_info, pump_id=2)[site_id]['calibration_stages']
+    assert detected == detect_calibration_stages(site, pump_id=2)
+    assert detected[0]['start_time'] > detect_calibration_stages(site, pump_id=1)[0]['start_time']
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+from util.recommendations import recommend_frequencies, best_frequencies, kpi_table
+
+
+# Checks of the frequency recommendation engine on hand-made KPI charts
+# usage (from Bison_Water/):
+#     python -m pytest -q tests
+
+
+def site_chart(frequencies, bep=True):
+    # a site's chart, {frequency: {KPI: average}}: flow rises with frequency, kWh/BBL bottoms out at 50 Hz, BEP at 55 Hz
+    # (NaN without a pump curve, as compute_kpis_for_sites leaves it)
+    return {freq: {'Flow Rate': 200.0 * freq, 'kWh/BBL': 0.1 + 0.001 * (freq - 50) ** 2,
+                   'perc_from_BEP': 2.0 * (freq - 55) if bep else np.nan} for freq in frequencies}
+
+
+def test_mixed_fleet_with_and_without_a_pump_curve():
+    # 33614 has a pump curve, 48137 doesn't -- its BEP KPI is all NaN
+    kpis_all_sites = {33614: site_chart(range(40, 61)), 48137: site_chart(range(45, 61), bep=False)}
+    recommendations = recommend_frequencies(kpis_all_sites)
+
+    sites = recommendations['sites'].set_index('site_id')
+    assert sorted(sites.index) == [33614, 48137] # the site without a curve is judged on flow rate and kWh/BBL alone
+    assert 50 <= sites.at[33614, 'recommended_frequency'] <= 60
+    assert 50 <= sites.at[48137, 'recommended_frequency'] <= 60
+    assert sites['score'].between(0, 1).all()
+    assert recommendations['best_by_kpi'][33614] == {'Flow Rate': 60, 'kWh/BBL': 50, 'perc_from_BEP': 55}
+    assert recommendations['best_by_kpi'][48137] == {'Flow Rate': 60, 'kWh/BBL': 50}
+    assert recommendations['fleet'] is not None
+
+
+def test_best_frequencies_ties_go_to_the_lowest_frequency():
+    chart = {freq: {'Flow Rate': 1000.0, 'kWh/BBL': 0.2} for freq in [50, 52, 54]}
+    assert best_frequencies(kpi_table({33404: chart})) == {33404: {'kWh/BBL': 50, 'Flow Rate': 50}}
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # run from anywhere, import util like the notebooks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'jobs'))
+import refresh_kpi_charts as job
+from util.registry import LazyPumpCurves
+from util.synthetic import synthetic_bison_data
+
+
+# Checks that the headless KPI chart refresh (jobs/refresh_kpi_charts.py) reports a failing site and still writes the others'
+# charts, on synthetic telemetry in place of the cache and site registry
+# usage (from Bison_Water/):
+#     python -m pytest -q tests
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    data, sites_info, site_pump_curves = synthetic_bison_data(20000)
+    monkeypatch.setattr(job, 'cached_bison_data', lambda *args, **kwargs: data)
+    monkeypatch.setattr(job, 'cached_site_info', lambda dict=False: sites_info)
+    return data, sites_info, site_pump_curves
+
+
+def test_a_bad_pump_curve_fails_only_its_site(fleet, monkeypatch, tmp_path):
+    data, _, site_pump_curves = fleet
+    bad_site = int(data['site_id'].iloc[0])
+    def load(site_id):
+        if site_id == bad_site:
+            raise FileNotFoundError("PumpCurve_{}_DataPoints.csv".format(site_id))
+        return site_pump_curves[site_id]
+    monkeypatch.setattr(job, 'load_pump_curves', lambda site_ids, models=False: LazyPumpCurves(site_ids, load))
+
+    result = job.refresh_kpi_charts('cache', kpis=['kWh/BBL', 'Flow Rate', 'perc_from_BEP'], output_dir=str(tmp_path))
+    assert list(result['failed']) == [bad_site]
+    assert sorted(result['refreshed']) == sorted(site_id for site_id in site_pump_curves if site_id != bad_site)
+    for site_id in result['refreshed']:
+        assert os.path.exists(os.path.join(str(tmp_path), '{}_kpis_unnormalized.csv'.format(site_id)))
+
+
+def test_a_failing_site_in_the_pool_fails_only_that_site(fleet, monkeypatch, tmp_path):
+    data, _, _ = fleet
+    bad_site = int(data['site_id'].iloc[0])
+    compute_kpis_for_sites = job.compute_kpis_for_sites
+    def flaky(site_data, site_id, **kwargs):
+        if site_id == bad_site:
+            raise RuntimeError("bad site")
+        return compute_kpis_for_sites(site_data, site_id, **kwargs)
+    def pool(*args, **kwargs): # the pool stops at the first failing site
+        raise RuntimeError("bad site")
+    monkeypatch.setattr(job, 'compute_kpis_for_sites', flaky)
+    monkeypatch.setattr(job, 'compute_kpis_all_sites', pool)
+
+    result = job.refresh_kpi_charts('cache', output_dir=str(tmp_path), n_workers=2)
+    assert list(result['failed']) == [bad_site]
+    assert len(result['refreshed']) == data['site_id'].nunique() - 1
@@ -1,4 +1,25 @@
-from .dataloader import *
-from .formatting import *
-from .plot import *
-from .preprocessing import *
\ No newline at end of file
+import importlib
+
+# the `util.<name>` shortcuts to the modules below, imported on first use (PEP 562) rather than when util is imported, so
+# importing any util module doesn't pull in matplotlib / plotly -- a headless job (see jobs/refresh_kpi_charts.py) never
+# loads them; plot.py is only imported for a name none of the others have
+_REEXPORTED_MODULES = ['preprocessing', 'formatting', 'dataloader', 'plot']
+
+# what `from util import *` gives: the names it gave when this imported the modules eagerly, less the plotting ones
+# (plot_3kpis, plot_ts_gt, map_frequency_to_color, plt, px, plot), which would load matplotlib -- use `from util.plot import *`
+__all__ = ['cached_bison_data', 'cached_site_info', 'fetch_bison_data', 'load_pump_curves', 'select_calib_data', 'site_ids_name',
+           'find_closest_time', 'process_voltage_and_current', 'remove_NaN_cols', 'threshold_filtering',
+           'format_sitegts', 'ryan_format', 'ryan_site_info_to_audrey_format',
+           'dataloader', 'formatting', 'preprocessing',
+           'np', 'pd', 'os', 'json', 'datetime', 'timedelta', 'deepcopy', 'psycopg2']
+
+
+def __getattr__(name):
+    if name in _REEXPORTED_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    if not name.startswith('_'):
+        for module_name in _REEXPORTED_MODULES:
+            module = importlib.import_module('.' + module_name, __name__)
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
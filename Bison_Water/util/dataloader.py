@@ -1,169 +1,264 @@
 import os
+import shutil
+import numpy as np
 import pandas as pd
+import time
 import psycopg2
+import psycopg2.pool
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from util.preprocessing import process_voltage_and_current, find_closest_time
+from util.preprocessing import process_voltage_and_current, find_closest_time, TimestampIndex, view_of
+from util.pumpcurve import PumpCurveModel
+from util.profiling import profile_stage
+from util.registry import load_site_registry, LazyPumpCurves
+from util.features import FeatureFrame
 import json
-from copy import deepcopy
-
-def site_ids_name(): # hardcoded TODO: load this in from somewhere
-    ids = {}
-    ids[33404] = "Union City" 
-    ids[33467] = "Siegrist"
-    ids[57740] = "Canadian"
-    ids[33614] = "Calument"
-    return ids
-
-
-def load_pump_curves(site_ids):
-    datapath = "/Users/audreyder/Neuralix/AllPumpCSV/" 
-    pump_curves = {site_id:None for site_id in site_ids}
-    calumet = pd.read_csv(datapath+"PumpCurve_Calument_33614_DataPoints.csv")
-    canadian = pd.read_csv(datapath+"PumpCurve_Canadian_57740_DataPoints.csv")
-    siegrist = pd.read_csv(datapath+"PumpCurve_Siegrist_33467_DataPoints.csv")
-    unioncity = pd.read_csv(datapath+"PumpCurve_UnionCity2_33404_DataPoints.csv")
-    pump_curves[33404] = unioncity # hardcoded TODO: Future proof; do this dynamically by site_id
-    pump_curves[33467] = siegrist
-    pump_curves[57740] = canadian
-    pump_curves[33614] = calumet
-    return pump_curves
-
-
-def cached_bison_data(filepath):
-    df = pd.read_csv(filepath)
-    # Ensure 'timestamp' is in datetime format
-    print("Adding Datetime Timestamp and Delta T columns...")
-    df['timestamp_datetime'] = pd.to_datetime(df['timestamp'].copy())
-    df['delta_t'] = df['timestamp_datetime'].copy().diff()
+
+def site_ids_name():
+    # dictionary of site_id: short site name, from the site registry (sites.json)
+    return load_site_registry().site_names()
+
+
+def load_pump_curves(site_ids, models=False, cache_dir=None):
+    # loads the pump curve for each site, lazily: a curve CSV is read the first time its site is looked up
+    # ------------------------------------------------
+    # site_ids: list of (int) site_ids
+    # models: if True, return each curve compiled into a PumpCurveModel instead of the raw type/label/x/y dataframe
+    # cache_dir: (optional) with models=True, compiled models are persisted here keyed by the curve CSV's hash
+    # output: dictionary of site_id: pump curve (None for a site without a curve file in the site registry)
+    # ================================================
+    registry = load_site_registry()
+
+    def load(site_id):
+        curve_path = registry.pump_curve_path(site_id) if site_id in registry else None
+        if curve_path is None:
+            return None
+        if models:
+            return PumpCurveModel.from_csv(curve_path, cache_dir=cache_dir)
+        return pd.read_csv(curve_path)
+    return LazyPumpCurves(site_ids, load)
+
+
+# telemetry schema -- see apply_telemetry_schema()
+KEY_COLUMNS = ['site_id', 'pump_id', 'timestamp']
+SENSOR_COLUMNS = ['vibration', 'thrust temperature', 'suction pressure', 'discharge pressure', 'flow rate', 'frequency',
+                  'amps', 'ampsa', 'ampsb', 'ampsc', 'volts', 'voltsa', 'voltsb', 'voltsc', 'meter total']
+KPI_COLUMNS = ['frequency', 'flow rate', 'amps', 'volts'] # all the kWh/BBL and BEP KPIs need; pass as cached_bison_data(columns=...)
+COLUMNAR_FORMATS = ('.parquet', '.feather')
+
+
+# the declared dtype of every stored column: a single datetime64 time axis, categorical names, and float32 sensors
+# (float32 keeps ~7 significant digits, well past the sensors' own precision)
+TELEMETRY_SCHEMA = {'site_id': 'category', 'facility_name': 'category', 'pump_id': 'int8', 'timestamp': 'datetime64[ns]',
+                    **{col: 'float32' for col in SENSOR_COLUMNS}}
+DERIVED_COLUMNS = ['timestamp_datetime', 'delta_t'] # added by cached_bison_data on request; see time_axis() / time_deltas()
+
+
+def apply_telemetry_schema(df):
+    # casts df's columns to TELEMETRY_SCHEMA (columns it doesn't have are skipped); casts df's columns in place and returns it
+    # ------------------------------------------------
+    # df: historian dataframe, e.g. from fetch_bison_data or a CSV cache
+    # output: df
+    # ================================================
+    for col, dtype in TELEMETRY_SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == 'datetime64[ns]':
+            df[col] = pd.to_datetime(df[col]).astype(dtype)
+        elif dtype == 'float32':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+        elif dtype == 'int8' and df[col].isna().any(): # a missing pump_id can't be an int8
+            df[col] = df[col].astype('float32')
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def is_columnar_cache(filepath):
+    return str(filepath).endswith(COLUMNAR_FORMATS)
+
+
+def write_columnar_cache(df, filepath):
+    # writes the synced historian data as a Parquet or Feather file (chosen by filepath's extension)
+    # timestamps are stored as datetime64, site_id and facility_name as categoricals, and sensor columns as float32
+    # ------------------------------------------------
+    # df: dataframe from fetch_bison_data (a site_id/pump_id/timestamp index is written out as columns)
+    # filepath: path ending in .parquet or .feather
+    # output: the dataframe as it was written
+    # ================================================
+    if any(name in KEY_COLUMNS for name in df.index.names):
+        df = df.reset_index()
+    df = apply_telemetry_schema(df.copy())
+    if str(filepath).endswith('.parquet'):
+        df.to_parquet(filepath, index=False)
+    else:
+        df.to_feather(filepath)
+    return df
+
+
+def convert_csv_cache(csv_path, filepath):
+    # one-time conversion of an existing syncdatabase_*.csv into the columnar cache format
+    return write_columnar_cache(pd.read_csv(csv_path), filepath)
+
+
+@profile_stage('load')
+def cached_bison_data(filepath, columns=None, compact=False, derived=None, site_ids=None, start_time=None, end_time=None, mmap=False):
+    # loads the synced historian data from a cached CSV, Parquet, or Feather file, or a site store (see write_site_store())
+    # ------------------------------------------------
+    # filepath: path of the cache written by fetch_bison_data (the format is picked by the extension), or a sync_bison_data directory
+    # columns: (optional) list of sensor columns to load, e.g. KPI_COLUMNS; site_id, pump_id, and timestamp are always loaded
+    # compact: cast to TELEMETRY_SCHEMA as the data is read (a CSV is parsed straight into float32 / categorical columns), and
+        # only add the derived columns asked for -- a fleet-wide frame then takes roughly a third of the memory
+    # derived: (optional) which of DERIVED_COLUMNS to add; defaults to both, or to none if compact
+        # the KPI functions fall back to 'timestamp' when they're left out (see time_axis() and time_deltas() in preprocessing.py)
+    # site_ids: (optional) list of (int) site_ids to load
+    # start_time, end_time: (optional) only load rows with start_time <= timestamp <= end_time
+        # a site store pages in just those sites' and that window's bytes; any other cache is read whole, then filtered
+    # mmap: (site store only) leave a single site's columns as read-only memory maps onto the store (see open_site())
+    # NOTE: a columnar cache or site store (or compact) keeps 'timestamp' as datetime64 rather than the CSV's string format,
+        # and a site store's columns are always in TELEMETRY_SCHEMA
+    # output: the dataframe, with the derived columns added
+    # ================================================
+    load_columns = None if columns is None else KEY_COLUMNS + [col for col in columns if col not in KEY_COLUMNS]
+    if derived is None:
+        derived = [] if compact else DERIVED_COLUMNS
+    if is_site_store(filepath):
+        df = read_site_store(filepath, site_ids=site_ids, start_time=start_time, end_time=end_time, columns=columns, mmap=mmap)
+        site_ids = start_time = end_time = None # already selected
+    elif os.path.isdir(filepath) or is_columnar_cache(filepath):
+        if os.path.isdir(filepath): # an incrementally synced cache, see sync_bison_data()
+            df = read_partitioned_cache(filepath, columns=load_columns)
+        elif str(filepath).endswith('.parquet'):
+            df = pd.read_parquet(filepath, columns=load_columns)
+        else:
+            df = pd.read_feather(filepath, columns=load_columns)
+        for col in ['site_id', 'facility_name']: # not every pyarrow version restores the categorical dtype
+            if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+    elif compact:
+        # site_id is left to apply_telemetry_schema: a CSV read as category would give it string categories
+        csv_dtypes = {col: dtype for col, dtype in TELEMETRY_SCHEMA.items() if dtype == 'float32' or col == 'facility_name'}
+        df = pd.read_csv(filepath, usecols=None if load_columns is None else lambda col: col in load_columns,
+                         dtype=csv_dtypes, parse_dates=['timestamp'])
+    else:
+        df = pd.read_csv(filepath, usecols=None if load_columns is None else lambda col: col in load_columns)
+    if compact:
+        df = apply_telemetry_schema(df)
+    if site_ids is not None:
+        df = df[df['site_id'].isin(site_ids)]
+    if start_time is not None or end_time is not None:
+        times = df['timestamp'] if pd.api.types.is_datetime64_any_dtype(df['timestamp']) else pd.to_datetime(df['timestamp'])
+        df = df[times.between(pd.Timestamp(start_time) if start_time is not None else times.min(),
+                              pd.Timestamp(end_time) if end_time is not None else times.max())]
+
+    if derived:
+        if 'timestamp_datetime' in derived and not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
+            print("Adding Datetime Timestamp and Delta T columns...")
+        # derived from the feature registry (see features.py); anything left out is derived there on demand instead
+        df = FeatureFrame(df).materialize([col for col in DERIVED_COLUMNS if col in derived])
     print("Data columns: {}".format(df.columns))
     print("Number of rows: {}".format(len(df)))
-    print("Earliest timestamp: {}".format(df.iloc[0]['timestamp']))
-    print("Latest timestamp: {}".format(df.iloc[-1]['timestamp']))
+    if len(df):
+        print("Earliest timestamp: {}".format(df.iloc[0]['timestamp']))
+        print("Latest timestamp: {}".format(df.iloc[-1]['timestamp']))
     return df
 
 
-def fetch_bison_data(filepath, start_time=datetime.now() - timedelta(days=90), end_time=datetime.now()):
-    device_ids = [
-        57740,
-        # 48034,
-        33614,
-        33404,
-        33467,    
-        48137,
-        48138
-    ]  # List of device IDs (integers), e.g., [57740, 33614]
-    device_name_substrings = []#['canadian']  # List of devicename substrings, e.g., ['canadian', 'alpha']
-    
-    # 2. Time Zone
-    time_zone = 'UTC'
+# historian sync configuration -- device ids and measurement paths come from the site registry (sites.json)
+BISON_DEVICE_IDS = load_site_registry().device_ids() # List of device IDs (integers), e.g., [57740, 33614]
+BISON_MEASUREMENTS = load_site_registry().measurements # measurement name: historian paths it's read from
+CREDENTIALS_PATH = "/Users/audreyder/Neuralix/bison_credentials.json"
 
-    # 3. Measurement Mappings
-    measurements = {
-        'Vibration': ['sv/pmp_vib_rear', 'sv/hp1_vib', 'sv/vib'],
-        'Thrust Temperature': ['sv/thrust_temp'],
-        'Suction Pressure': ['sv/suctp'],
-        'Discharge Pressure': ['sv/discp'],
-        'Flow Rate': ['sv/fr'],
-        'Frequency': ['sv/vfd_speed', 'sv/HZ', 'sv/hp1_hz'],
-        'Amps': ['sv/vfd_current','sv/hp1_amps_a'],
-        'AmpsA': ['sv/hp1_amps_a','sv/uphase'],
-        'AmpsB': ['sv/hp1_amps_b','sv/vphase'],
-        'AmpsC': ['sv/hp1_amps_c','sv/wphase'],
-        'Volts': ['sv/vfd_voltage', 'sv/outv'],
-        'VoltsA': ['sv/hp1_volts_a'],
-        'VoltsB': ['sv/hp1_volts_b'],
-        'VoltsC': ['sv/hp1_volts_c'],
-        'Meter Total': ['sv/accum_volume', 'sv/av'],
-        # Add more measurements as needed
-    }
-
-    # 4. Time Range
-    # time_interval = '1 hour'  # Adjust as needed
-    time_interval = None
-
-    # Function to generate SQL query
-    def generate_sql_query(device_ids, device_name_substrings, time_zone, measurements, time_interval):
-        # Build SELECT clauses for each measurement
-        select_clauses = [
-            "h.deviceid AS site_id",
-            "d.devicename AS facility_name",
-            "CONVERT_TIMEZONE(%s, h.datetime) AS timestamp"
-        ]
-        params = [time_zone]
-        where_paths = set()
-
-        for measurement_name, paths in measurements.items():
-            case_conditions = "\n            ".join(
-                [f"WHEN h.path = '{path}' THEN h.value" for path in paths]
-            )
-            select_clause = f"""MAX(
-                    CASE
-                        {case_conditions}
-                        ELSE NULL
-                    END
-                ) AS "{measurement_name}" """
-            select_clauses.append(select_clause)
-            where_paths.update(paths)
-
-        # Build WHERE clause components
-        where_clauses = []
-        where_params = []
-
-        # Device ID filtering
-        if device_ids:
-            device_id_placeholders = ', '.join(['%s'] * len(device_ids))
-            where_clauses.append(f"h.deviceid IN ({device_id_placeholders})")
-            where_params.extend(device_ids)
-
-        # Device name substring filtering
-        if device_name_substrings:
-            name_conditions = []
-            for substring in device_name_substrings:
-                name_conditions.append("d.devicename ILIKE %s")
-                where_params.append(f"%{substring}%")
-            where_clauses.append("(" + " OR ".join(name_conditions) + ")")
-
-        # Only include devices that are not disabled
-        where_clauses.append("d.disabled = %s")
-        where_params.append(False)
-
-        # h.path filtering
-        path_placeholders = ', '.join(['%s'] * len(where_paths))
-        where_clauses.append(f"h.path IN ({path_placeholders})")
-        where_params.extend(where_paths)
-
-        # Time filtering
-        # where_clauses.append(f"h.datetime > GETDATE() - INTERVAL %s")
-        # where_params.append(time_interval)
-        # Alternatively, for specific times:
-        where_clauses.append(f"h.datetime BETWEEN %s AND %s")
-        where_params.append(start_time)
-        where_params.append(end_time)
-
-        # Combine WHERE clause
-        where_clause = "WHERE\n    " + "\n    AND ".join(where_clauses)
-
-        # Assemble the final query
-        query = f"""
-    SELECT
-        {',    '.join(select_clauses)}
-    FROM
-        historical AS h
-        JOIN devices AS d ON h.deviceid = d.deviceid
-    {where_clause}
-    GROUP BY
-        h.deviceid, d.devicename, h.datetime
-    ORDER BY
-        h.deviceid, h.datetime;
-    """
-        # Combine all parameters
-        params.extend(where_params)
-        return query, params
-
-    # Generate the query and parameters
-    query, params = generate_sql_query(device_ids, device_name_substrings, time_zone, measurements, time_interval)
-    
-    cred_path = "/Users/audreyder/Neuralix/bison_credentials.json"
+
+def generate_sql_query(device_ids, device_name_substrings, time_zone, measurements, start_time, end_time, dialect='redshift'):
+    # Function to generate SQL query -- pivots the historian's one-row-per-path layout into one column per measurement
+    # dialect: 'redshift', or 'postgres' to run against a local PostgreSQL stand-in of the historian (no CONVERT_TIMEZONE there)
+    # the measurement columns are aliased in lowercase (as SENSOR_COLUMNS names them), since PostgreSQL keeps a quoted
+    # alias's case where Redshift folds it
+    # Build SELECT clauses for each measurement
+    if dialect == 'postgres':
+        timestamp_clause = "(h.datetime AT TIME ZONE 'UTC') AT TIME ZONE %s AS timestamp"
+    else:
+        timestamp_clause = "CONVERT_TIMEZONE(%s, h.datetime) AS timestamp"
+    select_clauses = [
+        "h.deviceid AS site_id",
+        "d.devicename AS facility_name",
+        timestamp_clause
+    ]
+    params = [time_zone]
+    where_paths = set()
+
+    for measurement_name, paths in measurements.items():
+        case_conditions = "\n            ".join(
+            [f"WHEN h.path = '{path}' THEN h.value" for path in paths]
+        )
+        select_clause = f"""MAX(
+                CASE
+                    {case_conditions}
+                    ELSE NULL
+                END
+            ) AS "{measurement_name.lower()}" """
+        select_clauses.append(select_clause)
+        where_paths.update(paths)
+
+    # Build WHERE clause components
+    where_clauses = []
+    where_params = []
+
+    # Device ID filtering
+    if device_ids:
+        device_id_placeholders = ', '.join(['%s'] * len(device_ids))
+        where_clauses.append(f"h.deviceid IN ({device_id_placeholders})")
+        where_params.extend(device_ids)
+
+    # Device name substring filtering
+    if device_name_substrings:
+        name_conditions = []
+        for substring in device_name_substrings:
+            name_conditions.append("d.devicename ILIKE %s")
+            where_params.append(f"%{substring}%")
+        where_clauses.append("(" + " OR ".join(name_conditions) + ")")
+
+    # Only include devices that are not disabled
+    where_clauses.append("d.disabled = %s")
+    where_params.append(False)
+
+    # h.path filtering
+    path_placeholders = ', '.join(['%s'] * len(where_paths))
+    where_clauses.append(f"h.path IN ({path_placeholders})")
+    where_params.extend(where_paths)
+
+    # Time filtering
+    # where_clauses.append(f"h.datetime > GETDATE() - INTERVAL %s")
+    # where_params.append(time_interval)
+    # Alternatively, for specific times:
+    where_clauses.append(f"h.datetime BETWEEN %s AND %s")
+    where_params.append(start_time)
+    where_params.append(end_time)
+
+    # Combine WHERE clause
+    where_clause = "WHERE\n    " + "\n    AND ".join(where_clauses)
+
+    # Assemble the final query
+    query = f"""
+SELECT
+    {',    '.join(select_clauses)}
+FROM
+    historical AS h
+    JOIN devices AS d ON h.deviceid = d.deviceid
+{where_clause}
+GROUP BY
+    h.deviceid, d.devicename, h.datetime
+ORDER BY
+    h.deviceid, h.datetime;
+"""
+    # Combine all parameters
+    params.extend(where_params)
+    return query, params
+
+
+def redshift_connection_kwargs(cred_path=CREDENTIALS_PATH):
+    # psycopg2 connection arguments from the credentials file
     credentials = None
     with open(cred_path, 'r') as file:
         credentials = json.load(file)
@@ -172,8 +267,7 @@ def fetch_bison_data(filepath, start_time=datetime.now() - timedelta(days=90), e
     REDSHIFT_DBNAME = credentials['REDSHIFT_DBNAME']
     REDSHIFT_USER = credentials['REDSHIFT_USER']
     REDSHIFT_PASS = credentials['REDSHIFT_PASS']
-
-    conn = psycopg2.connect(
+    return dict(
         user = REDSHIFT_USER,
         password = REDSHIFT_PASS,
         host = REDSHIFT_ENDPOINT,
@@ -181,134 +275,514 @@ def fetch_bison_data(filepath, start_time=datetime.now() - timedelta(days=90), e
         database = REDSHIFT_DBNAME
     )
 
+
+def connect_redshift(cred_path=CREDENTIALS_PATH):
+    conn = psycopg2.connect(**redshift_connection_kwargs(cred_path))
+    return conn
+
+
+def assign_pump_ids(df):
+    # sets every row's pump_id from the site registry: the pump a device measures at its station, 1 for a single-pump site
+    pump_ids = load_site_registry().pump_ids()
+    df['pump_id'] = df['site_id'].map(pump_ids).fillna(1).astype(int)
+    return df
+
+
+def query_bison_data(conn, device_ids, start_time, end_time, device_name_substrings=None, time_zone='UTC', measurements=BISON_MEASUREMENTS,
+                     dialect='redshift'):
+    # runs the historian pivot query over an open connection
+    # output: dataframe with one row per (site_id, timestamp), pump_id set, and volts/amps processed
+    # ================================================
+    query, params = generate_sql_query(device_ids, device_name_substrings, time_zone, measurements, start_time, end_time, dialect=dialect)
     # Execute the query and load results into a pandas DataFrame
     df = pd.read_sql_query(query, conn, params=params)
-    df['pump_id'] = 1
+    df = assign_pump_ids(df)
+    # Process the voltage and current columns
+    df = process_voltage_and_current(df)
+    return df
+
+
+def fetch_bison_data(filepath, start_time=datetime.now() - timedelta(days=90), end_time=datetime.now(), chunksize=None):
+    # pulls every device's data for [start_time, end_time] from Redshift and caches it at filepath (CSV, .parquet, or .feather)
+    # see sync_bison_data() for refreshing a cache without re-pulling the whole window
+    # chunksize: (optional) stream the query in batches of this many rows straight to filepath (a CSV or a cache directory)
+        # instead of loading the whole result into memory; nothing is returned in that case
+    # ================================================
+    device_ids = BISON_DEVICE_IDS
+    device_name_substrings = []#['canadian']  # List of devicename substrings, e.g., ['canadian', 'alpha']
+    
+    # 2. Time Zone
+    time_zone = 'UTC'
+
+    conn = connect_redshift()
+    if chunksize is not None:
+        rows_written, _ = stream_bison_data(conn, device_ids, start_time, end_time, filepath, chunksize=chunksize,
+                                            device_name_substrings=device_name_substrings, time_zone=time_zone)
+        conn.close()
+        print("Wrote {} rows to {}".format(rows_written, filepath))
+        return None
+    df = query_bison_data(conn, device_ids, start_time, end_time, device_name_substrings=device_name_substrings, time_zone=time_zone)
 
     # Close the database connection
     conn.close()
     df.set_index(['site_id','pump_id','timestamp'],inplace=True)
 
-    # Process the voltage and current columns
-    df = process_voltage_and_current(df)
-
     # Ensure 'timestamp' is in datetime format # -- moved this step to catched data function
     # df['timestamp_datetime'] = pd.to_datetime(df['timestamp'])
     # df['delta_t'] = df['timestamp_datetime'].diff()
-    df.to_csv(filepath, index=True)
+    if is_columnar_cache(filepath):
+        write_columnar_cache(df, filepath)
+    else:
+        df.to_csv(filepath, index=True)
     return df
 
 
-def cached_site_info(dict=False):
-    # UPDATED SITES INFO - 01-24-2025
-    # updated Calumet Calibration stage estimations for ground truth
-    # NOTE: these estimations of ground truth are based on strict assumptions each ...
-    # ...frequency is tested for precisely two hours (and not a half an hour more)
-    # in the future, we are working on making this more sophisticated
+def shard_fetch_window(device_ids, start_time, end_time, shard_days=7):
+    # splits a fetch into (device_id, shard_start, shard_end) pieces of at most shard_days each
+    shards = []
+    for device_id in device_ids:
+        shard_start = start_time
+        while shard_start < end_time:
+            shard_end = min(shard_start + timedelta(days=shard_days), end_time)
+            shards.append((device_id, shard_start, shard_end))
+            shard_start = shard_end
+    return shards
+
+
+def parallel_fetch_bison_data(start_time, end_time, device_ids=None, filepath=None, shard_days=7, max_workers=4, retries=3,
+                              retry_wait=2, connection_kwargs=None, dialect='redshift'):
+    # fetches (device, day-range) shards concurrently through a bounded connection pool, so the sync takes about as long
+    # as the slowest shard instead of the sum of all of them; failed shards are retried with exponential backoff
+    # ------------------------------------------------
+    # start_time, end_time: the time window to fetch
+    # device_ids: (optional) list of (int) device ids; defaults to BISON_DEVICE_IDS
+    # filepath: (optional) cache the result here like fetch_bison_data does (CSV, .parquet, or .feather)
+    # shard_days: (int) days per shard
+    # max_workers: (int) concurrent shards, which is also the size of the connection pool
+    # retries: (int) extra attempts per shard before giving up
+    # retry_wait: (float) seconds before the first retry, doubled for each later one
+    # connection_kwargs: (optional) psycopg2.connect arguments; defaults to the Redshift credentials file
+        # e.g. dict(host='localhost', database='historian', user=..., password=...) with dialect='postgres' for a local stand-in
+    # output: dataframe of all shards merged in (site_id, timestamp) order
+    # ================================================
+    device_ids = BISON_DEVICE_IDS if device_ids is None else device_ids
+    connection_kwargs = redshift_connection_kwargs() if connection_kwargs is None else connection_kwargs
+    shards = shard_fetch_window(device_ids, start_time, end_time, shard_days=shard_days)
+    connection_pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers, **connection_kwargs)
+
+    def fetch_shard(shard):
+        device_id, shard_start, shard_end = shard
+        for attempt in range(retries + 1):
+            conn = None
+            try:
+                conn = connection_pool.getconn() # connecting can fail transiently too (OperationalError, or PoolError if exhausted)
+                df_shard = query_bison_data(conn, [device_id], shard_start, shard_end, dialect=dialect)
+            except (psycopg2.Error, psycopg2.pool.PoolError, pd.errors.DatabaseError) as error: # read_sql_query wraps driver errors in DatabaseError
+                if conn is not None:
+                    connection_pool.putconn(conn, close=True) # don't hand a broken connection to the next shard
+                if attempt == retries:
+                    raise
+                print("Shard {} failed ({}), retrying".format(shard, error))
+                time.sleep(retry_wait * 2 ** attempt)
+            except Exception:
+                if conn is not None:
+                    connection_pool.putconn(conn)
+                raise
+            else:
+                connection_pool.putconn(conn)
+                return df_shard
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shard_results = list(executor.map(fetch_shard, shards))
+    finally:
+        connection_pool.closeall()
+
+    df = pd.concat(shard_results, ignore_index=True) if shard_results else pd.DataFrame(columns=KEY_COLUMNS)
+    # BETWEEN is inclusive on both ends, so rows on a shard boundary come back twice
+    df = df.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+    df = df.sort_values(['site_id', 'timestamp'], kind='stable').reset_index(drop=True)
+    if filepath is not None:
+        if is_columnar_cache(filepath):
+            write_columnar_cache(df, filepath)
+        else:
+            df.set_index(['site_id','pump_id','timestamp']).to_csv(filepath, index=True)
+    return df
 
-    if dict:
-        sites_info = {33614:
-        {'enable': False, 'site_name': 'Calumet SWD', 'site_id': 33614, 'num_pumps': 1, 'site_dir_name': 'CalumetSWD(33614)', 
-        'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Calument_33614_DataPoints.csv', # replace path as appropriate
-        'calibration_stages': [
-            {'frequency': 48, 'start_time': '2025-01-15 15:00:19', 'end_time': '2025-01-15 16:20:19'}, 
-            {'frequency': 50, 'start_time': '2025-01-15 16:25:19', 'end_time': '2025-01-15 18:10:17'}, 
-            {'frequency': 52, 'start_time': '2025-01-15 18:15:19', 'end_time': '2025-01-15 19:50:23'}, 
-            {'frequency': 54, 'start_time': '2025-01-15 19:55:18', 'end_time': '2025-01-15 21:40:18'}, 
-            {'frequency': 56, 'start_time': '2025-01-15 21:45:18', 'end_time': '2025-01-15 23:35:20'}, 
-            {'frequency': 58, 'start_time': '2025-01-15 23:40:19', 'end_time': '2025-01-16 00:08:30'}]}, 
-        57740:
-        {'enable': False, 'site_name': 'Canadian SWD', 'site_id': 57740, 'num_pumps': 1, 'site_dir_name': 'CanadianSWD(57740)', 
-        'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Canadian_57740_DataPoints.csv', # replace path as appropriate
-        'calibration_stages': [
-            {'frequency': 44, 'start_time': '2024-12-13 12:00:02', 'end_time': '2024-12-13 13:58:02'}, 
-            {'frequency': 47, 'start_time': '2024-12-13 13:59:03', 'end_time': '2024-12-13 15:51:03'}, 
-            {'frequency': 49, 'start_time': '2024-12-13 15:52:03', 'end_time': '2024-12-13 17:51:03'}, 
-            {'frequency': 51, 'start_time': '2024-12-13 17:52:02', 'end_time': '2024-12-13 19:50:04'}, 
-            {'frequency': 53, 'start_time': '2024-12-13 19:51:03', 'end_time': '2024-12-13 21:47:04'}, 
-            {'frequency': 55, 'start_time': '2024-12-13 21:48:03', 'end_time': '2024-12-13 23:53:02'}, 
-            {'frequency': 57, 'start_time': '2024-12-13 23:54:03', 'end_time': '2024-12-14 01:53:03'}, 
-            {'frequency': 59, 'start_time': '2024-12-14 01:54:03', 'end_time': '2024-12-14 03:53:02'}]}, 
-        33467:
-        {'enable': False, 'site_name': 'Siegrist SWD', 'site_id': 33467, 'num_pumps': 1, 'site_dir_name': 'SiegristSWD(33467)', 
-        'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Siegrist_33467_DataPoints.csv', # replace path as appropriate
-        'calibration_stages': [
-            {'frequency': 47, 'start_time': '2024-12-17 12:00:21', 'end_time': '2024-12-17 13:55:19'}, 
-            {'frequency': 49, 'start_time': '2024-12-17 14:00:32', 'end_time': '2024-12-17 15:55:19'}, 
-            {'frequency': 51, 'start_time': '2024-12-17 16:00:19', 'end_time': '2024-12-17 17:55:20'}, 
-            {'frequency': 53, 'start_time': '2024-12-17 18:00:38', 'end_time': '2024-12-17 19:55:20'}, 
-            {'frequency': 55, 'start_time': '2024-12-17 20:00:22', 'end_time': '2024-12-17 21:50:23'}, 
-            {'frequency': 57, 'start_time': '2024-12-17 21:55:19', 'end_time': '2024-12-17 23:45:21'}]}, 
-        33404:
-        {'enable': False, 'site_name': 'Union City 2 SWD', 'site_id': 33404, 'num_pumps': 1, 'site_dir_name': 'UnionCity2SWD(33404)', 
-        'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_UnionCity2_33404_DataPoints.csv', # replace path as appropriate
-        'calibration_stages': [
-            {'frequency': 46, 'start_time': '2024-12-17 12:00:12', 'end_time': '2024-12-17 13:50:12'}, 
-            {'frequency': 48, 'start_time': '2024-12-17 13:55:11', 'end_time': '2024-12-17 15:50:11'}, 
-            {'frequency': 50, 'start_time': '2024-12-17 15:55:11', 'end_time': '2024-12-17 17:50:12'}, 
-            {'frequency': 52, 'start_time': '2024-12-17 17:55:12', 'end_time': '2024-12-17 19:50:11'}, 
-            {'frequency': 54, 'start_time': '2024-12-17 19:55:11', 'end_time': '2024-12-17 21:45:11'}, 
-            {'frequency': 56, 'start_time': '2024-12-17 21:50:11', 'end_time': '2024-12-17 23:35:14'}]},
-        48137:
-        {'enable': False, 'site_name': '1509 1 SWD', 'site_id': 48137, 'num_pumps': 1, 'site_dir_name': '', 
-        'pump_curve_path': "1509 SWD",
-        'calibration_stages': []},
-
-        48138:
-        {'enable': False, 'site_name': '1509 2 SWD', 'site_id': 48138, 'num_pumps': 1, 'site_dir_name': '', 
-        'pump_curve_path': "1509 SWD",
-        'calibration_stages': []}
-            
-        }
 
+def write_cache_chunk(chunk, target, chunk_name, append=True):
+    # writes one batch of historian rows to the on-disk cache: a new parquet part if target is a directory, else to a CSV
+    # a CSV is written like fetch_bison_data writes it (site_id, pump_id, timestamp first); append: add the rows to the
+    # CSV, in its column order (a later batch of the same fetch), rather than start the file over with them
+    if os.path.isdir(target):
+        write_columnar_cache(chunk, os.path.join(target, "part-{}.parquet".format(chunk_name)))
+        return
+    chunk = chunk.set_index(['site_id','pump_id','timestamp'])
+    if append and os.path.exists(target) and os.path.getsize(target) > 0:
+        header = list(pd.read_csv(target, nrows=0).columns)
+        if sorted(header) != sorted(KEY_COLUMNS + list(chunk.columns)):
+            raise ValueError("Can't append to {}: its columns {} aren't the fetched columns {}".format(
+                target, header, KEY_COLUMNS + list(chunk.columns)))
+        chunk.reset_index()[header].to_csv(target, mode='a', header=False, index=False)
     else:
-        sites_info = [{'enable': False, 'site_name': 'Calumet SWD', 'site_id': 33614, 'num_pumps': 1, 'site_dir_name': 'CalumetSWD(33614)', 'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Calument_33614_DataPoints.csv', 
-                       'calibration_stages': [{'frequency': 48, 'start_time': '2025-01-15 15:00:19', 'end_time': '2025-01-15 16:20:19'}, {'frequency': 50, 'start_time': '2025-01-15 16:25:19', 'end_time': '2025-01-15 18:10:17'}, {'frequency': 52, 'start_time': '2025-01-15 18:15:19', 'end_time': '2025-01-15 19:50:23'}, {'frequency': 54, 'start_time': '2025-01-15 19:55:18', 'end_time': '2025-01-15 21:40:18'}, {'frequency': 56, 'start_time': '2025-01-15 21:45:18', 'end_time': '2025-01-15 23:35:20'}, {'frequency': 58, 'start_time': '2025-01-15 23:40:19', 'end_time': '2025-01-16 00:08:30'}]},
-                      
-        {'enable': False, 'site_name': 'Canadian SWD', 'site_id': 57740, 'num_pumps': 1, 'site_dir_name': 'CanadianSWD(57740)', 'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Canadian_57740_DataPoints.csv', 
-         'calibration_stages': [{'frequency': 44, 'start_time': '2024-12-13 12:00:02', 'end_time': '2024-12-13 13:58:02'}, {'frequency': 47, 'start_time': '2024-12-13 13:59:03', 'end_time': '2024-12-13 15:51:03'}, {'frequency': 49, 'start_time': '2024-12-13 15:52:03', 'end_time': '2024-12-13 17:51:03'}, {'frequency': 51, 'start_time': '2024-12-13 17:52:02', 'end_time': '2024-12-13 19:50:04'}, {'frequency': 53, 'start_time': '2024-12-13 19:51:03', 'end_time': '2024-12-13 21:47:04'}, {'frequency': 55, 'start_time': '2024-12-13 21:48:03', 'end_time': '2024-12-13 23:53:02'}, {'frequency': 57, 'start_time': '2024-12-13 23:54:03', 'end_time': '2024-12-14 01:53:03'}, {'frequency': 59, 'start_time': '2024-12-14 01:54:03', 'end_time': '2024-12-14 03:53:02'}]},
+        chunk.to_csv(target, mode='w', index=True)
+
+
+def is_csv_target(target):
+    # whether stream_bison_data writes target as a CSV (a .csv path, or an existing file) rather than a cache directory
+    return str(target).endswith('.csv') or os.path.isfile(target)
+
+
+def stream_bison_data(conn, device_ids, start_time, end_time, target, chunksize=100000, chunk_prefix=None,
+                      device_name_substrings=None, time_zone='UTC', measurements=BISON_MEASUREMENTS):
+    # streams the historian pivot query through a named (server-side) cursor in fixed-size batches, so peak memory is
+    # bounded by chunksize rather than by devices x window length; each batch is processed and written out before the next
+    # ------------------------------------------------
+    # conn: open psycopg2 connection (see connect_redshift())
+    # device_ids: list of (int) device ids
+    # start_time, end_time: the time window to fetch
+    # target: a cache directory (each batch becomes a part-*.parquet; created if it doesn't exist) or a .csv path (written
+        # over by the first batch, like fetch_bison_data's non-streaming write, and appended to by the rest)
+    # chunksize: (int) rows per batch
+    # chunk_prefix: (optional) prefix for part names; defaults to the current time so parts sort oldest -> newest
+    # output: (int) rows written, dictionary of site_id: latest timestamp written
+    # ================================================
+    if is_columnar_cache(target):
+        raise ValueError("stream_bison_data writes to a cache directory or a CSV, not a single {} file".format(os.path.splitext(target)[1]))
+    if not is_csv_target(target):
+        os.makedirs(target, exist_ok=True)
+    chunk_prefix = datetime.now().strftime("%Y%m%dT%H%M%S%f") if chunk_prefix is None else chunk_prefix
+    query, params = generate_sql_query(device_ids, device_name_substrings, time_zone, measurements, start_time, end_time)
+
+    rows_written = 0
+    high_water_marks = {}
+    with conn.cursor(name="bison_historian_{}".format(chunk_prefix.replace("-", "_"))) as cursor: # a named cursor is server-side in psycopg2
+        cursor.itersize = chunksize
+        cursor.execute(query, params)
+        columns = None
+        chunk_number = 0
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            if columns is None:
+                columns = [desc[0] for desc in cursor.description]
+            chunk = pd.DataFrame(rows, columns=columns)
+            chunk = assign_pump_ids(chunk)
+            chunk = process_voltage_and_current(chunk)
+            write_cache_chunk(chunk, target, "{}-{:05d}".format(chunk_prefix, chunk_number), append=chunk_number > 0)
+            rows_written += len(chunk)
+            for site_id, hwm in chunk.groupby('site_id')['timestamp'].max().items():
+                high_water_marks[int(site_id)] = max(pd.Timestamp(hwm), high_water_marks.get(int(site_id), pd.Timestamp(hwm)))
+            chunk_number += 1
+        if chunk_number == 0 and is_csv_target(target): # nothing fetched: the CSV is still written over, with just its header
+            chunk = assign_pump_ids(pd.DataFrame([], columns=[desc[0] for desc in cursor.description]))
+            write_cache_chunk(chunk, target, "{}-{:05d}".format(chunk_prefix, chunk_number), append=False)
+    conn.commit() # closes the transaction the named cursor ran in
+    return rows_written, high_water_marks
+
+
+SYNC_STATE_FILE = "sync_state.json"
+
+
+def read_sync_state(cache_dir):
+    # per-device high-water marks of an incrementally synced cache: {site_id: latest synced timestamp}
+    state_path = os.path.join(cache_dir, SYNC_STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return {int(site_id): pd.Timestamp(hwm) for site_id, hwm in json.load(file).items()}
+
+
+def write_sync_state(cache_dir, state):
+    with open(os.path.join(cache_dir, SYNC_STATE_FILE), 'w') as file:
+        json.dump({str(site_id): str(hwm) for site_id, hwm in state.items()}, file, indent=2)
+
+
+def sync_bison_data(cache_dir, end_time=None, lookback=timedelta(hours=6), initial_days=90, device_ids=None, chunksize=100000):
+    # incremental (delta) sync: fetches only rows newer than each device's high-water mark and appends them as new parts of the cache
+    # rows within `lookback` of the high-water mark are re-fetched so late-arriving rows are reconciled; cached_bison_data
+    # keeps the newest copy of any duplicated (site_id, pump_id, timestamp) row
+    # ------------------------------------------------
+    # cache_dir: directory of part-*.parquet files plus sync_state.json; read it back with cached_bison_data(cache_dir)
+    # end_time: (optional) sync up to this time; defaults to now
+    # lookback: (timedelta) how far behind the high-water mark to re-fetch
+    # initial_days: (int) window fetched for a device that has never been synced
+    # device_ids: (optional) list of (int) device ids to sync; defaults to BISON_DEVICE_IDS
+    # chunksize: (int) rows per streamed batch, see stream_bison_data()
+    # output: dictionary of site_id: high-water mark after the sync
+    # ================================================
+    end_time = datetime.now() if end_time is None else end_time
+    device_ids = BISON_DEVICE_IDS if device_ids is None else device_ids
+    os.makedirs(cache_dir, exist_ok=True)
+    state = read_sync_state(cache_dir)
+    sync_prefix = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+
+    conn = connect_redshift()
+    total_rows = 0
+    for device_id in device_ids:
+        if device_id in state:
+            start_time = state[device_id] - lookback
+        else:
+            start_time = end_time - timedelta(days=initial_days)
+        print("Syncing {} from {}".format(device_id, start_time))
+        rows_written, high_water_marks = stream_bison_data(conn, [device_id], start_time, end_time, cache_dir, chunksize=chunksize,
+                                                           chunk_prefix="{}-{}".format(sync_prefix, device_id))
+        total_rows += rows_written
+        # only move a high-water mark forward once its rows are on disk
+        for site_id, hwm in high_water_marks.items():
+            state[site_id] = max(hwm, state.get(site_id, hwm))
+        write_sync_state(cache_dir, state)
+    conn.close()
+    print("Fetched {} rows".format(total_rows))
+    return state
+
+
+def read_partitioned_cache(cache_dir, columns=None):
+    # reads every part of an incrementally synced cache, keeping only the newest copy of each (site_id, pump_id, timestamp) row
+    # ------------------------------------------------
+    # cache_dir: directory written by sync_bison_data()
+    # columns: (optional) list of columns to load
+    # output: dataframe sorted by site_id, pump_id, timestamp (empty if nothing was synced yet, with the key columns and the
+        # columns asked for -- every schema column by default -- so filtering and the KPIs get an empty result, not an error)
+    # ================================================
+    part_paths = sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.startswith("part-") and name.endswith(".parquet"))
+    if not part_paths: # e.g. a fresh cache whose first sync returned nothing
+        empty_columns = KEY_COLUMNS + [col for col in (TELEMETRY_SCHEMA if columns is None else columns) if col not in KEY_COLUMNS]
+        return pd.DataFrame({col: pd.Series(dtype=TELEMETRY_SCHEMA.get(col, 'float64')) for col in empty_columns})
+    parts = [pd.read_parquet(part_path, columns=columns) for part_path in part_paths] # part names sort oldest -> newest
+    df = pd.concat(parts, ignore_index=True)
+    df = df.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+    df = df.sort_values(KEY_COLUMNS, kind='stable').reset_index(drop=True)
+    return df
+
+
+def compact_cache(cache_dir):
+    # rewrites an incrementally synced cache as a single part, dropping superseded duplicate rows
+    df = read_partitioned_cache(cache_dir)
+    old_parts = [name for name in os.listdir(cache_dir) if name.startswith("part-")]
+    if not old_parts:
+        return df
+    write_columnar_cache(df, os.path.join(cache_dir, "part-{}.parquet".format(datetime.now().strftime("%Y%m%dT%H%M%S%f"))))
+    for name in old_parts:
+        os.remove(os.path.join(cache_dir, name))
+    return df
 
-        {'enable': False, 'site_name': 'Siegrist SWD', 'site_id': 33467, 'num_pumps': 1, 'site_dir_name': 'SiegristSWD(33467)', 'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_Siegrist_33467_DataPoints.csv', 
-         'calibration_stages': [
-             {'frequency': 47, 'start_time': '2024-12-17 12:00:21', 'end_time': '2024-12-17 13:55:19'}, 
-             {'frequency': 49, 'start_time': '2024-12-17 14:00:32', 'end_time': '2024-12-17 15:55:19'}, 
-             {'frequency': 51, 'start_time': '2024-12-17 16:00:19', 'end_time': '2024-12-17 17:55:20'}, 
-             {'frequency': 53, 'start_time': '2024-12-17 18:00:38', 'end_time': '2024-12-17 19:55:20'}, 
-             {'frequency': 55, 'start_time': '2024-12-17 20:00:22', 'end_time': '2024-12-17 21:50:23'}, 
-             {'frequency': 57, 'start_time': '2024-12-17 21:55:19', 'end_time': '2024-12-17 23:45:21'}]},
 
-        {'enable': False, 'site_name': 'Union City 2 SWD', 'site_id': 33404, 'num_pumps': 1, 'site_dir_name': 'UnionCity2SWD(33404)', 'pump_curve_path': '/Users/audreyder/Neuralix/AllPumpCSV/PumpCurve_UnionCity2_33404_DataPoints.csv', 
-         'calibration_stages': [{'frequency': 46, 'start_time': '2024-12-17 12:00:12', 'end_time': '2024-12-17 13:50:12'}, {'frequency': 48, 'start_time': '2024-12-17 13:55:11', 'end_time': '2024-12-17 15:50:11'}, {'frequency': 50, 'start_time': '2024-12-17 15:55:11', 'end_time': '2024-12-17 17:50:12'}, {'frequency': 52, 'start_time': '2024-12-17 17:55:12', 'end_time': '2024-12-17 19:50:11'}, {'frequency': 54, 'start_time': '2024-12-17 19:55:11', 'end_time': '2024-12-17 21:45:11'}, {'frequency': 56, 'start_time': '2024-12-17 21:50:11', 'end_time': '2024-12-17 23:35:14'}]}
-        ]
+# per-site memory-mapped store -- see write_site_store()
+SITE_STORE_INDEX = "site_index.json"
 
-    return sites_info
 
+def is_site_store(path):
+    return os.path.isfile(os.path.join(path, SITE_STORE_INDEX))
 
-def select_calib_data(df, stage, approx_time=True):
+
+def read_site_index(store_dir):
+    # output: the store's index -- {'columns': {column: {'file', 'dtype'}}, 'sites': {site_id: {'facility_name', 'rows', 'start_time', 'end_time', 'pump_ids'}}}
+    with open(os.path.join(store_dir, SITE_STORE_INDEX)) as f:
+        return json.load(f)
+
+
+def site_store_filename(col):
+    return col.replace(' ', '_').replace('/', '_') + '.bin'
+
+
+def write_site_store(data, store_dir):
+    # writes telemetry as a per-site, per-sensor store of flat binary arrays plus a small index of each site's rows and time range
+    # every site is a directory of one file per column, sorted by pump then time, so open_site() can read (or memory-map)
+    # just one site, or one time window of it, and page in only those bytes, instead of loading a fleet-wide CSV first
+    # ------------------------------------------------
+    # data: dataframe, or an iterable of dataframes (e.g. pd.read_csv(..., chunksize=...)), so the input never has to fit in memory
+    # store_dir: directory of the store; sites in data replace the same sites already in the store, other sites are kept
+    # output: the store's index (see read_site_index())
+    # ================================================
+    os.makedirs(store_dir, exist_ok=True)
+    index = read_site_index(store_dir) if is_site_store(store_dir) else {'columns': {}, 'sites': {}}
+    site_rows = {} # site_id: rows written so far by this call
+    facility_names = {}
+    for chunk in ([data] if isinstance(data, pd.DataFrame) else data):
+        if any(name in KEY_COLUMNS for name in chunk.index.names):
+            chunk = chunk.reset_index()
+        chunk = apply_telemetry_schema(chunk.copy())
+        for col in ['pump_id', 'timestamp'] + [col for col in SENSOR_COLUMNS if col in chunk.columns]:
+            if col not in index['columns']:
+                index['columns'][col] = {'file': site_store_filename(col), 'dtype': str(chunk[col].dtype)}
+                for site_id, rows in site_rows.items(): # a column that first shows up mid-way is NaN for the rows before it
+                    np.full(rows, np.nan, dtype=index['columns'][col]['dtype']).tofile(os.path.join(store_dir, str(site_id), index['columns'][col]['file']))
+        for site_id, site_chunk in chunk.groupby('site_id', sort=False, observed=True):
+            site_id = int(site_id)
+            site_dir = os.path.join(store_dir, str(site_id))
+            if site_id not in site_rows: # first rows of this site in this call: start it over
+                shutil.rmtree(site_dir, ignore_errors=True)
+                os.makedirs(site_dir)
+                site_rows[site_id] = 0
+                facility_names[site_id] = str(site_chunk['facility_name'].iloc[0]) if 'facility_name' in site_chunk.columns else None
+            for col, col_info in index['columns'].items():
+                if col in site_chunk.columns:
+                    values = site_chunk[col].to_numpy(dtype=col_info['dtype'])
+                else:
+                    values = np.full(len(site_chunk), np.nan, dtype=col_info['dtype'])
+                with open(os.path.join(site_dir, col_info['file']), 'ab') as f:
+                    values.tofile(f)
+            site_rows[site_id] += len(site_chunk)
+
+    # sort each site by pump, then time (the order of the CSV cache, so delta_t stays within a pump): every pump is one
+    # contiguous block, and a time window is one contiguous byte range of each pump's block
+    for site_id, rows in site_rows.items():
+        site_dir = os.path.join(store_dir, str(site_id))
+        column_path = lambda col: os.path.join(site_dir, index['columns'][col]['file'])
+        times = np.fromfile(column_path('timestamp'), dtype='datetime64[ns]')
+        pump_ids = np.fromfile(column_path('pump_id'), dtype=index['columns']['pump_id']['dtype'])
+        order = np.lexsort((times, pump_ids))
+        if np.any(order != np.arange(rows)):
+            for col, col_info in index['columns'].items():
+                np.fromfile(column_path(col), dtype=col_info['dtype'])[order].tofile(column_path(col))
+            times, pump_ids = times[order], pump_ids[order]
+        valid_times = np.sort(times[~np.isnat(times)])
+        starts = np.flatnonzero(np.r_[True, pump_ids[1:] != pump_ids[:-1]]) if rows else np.array([], dtype=int)
+        ends = np.r_[starts[1:], rows]
+        index['sites'][str(site_id)] = {'facility_name': facility_names[site_id], 'rows': int(rows),
+                                        'start_time': str(valid_times[0]) if len(valid_times) else None,
+                                        'end_time': str(valid_times[-1]) if len(valid_times) else None,
+                                        'pump_ids': sorted(int(pump_id) for pump_id in np.unique(pump_ids)),
+                                        'pump_rows': {str(int(pump_ids[start])): [int(start), int(end)] for start, end in zip(starts, ends)}}
+    with open(os.path.join(store_dir, SITE_STORE_INDEX), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def build_site_store(cache_path, store_dir, chunksize=1000000):
+    # one-time conversion of a CSV (read chunksize rows at a time), Parquet, or Feather cache into a site store
+    if is_columnar_cache(cache_path):
+        return write_site_store(pd.read_parquet(cache_path) if str(cache_path).endswith('.parquet') else pd.read_feather(cache_path), store_dir)
+    return write_site_store(pd.read_csv(cache_path, chunksize=chunksize), store_dir)
+
+
+def open_site(store_dir, site_id, start_time=None, end_time=None, columns=None, index=None, mmap=False):
+    # opens one site of a site store as a dataframe, reading only the pages of the requested columns and time window
+    # ------------------------------------------------
+    # store_dir: directory written by write_site_store()
+    # site_id: (int)
+    # start_time, end_time: (optional) only rows with start_time <= timestamp <= end_time
+    # columns: (optional) list of sensor columns to open; site_id, pump_id, and timestamp are always included
+    # index: (optional) the store's index, if already read
+    # mmap: if True, the columns are read-only memory maps onto the store's files -- nothing is read until it's used, but
+        # writing to the frame in place (df.loc[...] = ..., fillna(inplace=True), process_voltage_and_current) fails with
+        # "assignment destination is read-only"; a multi-pump site with a time window is copied either way (its rows are
+        # one range per pump); by default the columns are copied into memory
+    # output: dataframe in the compact schema (see TELEMETRY_SCHEMA), sorted by pump_id then timestamp, indexed by row
+        # number within the site
+    # ================================================
+    index = read_site_index(store_dir) if index is None else index
+    site_info = index['sites'][str(site_id)]
+    rows = site_info['rows']
+
+    def column(col):
+        col_info = index['columns'][col]
+        path = os.path.join(store_dir, str(site_id), col_info['file'])
+        if rows == 0 or not os.path.exists(path): # an empty file can't be mapped; a column added after this site was written is NaN
+            return np.full(rows, np.nan if col != 'pump_id' else 0, dtype=col_info['dtype'])
+        return np.memmap(path, dtype=col_info['dtype'], mode='r', shape=(rows,))
+
+    times = column('timestamp')
+    blocks = sorted(site_info['pump_rows'].values())
+    ranges = []
+    for block_start, block_end in blocks: # the window's rows of each pump block, found by binary search
+        block_times = times[block_start:block_end]
+        lo = 0 if start_time is None else int(np.searchsorted(block_times, np.datetime64(pd.Timestamp(start_time), 'ns'), side='left'))
+        hi = len(block_times) if end_time is None else int(np.searchsorted(block_times, np.datetime64(pd.Timestamp(end_time), 'ns'), side='right'))
+        if hi > lo:
+            ranges.append((block_start + lo, block_start + hi))
+    if len(ranges) <= 1:
+        lo, hi = ranges[0] if ranges else (0, 0)
+        take = lambda values: values[lo:hi] if mmap else np.array(values[lo:hi])
+        row_index = pd.RangeIndex(lo, hi)
+    else:
+        take = lambda values: np.concatenate([values[lo:hi] for lo, hi in ranges])
+        row_index = pd.Index(np.concatenate([np.arange(lo, hi) for lo, hi in ranges]))
+    n_rows = len(row_index)
+
+    frame = {'site_id': pd.Categorical.from_codes(np.zeros(n_rows, dtype='int8'), categories=[int(site_id)]),
+             'pump_id': take(column('pump_id'))}
+    if site_info['facility_name'] is not None:
+        frame['facility_name'] = pd.Categorical.from_codes(np.zeros(n_rows, dtype='int8'), categories=[site_info['facility_name']])
+    frame['timestamp'] = take(times)
+    for col in index['columns']:
+        if col not in frame and (columns is None or col in columns):
+            frame[col] = take(column(col))
+    return pd.DataFrame(frame, index=row_index, copy=False)
+
+
+def read_site_store(store_dir, site_ids=None, start_time=None, end_time=None, columns=None, mmap=False):
+    # opens several sites of a site store (see open_site()); with mmap, a single site stays memory-mapped, several are concatenated
+    # ------------------------------------------------
+    # site_ids: (optional) list of (int) site_ids; defaults to every site in the store
+    # output: dataframe of the sites' rows, site by site
+    # ================================================
+    index = read_site_index(store_dir)
+    site_ids = [int(site_id) for site_id in index['sites']] if site_ids is None else list(site_ids)
+    frames = [open_site(store_dir, site_id, start_time, end_time, columns, index=index, mmap=mmap) for site_id in site_ids]
+    if len(frames) == 1:
+        return frames[0]
+    df = pd.concat(frames, ignore_index=True)
+    for col in ['site_id', 'facility_name']: # concatenating categoricals with different categories gives object columns
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def cached_site_info(dict=False):
+    # every site's info (calibration stages, pump curve path, etc.) in the Ryan sites_info format, from the site registry
+    # the calibration stages were estimated assuming each frequency is tested for precisely two hours -- see
+    # detect_sites_calibration_stages() in formatting.py for detecting them from the data instead
+    # ------------------------------------------------
+    # dict: if True, a dictionary of site_id: site info for every site; otherwise a list of the sites that have calibration stages
+    # output: fresh copies, so callers can edit them
+    # ================================================
+    registry = load_site_registry()
+    sites_info = {site_id: registry.site_info(site_id) for site_id in registry.site_ids()}
+    if dict:
+        return sites_info
+    return [site_info for site_info in sites_info.values() if site_info['calibration_stages']]
+
+
+def calib_stage_bounds(df, calibration_stages, approx_time=True, time_index=None):
+    # resolves every calibration stage's start and end to dataframe index labels at once
+    # exact timestamps are looked up together in one binary search over the time index; only the misses fall back to
+    # the closest-time search (same day only, as find_closest_time)
+    # ------------------------------------------------
+    # df: the dataframe the calibration stage data is in
+    # calibration_stages: list of stages in the Ryan sites_info format (see cached_site_info())
+    # approx_time: if an exact start/end time can't be found in the dataframe, use the closest time to it
+    # time_index: (optional) a prebuilt TimestampIndex of df
+    # output: array of start labels, array of end labels (one per stage; df.loc[start:end] is the stage's data)
+    # ================================================
+    if time_index is None:
+        time_index = TimestampIndex(df)
+    bounds = []
+    for key, name in [('start_time', 'start'), ('end_time', 'end')]:
+        queries = [stage[key] for stage in calibration_stages]
+        labels, found = time_index.find_many(queries)
+        for i in np.flatnonzero(~found):
+            if not approx_time:
+                raise IndexError("Calibration stage {} {} not found".format(name, queries[i]))
+            date_time = queries[i].split(" ")
+            _, labels[i] = find_closest_time(df,date_time[0],query_time=date_time[1],time_index=time_index)
+        bounds.append(labels)
+    return bounds[0], bounds[1]
+
+
+def select_calib_data(df, stage, approx_time=True, time_index=None):
     # for a given calibration stage and the dataframe that data is in, select just that calibration data
     # ------------------------------------------------
     # df: the dataframe the calibration stage data is in
     # stage: the calibration stage data for a given site in the Ryan sites_info format (see cached_site_info())
+    # time_index: (optional) a prebuilt TimestampIndex of df; pass one when selecting several stages from the same df
     # output: the calibration data for the input stage specified
     # ================================================
-    start = stage['start_time']
-    end = stage['end_time']
-
-    start_idx, end_idx = None, None
-        # first condition: do you find the exact timestamp in the db? second condition: do you allow searching for the closest approx time? or do you want exact?
-    if len(df[df['timestamp']==start]) == 0 and approx_time:
-        date_time = start.split(" ")
-        if approx_time:
-            start, start_idx = find_closest_time(df,date_time[0],query_time=date_time[1])
-    else:
-        start_idx = df[df['timestamp']==start].index[0]
-        
-    if len(df[df['timestamp']==end]) == 0 and approx_time:
-        date_time = end.split(" ")
-        end, end_idx = find_closest_time(df,date_time[0],query_time=date_time[1])
-    else:
-        end_idx = df[df['timestamp']==end].index[0]
-    
+    # first: do you find the exact timestamp in the db? if not: do you allow searching for the closest approx time? or do you want exact?
+    start_idx, end_idx = calib_stage_bounds(df, [stage], approx_time=approx_time, time_index=time_index)
+
     # datapoints for the frequency being calibrated at this stage -- TODO: confirm, this should never be np.nan...?
-    stage_cal_data = deepcopy(df.loc[start_idx:end_idx])
-    return stage_cal_data
\ No newline at end of file
+    stage_cal_data = view_of(df.loc[start_idx[0]:end_idx[0]]) # a copy only if pandas' copy-on-write is off
+    return stage_cal_data
@@ -0,0 +1,167 @@
+from collections import deque
+import numpy as np
+import pandas as pd
+from util.preprocessing import time_axis
+
+
+DRIFT_STATUS_COLUMNS = ['site_id', 'frequency', 'count', 'last_timestamp', 'baseline_mean', 'baseline_std', 'ewma', 'ewma_z',
+                        'rolling_median', 'median_z', 'cusum_high', 'cusum_low', 'alarm']
+
+
+class DriftMonitor:
+    # rolling concept-drift / degradation monitor of a per-sample KPI (kWh/BBL by default) per (site, frequency bin),
+    # against each site's calibration baseline (see calibration_baseline() in calculations.py)
+    # per (site, frequency bin) it keeps an EWMA, a rolling median over the last median_window samples, and a two-sided
+    # CUSUM of the baseline z-score, all carried over between updates, so each update costs O(new samples)
+    # an alarm is raised when a CUSUM passes cusum_h, or the EWMA stays more than ewma_limit of its standard errors off the
+    # baseline for sustain samples in a row -- a sustained deviation, not a single outlier -- and it clears once neither holds
+    # ------------------------------------------------
+    # column: the per-sample KPI to monitor, as calc_kWh_BBL / calc_perc_BEP / normalize_BEP add it
+    # ewma_alpha: EWMA smoothing factor (the weight of each new sample)
+    # median_window: (int) samples in the rolling median
+    # cusum_k: CUSUM allowance, in baseline standard deviations (drifts smaller than this don't accumulate)
+    # cusum_h: CUSUM decision threshold, in baseline standard deviations
+    # ewma_limit: how many EWMA standard errors off the baseline mean count as a deviation
+    # sustain: (int) consecutive deviating samples before the EWMA raises an alarm
+    # bin_width: frequency bin width (Hz); samples are binned to the nearest multiple, like the KPI charts' rounding
+    # NOTE: samples for a site must arrive in time order; anything at or before the site's last timestamp is ignored
+    # a (site, frequency bin) with no baseline (not calibrated or interpolated) is tracked but never alarms
+    # ================================================
+
+    def __init__(self, column='kWh/BBL', ewma_alpha=0.05, median_window=60, cusum_k=1.0, cusum_h=10.0, ewma_limit=3.0,
+                 sustain=60, bin_width=1):
+        self.column = column
+        self.ewma_alpha = ewma_alpha
+        self.median_window = median_window
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self.ewma_limit = ewma_limit
+        self.sustain = sustain
+        self.bin_width = bin_width
+        self.baselines = {} # site_id: dataframe indexed by frequency with 'mean' and 'std'
+        self.state = {} # (site_id, frequency bin): running statistics, see _new_state()
+        self.last_timestamps = {} # site_id: newest timestamp seen
+
+    def set_baseline(self, site_id, baseline):
+        # baseline: dataframe indexed by frequency with 'mean' and 'std', as calibration_baseline() gives it
+        self.baselines[site_id] = baseline
+        for (state_site_id, freq), freq_state in self.state.items():
+            if state_site_id == site_id:
+                freq_state['mean'], freq_state['std'] = self._baseline_of(site_id, freq)
+
+    def _baseline_of(self, site_id, freq):
+        baseline = self.baselines.get(site_id)
+        if baseline is None or freq not in baseline.index:
+            return np.nan, np.nan
+        return float(baseline.at[freq, 'mean']), float(baseline.at[freq, 'std'])
+
+    def _new_state(self, site_id, freq):
+        mean, std = self._baseline_of(site_id, freq)
+        return {'count': 0, 'last_timestamp': None, 'mean': mean, 'std': std, 'ewma': np.nan,
+                'window': deque(maxlen=self.median_window), 'rolling_median': np.nan,
+                'cusum_high': 0.0, 'cusum_low': 0.0, 'deviating_run': 0, 'alarm': False,
+                'on': {}} # statistic: whether its alarm condition held at the last sample
+
+    def update(self, samples):
+        # adds a batch of new samples (any number of sites)
+        # ------------------------------------------------
+        # samples: dataframe with site_id, frequency, the monitored column, and a time axis ('timestamp' or 'timestamp_datetime')
+        # output: dataframe of the alarms raised by this batch: site_id, frequency, timestamp, statistic ('cusum_high',
+            # 'cusum_low', or 'ewma'), value, baseline_mean, baseline_std
+        # ================================================
+        batch = pd.DataFrame({'site_id': samples['site_id'].to_numpy(), 'timestamp': time_axis(samples).to_numpy(dtype='datetime64[ns]'),
+                              'frequency': np.round(samples['frequency'].to_numpy(dtype=float) / self.bin_width) * self.bin_width,
+                              'value': samples[self.column].to_numpy(dtype=float)})
+        batch = batch[batch['frequency'].notna() & batch['timestamp'].notna()]
+        last = pd.to_datetime(batch['site_id'].map(self.last_timestamps)).to_numpy(dtype='datetime64[ns]')
+        batch = batch[np.isnat(last) | (batch['timestamp'].to_numpy() > last)]
+        if len(batch) == 0:
+            return pd.DataFrame(columns=['site_id', 'frequency', 'timestamp', 'statistic', 'value', 'baseline_mean', 'baseline_std'])
+        for site_id, newest in batch.groupby('site_id', sort=False)['timestamp'].max().items():
+            self.last_timestamps[site_id] = newest
+
+        alarms = []
+        for (site_id, freq), group in batch.sort_values('timestamp', kind='stable').groupby(['site_id', 'frequency'], sort=False):
+            alarms.extend(self._update_bin(site_id, freq, group))
+        return pd.DataFrame(alarms, columns=['site_id', 'frequency', 'timestamp', 'statistic', 'value', 'baseline_mean', 'baseline_std'])
+
+    def _update_bin(self, site_id, freq, group):
+        freq_state = self.state.get((site_id, freq))
+        if freq_state is None:
+            freq_state = self.state[(site_id, freq)] = self._new_state(site_id, freq)
+        group = group[group['value'].notna()]
+        if len(group) == 0:
+            return []
+        values = group['value'].to_numpy()
+        times = group['timestamp'].to_numpy()
+
+        # EWMA, continued from the previous batch's last value (adjust=False is the plain recursion)
+        seeded = np.r_[freq_state['ewma'], values] if not np.isnan(freq_state['ewma']) else values
+        ewma = pd.Series(seeded).ewm(alpha=self.ewma_alpha, adjust=False).mean().to_numpy()[len(seeded) - len(values):]
+
+        # rolling median over the last median_window samples, this batch's and the ones before it
+        history = np.array(freq_state['window'], dtype=float)
+        window_values = np.r_[history, values]
+        rolling_median = pd.Series(window_values).rolling(self.median_window, min_periods=1).median().to_numpy()[len(history):]
+
+        freq_state['count'] += len(values)
+        freq_state['last_timestamp'] = pd.Timestamp(times[-1])
+        freq_state['ewma'] = ewma[-1]
+        freq_state['window'].extend(values[-self.median_window:])
+        freq_state['rolling_median'] = rolling_median[-1]
+
+        mean, std = freq_state['mean'], freq_state['std']
+        if np.isnan(mean) or not std > 0:
+            return []
+
+        # two-sided CUSUM of the z-score: S_t = max(0, S_t-1 + x_t), in closed form as X_t - min(-S_0, min_j<=t X_j)
+        z = (values - mean) / std
+        alarms = []
+        for side, steps in [('cusum_high', z - self.cusum_k), ('cusum_low', -z - self.cusum_k)]:
+            walk = np.cumsum(steps)
+            cusum = walk - np.minimum(np.minimum.accumulate(walk), -freq_state[side])
+            freq_state[side] = cusum[-1]
+            alarms.extend(self._rising_edges(site_id, freq, side, cusum > self.cusum_h, cusum, times, mean, std))
+
+        # EWMA deviation, sustained: runs of deviating samples carried over from the previous batch
+        ewma_se = std * np.sqrt(self.ewma_alpha / (2 - self.ewma_alpha))
+        deviating = np.abs(ewma - mean) > self.ewma_limit * ewma_se
+        breaks = np.flatnonzero(~deviating)
+        run_start = np.full(len(values), -1)
+        run_start[breaks] = breaks
+        run_start = np.maximum.accumulate(run_start) # index of the last non-deviating sample at or before each sample
+        run = np.arange(len(values)) - run_start
+        run[run_start < 0] += freq_state['deviating_run'] # no break yet in this batch: the previous run continues
+        freq_state['deviating_run'] = int(run[-1])
+        alarms.extend(self._rising_edges(site_id, freq, 'ewma', run >= self.sustain, ewma, times, mean, std))
+
+        freq_state['alarm'] = bool(freq_state['cusum_high'] > self.cusum_h or freq_state['cusum_low'] > self.cusum_h or
+                                   freq_state['deviating_run'] >= self.sustain)
+        return alarms
+
+    def _rising_edges(self, site_id, freq, statistic, on, values, times, mean, std):
+        # an alarm for every sample where the condition turns on (it was off before, including at the end of the last batch)
+        was_on = self.state[(site_id, freq)]['on'].get(statistic, False)
+        edges = np.flatnonzero(on & ~np.r_[was_on, on[:-1]])
+        self.state[(site_id, freq)]['on'][statistic] = bool(on[-1])
+        return [{'site_id': site_id, 'frequency': freq, 'timestamp': pd.Timestamp(times[i]), 'statistic': statistic,
+                 'value': values[i], 'baseline_mean': mean, 'baseline_std': std} for i in edges]
+
+    def status(self, site_id=None):
+        # the current statistics of every (site, frequency bin), or of one site's
+        # ------------------------------------------------
+        # output: dataframe with DRIFT_STATUS_COLUMNS -- ewma_z and median_z are the EWMA's and rolling median's distance
+            # from the baseline mean in baseline standard deviations; alarm is whether an alarm is currently raised
+        # ================================================
+        rows = []
+        for (state_site_id, freq), freq_state in sorted(self.state.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            if site_id is not None and state_site_id != site_id:
+                continue
+            mean, std = freq_state['mean'], freq_state['std']
+            scale = std if std > 0 else np.nan
+            rows.append({'site_id': state_site_id, 'frequency': freq, 'count': freq_state['count'],
+                         'last_timestamp': freq_state['last_timestamp'], 'baseline_mean': mean, 'baseline_std': std,
+                         'ewma': freq_state['ewma'], 'ewma_z': (freq_state['ewma'] - mean) / scale,
+                         'rolling_median': freq_state['rolling_median'], 'median_z': (freq_state['rolling_median'] - mean) / scale,
+                         'cusum_high': freq_state['cusum_high'], 'cusum_low': freq_state['cusum_low'], 'alarm': freq_state['alarm']})
+        return pd.DataFrame(rows, columns=DRIFT_STATUS_COLUMNS)
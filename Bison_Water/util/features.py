@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+
+
+# The derived columns of the telemetry frame, declared once: each feature names the columns (raw or derived) it's computed
+# from and a vectorized formula over them. A FeatureFrame computes a feature on first access -- its inputs first, in
+# dependency order -- and keeps it, so nothing is derived that isn't asked for and nothing is derived twice:
+#     features = FeatureFrame(site_data)
+#     features['kWh/BBL']            # computes delta_t, delta_t_s, power_kW, energy_kWh, and volume_bbl on the way
+#     features['power_kW']           # already computed, returned as is
+#     features.computed()            # what's been derived so far
+# a column the data already has (e.g. cached_bison_data's timestamp_datetime / delta_t, or volts / amps averaged over the
+# phases at ingest by process_voltage_and_current) is used as is rather than derived again
+# PartitionedDataset.features(site_id) keeps one FeatureFrame per site / pump, so a notebook re-asking reuses the columns
+
+# name: Feature
+FEATURES = {}
+
+
+class Feature:
+    # a derived column
+    # ------------------------------------------------
+    # name: the column's name
+    # inputs: columns the formula needs, raw or derived -- the feature's own name stands for the data's own column of that
+        # name (left out of the formula's columns if the data doesn't have one)
+    # formula: function of a dictionary of input name: series (plus any context) giving the column (series or array)
+    # context: names of non-column values the formula needs (e.g. a pump curve), given to the FeatureFrame
+    # ================================================
+
+    def __init__(self, name, inputs, formula, context=()):
+        self.name = name
+        self.inputs = list(inputs)
+        self.formula = formula
+        self.context = list(context)
+
+    def __repr__(self):
+        return "Feature({!r}, inputs={})".format(self.name, self.inputs)
+
+
+def register_feature(name, inputs, context=()):
+    # decorator adding a formula to FEATURES, e.g.
+    #     @register_feature('power_kW', ['volts', 'amps'])
+    #     def power_kW(columns): ...
+    def register(formula):
+        FEATURES[name] = Feature(name, inputs, formula, context=context)
+        return formula
+    return register
+
+
+class FeatureFrame:
+    # lazily derived columns over one dataframe (a site, a pump, or any frame with the raw columns)
+    # ------------------------------------------------
+    # data: the dataframe; it isn't written to -- use materialize() for a frame with the features added
+    # context: (optional) dictionary of non-column values features need, e.g. {'pump_curve': PumpCurveModel}
+    # values: (optional) dictionary of name: series to use instead of deriving them, e.g. a delta_t computed before filtering
+    # derive: (optional) features to derive even if data has a column by that name (e.g. one left from an earlier calculation)
+    # ================================================
+
+    def __init__(self, data, context=None, values=None, derive=()):
+        self.data = data
+        self.context = dict(context or {})
+        self.derive = set(derive)
+        self._values = dict(values or {}) # name: computed series, aligned with data's index
+
+    def __contains__(self, name):
+        return name in self._values or name in self.data.columns or name in FEATURES
+
+    def __getitem__(self, name):
+        return self._resolve(name, ())
+
+    def _resolve(self, name, stack):
+        if name in self._values:
+            return self._values[name]
+        if name in self.data.columns and name not in self.derive:
+            return self.data[name]
+        feature = FEATURES.get(name)
+        if feature is None:
+            raise KeyError("{!r} is neither a column of the data nor a registered feature".format(name))
+        if name in stack:
+            raise ValueError("Features depend on each other in a cycle: {}".format(' -> '.join(stack + (name,))))
+        missing_context = [key for key in feature.context if key not in self.context]
+        if missing_context:
+            raise KeyError("Feature {!r} needs {} in the FeatureFrame's context".format(name, missing_context))
+        columns = {input_name: self.data[input_name] if input_name == name else self._resolve(input_name, stack + (name,))
+                   for input_name in feature.inputs if input_name != name or input_name in self.data.columns}
+        columns.update({key: self.context[key] for key in feature.context})
+        value = feature.formula(columns)
+        if not isinstance(value, pd.Series):
+            value = pd.Series(value, index=self.data.index, name=name)
+        self._values[name] = value
+        return value
+
+    def get(self, names):
+        # dictionary of name: series for several columns / features at once
+        return {name: self[name] for name in names}
+
+    def materialize(self, names):
+        # a copy of data with the given features added as columns (the data's own columns are shared, not copied)
+        return self.data.assign(**self.get(names))
+
+    def computed(self):
+        # names of the features derived (or given) so far
+        return list(self._values)
+
+    def dependencies(self, name):
+        # every feature name needs derived, in the order they'd be computed (ones the data has are left out)
+        order = []
+        def visit(feature_name, stack):
+            if feature_name in order or feature_name in self._values or (feature_name in self.data.columns and feature_name not in self.derive):
+                return
+            if feature_name in stack:
+                raise ValueError("Features depend on each other in a cycle: {}".format(' -> '.join(stack + (feature_name,))))
+            feature = FEATURES.get(feature_name)
+            if feature is None:
+                raise KeyError("{!r} is neither a column of the data nor a registered feature".format(feature_name))
+            for input_name in feature.inputs:
+                if input_name != feature_name: # the data's own column, not derived
+                    visit(input_name, stack + (feature_name,))
+            order.append(feature_name)
+        visit(name, ())
+        return order
+
+
+# =======================================================================================
+# the registered features
+
+@register_feature('timestamp_datetime', ['timestamp'])
+def timestamp_datetime(columns):
+    timestamp = columns['timestamp']
+    return timestamp if pd.api.types.is_datetime64_any_dtype(timestamp) else pd.to_datetime(timestamp)
+
+
+@register_feature('delta_t', ['timestamp_datetime'])
+def delta_t(columns):
+    # time since the previous row, as time_deltas() derives it
+    return columns['timestamp_datetime'].diff()
+
+
+@register_feature('delta_t_s', ['delta_t'])
+def delta_t_s(columns):
+    return columns['delta_t'].dt.total_seconds()
+
+
+def phase_average(column):
+    # a reading averaged with its phases over the same columns as process_voltage_and_current (the reading itself, if the
+    # data has it, and its three phases), so the feature matches the column that function fills in
+    def average(columns):
+        return pd.concat([columns[col] for col in [column, column + 'a', column + 'b', column + 'c'] if col in columns],
+                         axis=1).mean(axis=1, skipna=True)
+    return average
+
+
+register_feature('volts', ['volts', 'voltsa', 'voltsb', 'voltsc'])(phase_average('volts'))
+register_feature('amps', ['amps', 'ampsa', 'ampsb', 'ampsc'])(phase_average('amps'))
+
+
+@register_feature('power_kW', ['volts', 'amps'])
+def power_kW(columns):
+    # power in kilowatts (in float64, whatever the stored sensor dtype)
+    pf = 1.0 #power factor changes by motors
+    return (pf*np.sqrt(3)*columns['volts'].astype(float) * columns['amps'].astype(float)) / 1000
+
+
+@register_feature('energy_kWh', ['power_kW', 'delta_t_s'])
+def energy_kWh(columns):
+    # energy consumed during each interval in kilowatt-hours
+    return columns['power_kW'] * columns['delta_t_s'] / 3600
+
+
+@register_feature('volume_bbl', ['flow rate', 'delta_t_s'])
+def volume_bbl(columns):
+    # volume pumped during each interval in barrels (flow rate is BBL/day)
+    return columns['flow rate'].astype(float) * columns['delta_t_s'] / 86400
+
+
+@register_feature('kWh/BBL', ['energy_kWh', 'volume_bbl', 'delta_t_s'])
+def kWh_BBL(columns):
+    # energy per barrel, where there's a positive interval and volume to divide by
+    valid = columns['delta_t_s'].notna() & (columns['delta_t_s'] > 0) & (columns['volume_bbl'] > 0)
+    return (columns['energy_kWh'] / columns['volume_bbl']).where(valid)
+
+
+@register_feature('perc_from_BEP', ['frequency', 'flow rate'], context=['pump_curve'])
+def perc_from_BEP(columns):
+    # percent from BEP against the pump curve (a PumpCurveModel); NaN outside its speed lines
+    return columns['pump_curve'].score(columns['frequency'].to_numpy(dtype=float), columns['flow rate'].to_numpy(dtype=float))
@@ -0,0 +1,192 @@
+import re
+import numpy as np
+import pandas as pd
+from util.registry import load_site_registry
+
+
+# Declarative row filters: a FilterSpec is a list of conditions on the sensor columns, e.g.
+#     spec = FilterSpec(['frequency >= 30', 'frequency <= 65', 'flow rate > 5000', 'flow rate < 30000'],
+#                       site_overrides={33614: ['flow rate > 3000']})
+#     filtered = spec.apply(data)
+# a condition is '<column> <op> <value>' (op: >=, >, <=, <, ==, !=) or '<column> notna', or a (column, op, value) tuple
+# a site override replaces the default condition on the same column and side (a lower bound replaces the lower bound, ...)
+# and adds any condition the defaults don't have
+# the spec is compiled into one pass over float64 arrays; a FilterCache keeps those arrays and each condition's mask, so
+# after changing one threshold only that condition is re-evaluated -- see PartitionedDataset.filtered()
+
+CONDITION_OPS = {'>=': np.greater_equal, '>': np.greater, '<=': np.less_equal, '<': np.less, '==': np.equal, '!=': np.not_equal}
+CONDITION_PATTERN = re.compile(r'^\s*(.+?)\s*(>=|<=|==|!=|>|<)\s*(\S+)\s*$')
+
+
+def parse_condition(condition):
+    # a condition string or tuple as a (column, op, value) tuple -- value is a float, or None for 'notna'
+    if isinstance(condition, tuple):
+        column, op, value = condition
+    elif condition.strip().endswith(' notna'):
+        column, op, value = condition.strip()[:-len(' notna')].strip(), 'notna', None
+    else:
+        match = CONDITION_PATTERN.match(condition)
+        if match is None:
+            raise ValueError("Can't parse filter condition {!r}; write it as '<column> <op> <value>' or '<column> notna'".format(condition))
+        column, op, value = match.groups()
+    if op != 'notna' and op not in CONDITION_OPS:
+        raise ValueError("Unknown filter operator {!r}; use one of {} or 'notna'".format(op, list(CONDITION_OPS)))
+    return (column, op, None if op == 'notna' else float(value))
+
+
+def condition_side(condition):
+    # which bound a condition sets, so an override replaces the matching default: (column, 'low' / 'high' / op)
+    column, op, _ = condition
+    return (column, {'>=': 'low', '>': 'low', '<=': 'high', '<': 'high'}.get(op, op))
+
+
+class FilterSpec:
+    # a declarative row filter, with per-site overrides
+    # ------------------------------------------------
+    # conditions: list of condition strings or (column, op, value) tuples that every kept row must meet
+    # neighbours: (int) also drop this many rows on either side of a failing row (calc_kWh_BBL uses 1) -- rows of the same
+        # site, if data has a 'site_id' column
+    # site_overrides: (optional) dictionary of site_id: list of conditions for that site
+    # NOTE: a comparison is False on a NaN, so a row with a NaN in a compared column fails the condition
+    # ================================================
+
+    def __init__(self, conditions, neighbours=0, site_overrides=None):
+        self.conditions = [parse_condition(condition) for condition in conditions]
+        self.neighbours = neighbours
+        self.site_overrides = {site_id: [parse_condition(condition) for condition in site_conditions]
+                               for site_id, site_conditions in (site_overrides or {}).items()}
+
+    def __repr__(self):
+        return "FilterSpec({}, neighbours={}, site_overrides={})".format(self.conditions, self.neighbours, self.site_overrides)
+
+    def for_site(self, site_id):
+        # the conditions a site's rows must meet: the defaults, with the site's overrides applied
+        overrides = self.site_overrides.get(site_id, [])
+        replaced = {condition_side(condition) for condition in overrides}
+        return [condition for condition in self.conditions if condition_side(condition) not in replaced] + overrides
+
+    def with_conditions(self, *conditions, site_id=None):
+        # a copy of the spec with some conditions changed -- for every site, or as overrides of one site's
+        spec = FilterSpec([], neighbours=self.neighbours)
+        spec.site_overrides = {override_site_id: list(site_conditions) for override_site_id, site_conditions in self.site_overrides.items()}
+        changed = [parse_condition(condition) for condition in conditions]
+        replaced = {condition_side(condition) for condition in changed}
+        if site_id is None:
+            spec.conditions = [condition for condition in self.conditions if condition_side(condition) not in replaced] + changed
+        else:
+            spec.conditions = list(self.conditions)
+            site_conditions = spec.site_overrides.get(site_id, [])
+            spec.site_overrides[site_id] = [condition for condition in site_conditions if condition_side(condition) not in replaced] + changed
+        return spec
+
+    def columns(self):
+        # every column some condition reads
+        conditions = self.conditions + [condition for overrides in self.site_overrides.values() for condition in overrides]
+        return list(dict.fromkeys(column for column, _, _ in conditions))
+
+    def mask(self, data, cache=None):
+        # (np.array <bool>) which of data's rows pass -- pass a FilterCache of data to reuse its arrays and condition masks
+        cache = FilterCache(data) if cache is None else cache
+        return cache.mask(self)
+
+    def apply(self, data, cache=None):
+        # data's passing rows (data itself, shared rather than copied, if every row passes)
+        keep = self.mask(data, cache=cache)
+        return data.copy(deep=False) if keep.all() else data[keep]
+
+
+class FilterCache:
+    # a dataframe's sensor columns as float64 arrays and the masks of conditions evaluated on them, kept between filterings,
+    # so re-filtering with a changed threshold neither re-casts the columns nor re-evaluates the unchanged conditions
+    # ------------------------------------------------
+    # data: dataframe to filter; its rows must not change while the cache is in use
+    # site_bounds: (optional) dictionary of site_id: (start, end) rows, if each site's rows are contiguous (as in a
+        # PartitionedDataset); otherwise the sites are found from the 'site_id' column when a spec has overrides
+    # ================================================
+
+    def __init__(self, data, site_bounds=None):
+        self.data = data
+        self.site_bounds = site_bounds
+        self._arrays = {} # column: float64 array
+        self._masks = {} # (column, op, value): bool array over all rows
+        self._site_ids = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def array(self, column):
+        # a column as a float64 array, cast once
+        if column not in self._arrays:
+            self._arrays[column] = pd.to_numeric(self.data[column], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        return self._arrays[column]
+
+    def condition_mask(self, condition):
+        # (np.array <bool>) which rows meet one (column, op, value) condition, evaluated once
+        if condition not in self._masks:
+            column, op, value = condition
+            values = self.array(column)
+            if op == 'notna':
+                self._masks[condition] = ~np.isnan(values)
+            else:
+                with np.errstate(invalid='ignore'):
+                    self._masks[condition] = CONDITION_OPS[op](values, value)
+        return self._masks[condition]
+
+    def _fused(self, conditions, rows=slice(None)):
+        # the conditions' masks AND-ed into one buffer
+        keep = np.ones(len(range(*rows.indices(len(self.data)))) if isinstance(rows, slice) else len(rows), dtype=bool)
+        for condition in conditions:
+            np.logical_and(keep, self.condition_mask(condition)[rows], out=keep)
+        return keep
+
+    def site_rows(self):
+        # dictionary of site_id: rows (a slice if contiguous, else positions)
+        if self.site_bounds is not None:
+            return {site_id: slice(start, end) for site_id, (start, end) in self.site_bounds.items()}
+        if self._site_ids is None:
+            site_ids = self.data['site_id'].to_numpy()
+            self._site_ids = {site_id: np.flatnonzero(site_ids == site_id) for site_id in pd.unique(site_ids)}
+        return self._site_ids
+
+    def mask(self, spec):
+        # (np.array <bool>) which rows pass a FilterSpec
+        keep = self._fused(spec.conditions)
+        site_rows = self.site_rows() if spec.site_overrides else {}
+        for site_id in spec.site_overrides:
+            if site_id in site_rows:
+                keep[site_rows[site_id]] = self._fused(spec.for_site(site_id), site_rows[site_id])
+        if spec.neighbours:
+            site_ids = self.data['site_id'].to_numpy() if 'site_id' in self.data.columns else None
+            keep = drop_neighbours(keep, spec.neighbours, site_ids=site_ids)
+        return keep
+
+
+def drop_neighbours(keep, neighbours=1, site_ids=None):
+    # (np.array <bool>) keep, with the rows within neighbours of a failing row dropped too
+    # site_ids: (optional) each row's site -- a failing row then only drops the next / previous rows of its own site
+    failing = ~keep
+    keep = keep.copy()
+    for shift in range(1, neighbours + 1):
+        same_site = True if site_ids is None else site_ids[shift:] == site_ids[:-shift]
+        keep[shift:] &= ~(failing[:-shift] & same_site)
+        keep[:-shift] &= ~(failing[shift:] & same_site)
+    return keep
+
+
+# the fleet's default filters -- a site's "filters" entry in sites.json (a list of conditions) overrides them for that site
+THRESHOLD_CONDITIONS = ['frequency >= 30', 'frequency <= 65', 'flow rate < 30000', 'flow rate > 5000']
+KWH_VALIDITY_CONDITIONS = ['frequency notna', 'amps notna', 'volts notna', 'flow rate notna', 'flow rate < 40000']
+
+
+def threshold_filter_spec(site_overrides=None):
+    # threshold_filtering's spec: 30-65 Hz and 5000-30000 BBL/day, with the site registry's per-site "filters" overrides
+    # ------------------------------------------------
+    # site_overrides: (optional) dictionary of site_id: list of conditions; defaults to the site registry's
+    # ================================================
+    if site_overrides is None:
+        site_overrides = load_site_registry().filter_overrides()
+    return FilterSpec(THRESHOLD_CONDITIONS, site_overrides=site_overrides)
+
+
+# calc_kWh_BBL's validity check: every reading present and a plausible flow rate, for the sample and both its neighbours
+KWH_VALIDITY_SPEC = FilterSpec(KWH_VALIDITY_CONDITIONS, neighbours=1)
@@ -1,8 +1,13 @@
+import os
 from util.calculations import *
 import numpy as np
 import pandas as pd
+from util.profiling import profile_stage, profile_block
+from util.recommendations import kpi_table, best_frequencies
+from util.resampling import resample_uniform
 
-def compute_kpis_for_sites(site_data, site_id, sites_info=None, site_pump_curves=None, kpis=['kWh/BBL','Flow Rate']):
+@profile_stage('site KPIs', site_arg='site_id')
+def compute_kpis_for_sites(site_data, site_id, sites_info=None, site_pump_curves=None, kpis=['kWh/BBL','Flow Rate'], resample=None):
     # computes the list of KPIs for each site
     # ------------------------------------------------
     # site_data: the dataframe of information for a given site and pump
@@ -13,12 +18,16 @@ def compute_kpis_for_sites(site_data, site_id, sites_info=None, site_pump_curves
     # site_pump_curves: these are the actual pump curves, which is only required if you're normalizing pump curves; see demo usage in pumpcurve_kpis.ipynb
     # sites_info: this is needed to know the data from the calibration stages
     # NOTE: if you are computing the normalized percent from BEP (norm_perc_from_BEP) then you must also calculate percent from BEP (perc_from_BEP)
+    # resample: (optional) grid interval, e.g. '5min' -- the site is put on a uniform time grid first (resample_uniform() in
+        # resampling.py), so every site is charted from evenly spaced samples whatever its native rate; a multi-pump site
+        # needs resample_sites() instead
 
-    # output: (int) the average time in minutes between samples
+    # output: (int) the most common time in minutes between samples
     # ================================================
+    if resample is not None:
+        site_data = resample_uniform(site_data, interval=resample)
 
     site_data['frequency'] = site_data['frequency'].round() # round freqs to nearest whole
-    site_freqs = np.unique(site_data['frequency']) # find unique freqs
     if 'Flow Rate' in kpis:
         site_data['flow rate'] = site_data['flow rate'].round() # round flow rate to nearest whole
     if 'kWh/BBL' in kpis:
@@ -34,39 +43,74 @@ def compute_kpis_for_sites(site_data, site_id, sites_info=None, site_pump_curves
         print("Interpolated frequencies within calibration range (KPI normalization is approximated): {}".format(interpolated_freqs))
         print("Normalized frequencies: {}".format(normalized_freqs))
 
-    # format it into a chart, averaging values per frequnecy
-    sampling_interval = estimate_sampling_interval(site_data['timestamp_datetime'])
-    site_pump_kpis = {}
-    for site_freq in site_freqs: # for each of these freqs...
-        site_freq_data = site_data[site_data['frequency']==site_freq]
-        if len(site_freq_data) >= 60/sampling_interval: # one hour
-            flow_data = round(site_freq_data['flow rate'].mean(),3) # avg flow rate @ this freq
+    site_pump_kpis, sampling_interval = aggregate_kpis_by_freq(site_data, kpis)
+    return site_data, site_pump_kpis, sampling_interval
+
+
+def aggregate_kpis_by_freq(site_data, kpis=['kWh/BBL','Flow Rate']):
+    # averages each KPI per (rounded) frequency, keeping the frequencies held for at least an hour
+    # ------------------------------------------------
+    # site_data: dataframe with 'frequency' and the KPIs' columns (see compute_kpis_for_sites)
+    # output: dictionary of frequency: {KPI: average}, (int) the estimated sampling interval in minutes
+    # ================================================
+    # format it into a chart, averaging values per frequnecy -- one grouped pass instead of re-filtering the frame per frequency
+    with profile_block('aggregation', rows_in=len(site_data)) as stage:
+        sampling_interval = estimate_sampling_interval(time_axis(site_data))
+        kpi_columns = {'Flow Rate': 'flow rate', 'kWh/BBL': 'kWh/BBL', 'perc_from_BEP': 'perc_from_BEP', 'norm_perc_from_BEP': 'norm_perc_from_BEP'}
+        kpi_columns = {kpi: col for kpi, col in kpi_columns.items() if kpi in kpis}
+        grouped = site_data.groupby('frequency')[list(dict.fromkeys(kpi_columns.values()))]
+        freq_counts = grouped.size()
+        freq_means = grouped.mean().round(3)
+        freq_means = freq_means[freq_counts >= 60/sampling_interval] # one hour
+
+        site_pump_kpis = {}
+        for site_freq, freq_row in freq_means.iterrows(): # for each of these freqs...
             freq_kpis = {} # Bison KPIs
             if 'Flow Rate' in kpis:
-                freq_kpis['Flow Rate'] = flow_data
+                freq_kpis['Flow Rate'] = freq_row['flow rate'] # avg flow rate @ this freq
             if 'kWh/BBL' in kpis:
-                freq_kpis['kWh/BBL'] = round(site_freq_data['kWh/BBL'].mean(),3) # Calculate avg KWh/BBL @ this freq per site
+                freq_kpis['kWh/BBL'] = freq_row['kWh/BBL'] # avg KWh/BBL @ this freq per site
             if 'perc_from_BEP' in kpis:
-                freq_kpis['perc_from_BEP'] = round(site_freq_data['perc_from_BEP'].mean(),3)# Calculate % BEP @ this freq
+                freq_kpis['perc_from_BEP'] = freq_row['perc_from_BEP'] # % BEP @ this freq
                 freq_kpis['abs_perc_from_BEP'] = abs(freq_kpis['perc_from_BEP'])
             if 'norm_perc_from_BEP' in kpis:
-                freq_kpis['norm_perc_from_BEP'] = round(site_freq_data['norm_perc_from_BEP'].mean(),3)
+                freq_kpis['norm_perc_from_BEP'] = freq_row['norm_perc_from_BEP']
                 freq_kpis['abs_norm_perc_from_BEP'] = abs(freq_kpis['norm_perc_from_BEP'])
             site_pump_kpis[site_freq] = freq_kpis
-    return site_data, site_pump_kpis, sampling_interval
+        stage.rows_out = len(site_pump_kpis) # one row per charted frequency
+    return site_pump_kpis, sampling_interval
 
 
-def kpi_charts(kpis_all_sites, site_ids, sites_info, kpis=['kWh/BBL','Flow Rate'],print_chart=False):
+@profile_stage('station KPIs', site_arg='station')
+def compute_kpis_for_station(station_data, station, kpis=['kWh/BBL','Flow Rate']):
+    # the KPI chart of a multi-pump station, averaged per station frequency like compute_kpis_for_sites does per site
+    # ------------------------------------------------
+    # station_data: dataframe from calc_station_kWh_BBL() in stations.py (frequency is the mean of the running pumps')
+    # station: the station's name, e.g. '1509 SWD'
+    # kpis: 'kWh/BBL' and/or 'Flow Rate' (station flow is the pumps' total)
+    # output: station_data with rounded frequency / flow rate, dictionary of frequency: {KPI: average}, sampling interval (min.)
+    # ================================================
+    station_data = station_data.copy(deep=False)
+    station_data['frequency'] = station_data['frequency'].round()
+    if 'Flow Rate' in kpis:
+        station_data['flow rate'] = station_data['flow rate'].round()
+    station_kpis, sampling_interval = aggregate_kpis_by_freq(station_data, kpis)
+    return station_data, station_kpis, sampling_interval
+
+
+def kpi_charts(kpis_all_sites, site_ids, sites_info, kpis=['kWh/BBL','Flow Rate'],print_chart=False, save_csv=True,
+               output_dir='bison_kpi_charts'):
     # generates the Optimize-For-KPI Charts for each of the given sites
     # ------------------------------------------------
     # kpis_all_sites: a dictionary of dictionaries, see average_kpis_by_freq.ipynb
     # site_ids: list of (int) site_ids
+    # save_csv: save each site's KPI chart to <output_dir>/<site_id>_kpis_unnormalized.csv
     # output: df_all is a dataframe with all the sites' KPI information averaged on a per-frequency basis
-            # game_kpi reports the best frequency to use, if you were to gamify/optimize for that particular KPI
-    # NOTE: a single sites' KPI chart is saved to a CSV
+            # game_kpi reports, per site, the best frequency to use if you were to gamify/optimize for that particular KPI
+            # (dictionary of site_id: {KPI: frequency}; see recommend_frequencies() in recommendations.py to trade KPIs off)
     # ================================================
 
-    df_all = pd.DataFrame(columns=['site_id','kWh/BBL','Flow Rate'])
+    site_charts = []
     for site_id in site_ids:
         site_name = sites_info[site_id]['site_name']
         print(site_name)
@@ -75,16 +119,12 @@ def kpi_charts(kpis_all_sites, site_ids, sites_info, kpis=['kWh/BBL','Flow Rate'
         df_site = pd.DataFrame(site_kpis).transpose()
         df_site['site_id'] = site_name
         if print_chart:
+            from IPython.display import display # only in a notebook, so headless jobs don't import IPython
             display(df_site)
+        site_charts.append(df_site)
 
-        df_all = pd.concat([df_all,df_site])
-
-        game_kpi = {'Flow Rate': int(df_site[df_site['Flow Rate']==max(df_site['Flow Rate'])].index[0]),
-                    'kWh/BBL': int(df_site[df_site['kWh/BBL']==min(df_site['kWh/BBL'])].index[0])}
-        if 'perc_from_BEP' in kpis:
-            game_kpi['perc_from_BEP'] = int(df_site[df_site['abs_perc_from_BEP']==min(df_site['abs_perc_from_BEP'])].index[0])
-        if 'norm_perc_from_BEP' in kpis:
-            game_kpi['norm_perc_from_BEP'] = int(df_site[df_site['abs_norm_perc_from_BEP']==min(df_site['abs_norm_perc_from_BEP'])].index[0])
-
-        df_site.to_csv("bison_kpi_charts/{}_kpis_unnormalized.csv".format(site_id))
+        if save_csv:
+            df_site.to_csv(os.path.join(output_dir, "{}_kpis_unnormalized.csv".format(site_id)))
+    df_all = pd.concat([pd.DataFrame(columns=['site_id','kWh/BBL','Flow Rate'])] + site_charts)
+    game_kpi = best_frequencies(kpi_table(kpis_all_sites, site_ids=site_ids), kpis=kpis)
     return df_all, game_kpi
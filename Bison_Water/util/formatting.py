@@ -1,7 +1,7 @@
 from copy import deepcopy
 import pandas as pd
 import numpy as np
-from util.preprocessing import find_closest_time
+from util.preprocessing import find_closest_time, build_site_time_indexes, time_axis
 
 
 def format_sitegts(site_start,site_freqs,duration_len):
@@ -15,6 +15,7 @@ def format_sitegts(site_start,site_freqs,duration_len):
             # frequencies are listed in the order they are calibrated (e.g. if calib. is done in ascending order, freqs. are listed ascending, too)
     # duration_len: (int) duration (the number of indices/timestamps) the calibration is occuring
         # assumption: the dataframe with site info is recorded in order; i.e. all the rows are in chronological order
+        # on a uniform grid (resample_sites() in resampling.py) this is samples_in('2h', interval) for every site alike
 
     # output: a dictionary where key:value is frequency: [start_idx, end_idx] for that frequency during calibration
     # ================================================
@@ -46,8 +47,8 @@ def ryan_format(data, ryan_sites_info, audrey_sitegts):
             tmp = {}
             tmp['frequency'] = freq
             start_and_end = curr_site_gts[freq]
-            start_timestamp = data.iloc[start_and_end[0]]['timestamp']
-            end_timestamp = data.iloc[start_and_end[1]]['timestamp']
+            start_timestamp = str(data.iloc[start_and_end[0]]['timestamp']) # a columnar cache holds Timestamps, not strings
+            end_timestamp = str(data.iloc[start_and_end[1]]['timestamp'])
             tmp['start_time'] = start_timestamp
             tmp['end_time'] = end_timestamp
             format_calib_stage.append(tmp)
@@ -64,6 +65,7 @@ def ryan_site_info_to_audrey_format(data, ryan_cached_gt,sampling_rates):
     # output: audrey-format dictionaries about site info
     # ================================================
     audrey_format = {}
+    time_indexes = build_site_time_indexes(data)
     for site in ryan_cached_gt:
         site_id = site['site_id']
         frequencies = []
@@ -72,7 +74,108 @@ def ryan_site_info_to_audrey_format(data, ryan_cached_gt,sampling_rates):
             listed_start = stage['start_time'].split(" ")
             startdate = listed_start[0]
             starttime = listed_start[1]
-            _, index = find_closest_time(data[data['site_id']==site_id], startdate, query_time=starttime)
+            _, index = find_closest_time(None, startdate, query_time=starttime, time_index=time_indexes[site_id])
         site_estimatedgt = format_sitegts(index,frequencies,sampling_rates[site_id])
         audrey_format[site_id] = site_estimatedgt
-    return audrey_format
\ No newline at end of file
+    return audrey_format
+
+# =======================================================================================
+# calibration-stage detection: finds calibration sweeps in the frequency series instead of assuming two hours per frequency
+
+def find_calibration_sweeps(data, min_minutes=60, max_minutes=180, max_step=4, max_gap_minutes=15, min_stages=4, smoothing=5,
+                            pump_id=None):
+    # finds every calibration sweep in a site's frequency series, in one vectorized pass: the series is split into
+    # plateaus (runs of the same whole frequency), and a sweep is a chain of back-to-back plateaus that each hold for
+    # min_minutes to max_minutes and step the frequency the same way (up or down) by 1 to max_step Hz each time
+    # ------------------------------------------------
+    # data: dataframe of the site you're looking at (needs 'frequency' and 'timestamp' or 'timestamp_datetime')
+    # min_minutes, max_minutes: how long a calibration stage holds its frequency
+    # max_step: (int) the largest frequency step (Hz) between two stages of a sweep
+    # max_gap_minutes: a gap in the samples longer than this is a dropout: it doesn't count towards a plateau's hold time,
+        # and a longer gap between two plateaus doesn't make them neighbouring stages
+    # min_stages: (int) the fewest stages that make a sweep (fewer is too easily an ordinary change of set point)
+    # smoothing: (int) samples in the centered rolling median taken before rounding, so sensor noise doesn't split plateaus
+    # pump_id: (optional) (int) only look at this pump's rows -- a multi-pump site's pumps are calibrated separately
+    # output: list of sweeps, in time order; each is a list of calibration stages in the Ryan sites_info format
+    # ================================================
+    if pump_id is not None and 'pump_id' in data.columns:
+        data = data[data['pump_id'] == pump_id]
+    times = time_axis(data).to_numpy(dtype='datetime64[ns]')
+    frequency = data['frequency'].to_numpy(dtype=float)
+    keep = ~np.isnat(times) & ~np.isnan(frequency)
+    times, frequency = times[keep], frequency[keep]
+    if not np.all(times[1:] >= times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times, frequency = times[order], frequency[order]
+    if len(times) == 0:
+        return []
+    smoothed = pd.Series(frequency).rolling(smoothing, center=True, min_periods=1).median().to_numpy()
+    whole = np.rint(smoothed).astype(int)
+
+    # plateaus: runs of the same whole frequency; a dropout in the samples doesn't end one, but doesn't count towards its hold time
+    starts = np.flatnonzero(np.r_[True, whole[1:] != whole[:-1]])
+    ends = np.r_[starts[1:], len(whole)] - 1
+    plateau_freqs = whole[starts]
+    step_minutes = np.diff(times) / np.timedelta64(1, 'm')
+    sampled_minutes = np.r_[0, np.where(step_minutes > max_gap_minutes, 0, step_minutes)]
+    minutes = np.add.reduceat(sampled_minutes, starts) - sampled_minutes[starts] # from each plateau's first sample to its last
+    holds = (minutes >= min_minutes) & (minutes <= max_minutes)
+
+    # links between consecutive plateaus that can be neighbouring stages of a sweep
+    step = np.diff(plateau_freqs)
+    between = (times[starts[1:]] - times[ends[:-1]]) <= np.timedelta64(int(max_gap_minutes * 60), 's')
+    link = holds[:-1] & holds[1:] & between & (np.abs(step) >= 1) & (np.abs(step) <= max_step)
+    link[1:] &= ~(link[:-1] & (np.sign(step[1:]) != np.sign(step[:-1]))) # a sweep doesn't turn around
+
+    # sweeps: chains of linked plateaus
+    chain = np.cumsum(np.r_[True, ~link]) - 1
+    chain_length = np.bincount(chain)
+    sweeps = []
+    for chain_id in np.flatnonzero(chain_length >= min_stages):
+        plateaus = np.flatnonzero(chain == chain_id)
+        sweeps.append([{'frequency': int(plateau_freqs[p]),
+                        'start_time': pd.Timestamp(times[starts[p]]).strftime('%Y-%m-%d %H:%M:%S'),
+                        'end_time': pd.Timestamp(times[ends[p]]).strftime('%Y-%m-%d %H:%M:%S')} for p in plateaus])
+    return sweeps
+
+
+def detect_calibration_stages(data, sweep='longest', **kwargs):
+    # a site's calibration stages, detected from its frequency series (see find_calibration_sweeps())
+    # ------------------------------------------------
+    # data: dataframe of the site you're looking at
+    # sweep: which sweep to use if there are several -- 'longest' (most stages; the earliest on a tie), 'first', or 'last'
+    # kwargs: passed on to find_calibration_sweeps()
+    # output: list of calibration stages in the Ryan sites_info format (empty if no sweep was found)
+    # ================================================
+    sweeps = find_calibration_sweeps(data, **kwargs)
+    if not sweeps:
+        return []
+    if sweep == 'first':
+        return sweeps[0]
+    if sweep == 'last':
+        return sweeps[-1]
+    return max(sweeps, key=len)
+
+
+def detect_sites_calibration_stages(data, sites_info, overwrite=False, sweep='longest', **kwargs):
+    # fills in sites_info's calibration stages from each site's frequency series (grouping the dataframe only once)
+    # ------------------------------------------------
+    # data: dataframe of all site info
+    # sites_info: dictionary of site_id: site info, as cached_site_info(dict=True) gives it
+    # overwrite: also replace calibration stages that were entered by hand (by default only empty ones are filled in)
+    # sweep, kwargs: passed on to detect_calibration_stages()
+    # NOTE: a multi-pump site's pumps are searched separately (their interleaved frequencies hide each other's plateaus), and
+        # the site gets the pump with the most stages (the lowest pump_id on a tie) -- pass pump_id to pick one instead
+    # output: a copy of sites_info with the detected calibration stages
+    # ================================================
+    detected_info = deepcopy(sites_info)
+    for site_id, site_data in data.groupby('site_id', sort=False, observed=True):
+        if site_id not in detected_info or (detected_info[site_id]['calibration_stages'] and not overwrite):
+            continue
+        if 'pump_id' in kwargs or 'pump_id' not in site_data.columns:
+            detected_info[site_id]['calibration_stages'] = detect_calibration_stages(site_data, sweep=sweep, **kwargs)
+            continue
+        pump_stages = [detect_calibration_stages(site_data, sweep=sweep, pump_id=pump_id, **kwargs)
+                       for pump_id in sorted(site_data['pump_id'].dropna().unique())]
+        detected_info[site_id]['calibration_stages'] = max(pump_stages, key=len) if pump_stages else []
+    return detected_info
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from util.preprocessing import TimestampIndex, time_axis, view_of
+from util.dataloader import calib_stage_bounds
+from util.filters import FilterCache, threshold_filter_spec
+from util.features import FeatureFrame
+
+
+class PartitionedDataset:
+    # the fleet's telemetry sorted once into contiguous per-(site, pump) blocks, each in time order, handing out views
+    # instead of copies: a site, a pump, a time range, or a calibration window is a row slice of the one sorted frame
+    # with pandas' copy-on-write on (always on pandas 3; opt in on pandas 2.x with preprocessing.enable_copy_on_write()), a view
+    # is only copied -- column by column -- when the caller writes to it, so e.g. compute_kpis_for_sites(dataset.site(site_id), ...)
+    # leaves the dataset untouched; without it, site() / pump() / ... hand out copies, as the notebooks' deepcopy did
+    # replaces the notebooks' deepcopy(data[data['site_id']==site_id]), which scanned and copied the whole frame per site
+    # ------------------------------------------------
+    # data: dataframe of all site info (as loaded by cached_bison_data); it's used as-is if already sorted, else copied once
+    # NOTE: a multi-pump site's view is its pump blocks back to back, not interleaved by time -- use pump() for time order
+    # ================================================
+
+    def __init__(self, data):
+        site_ids = data['site_id'].to_numpy(dtype='int64')
+        pump_ids = data['pump_id'].to_numpy(dtype='int64') if 'pump_id' in data.columns else np.ones(len(data), dtype='int64')
+        times = time_axis(data).to_numpy(dtype='datetime64[ns]')
+
+        keys_sorted = (np.all(site_ids[1:] >= site_ids[:-1]) and
+                       np.all((site_ids[1:] > site_ids[:-1]) | (pump_ids[1:] > pump_ids[:-1]) |
+                              ((pump_ids[1:] == pump_ids[:-1]) & (times[1:] >= times[:-1]))))
+        if not keys_sorted:
+            order = np.lexsort((times, pump_ids, site_ids)) # stable: equal timestamps keep their row order
+            data, site_ids, pump_ids, times = data.iloc[order], site_ids[order], pump_ids[order], times[order]
+        self.data = data
+        self.times = times
+
+        # block boundaries: where the (site, pump) key changes
+        starts = np.flatnonzero(np.r_[True, (site_ids[1:] != site_ids[:-1]) | (pump_ids[1:] != pump_ids[:-1])]) if len(data) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(data)]
+        self._set_blocks({(int(site_ids[start]), int(pump_ids[start])): (int(start), int(end)) for start, end in zip(starts, ends)})
+
+    def _set_blocks(self, blocks):
+        self.blocks = blocks
+        self.site_blocks = {}
+        for (site_id, _), (start, end) in self.blocks.items():
+            site_start, _ = self.site_blocks.get(site_id, (start, end))
+            self.site_blocks[site_id] = (site_start, end)
+        self._time_indexes = {}
+        self._filter_cache = None
+        self._feature_frames = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        # (site_id, site view) for every site
+        for site_id in self.site_blocks:
+            yield site_id, self.site(site_id)
+
+    @property
+    def site_ids(self):
+        return list(self.site_blocks)
+
+    def pump_ids(self, site_id):
+        return [pump_id for block_site_id, pump_id in self.blocks if block_site_id == site_id]
+
+    def _slice(self, start, end):
+        return view_of(self.data.iloc[start:end])
+
+    def _block(self, site_id, pump_id=None):
+        # (start, end) rows of a site, or of one of its pumps
+        bounds = self.site_blocks.get(site_id) if pump_id is None else self.blocks.get((site_id, pump_id))
+        if bounds is None:
+            raise KeyError("No data for site {}{}".format(site_id, "" if pump_id is None else ", pump {}".format(pump_id)))
+        return bounds
+
+    def site(self, site_id):
+        # view of every row of a site
+        return self._slice(*self._block(site_id))
+
+    def pump(self, site_id, pump_id):
+        # view of one pump's rows, in time order
+        return self._slice(*self._block(site_id, pump_id))
+
+    def time_range(self, site_id, start_time, end_time, pump_id=None):
+        # rows of a site (or one of its pumps) with start_time <= timestamp <= end_time
+        # a view if the rows are one block (a pump, or a single-pump site); a multi-pump site's pump ranges are concatenated
+        # ------------------------------------------------
+        # site_id: (int); start_time, end_time: str or datetime; pump_id: (optional) (int)
+        # ================================================
+        pump_ids = self.pump_ids(site_id) if pump_id is None else [pump_id]
+        ranges = []
+        for block_pump_id in pump_ids:
+            start, end = self._block(site_id, block_pump_id)
+            block_times = self.times[start:end]
+            lo = start + np.searchsorted(block_times, np.datetime64(pd.Timestamp(start_time), 'ns'), side='left')
+            hi = start + np.searchsorted(block_times, np.datetime64(pd.Timestamp(end_time), 'ns'), side='right')
+            ranges.append(self._slice(lo, hi))
+        if len(ranges) == 1:
+            return ranges[0]
+        return pd.concat(ranges)
+
+    def time_index(self, site_id, pump_id=None):
+        # the (cached) TimestampIndex of a site or pump view, for find_closest_time / select_calib_data
+        key = (site_id, pump_id)
+        if key not in self._time_indexes:
+            self._time_indexes[key] = TimestampIndex(self.site(site_id) if pump_id is None else self.pump(site_id, pump_id))
+        return self._time_indexes[key]
+
+    def features(self, site_id, pump_id=None, context=None):
+        # the (cached) FeatureFrame of a site or pump view: its derived columns are computed on first access and kept for
+        # the dataset's lifetime, so e.g. dataset.features(site_id)['power_kW'] only derives power once (see features.py)
+        # ------------------------------------------------
+        # site_id: (int); pump_id: (optional) (int)
+        # context: (optional) dictionary of values features need, e.g. {'pump_curve': PumpCurveModel}; added to the frame's
+        # ================================================
+        key = (site_id, pump_id)
+        if key not in self._feature_frames:
+            self._feature_frames[key] = FeatureFrame(self.site(site_id) if pump_id is None else self.pump(site_id, pump_id))
+        if context:
+            self._feature_frames[key].context.update(context)
+        return self._feature_frames[key]
+
+    def filter_cache(self):
+        # the (cached) FilterCache of the dataset: its sensor columns cast once, and every condition mask evaluated so far
+        if self._filter_cache is None:
+            self._filter_cache = FilterCache(self.data, site_bounds=self.site_blocks)
+        return self._filter_cache
+
+    def filtered(self, spec=None):
+        # a new PartitionedDataset of the rows passing a FilterSpec (see filters.py) -- e.g. threshold_filtering's thresholds
+        # with one changed, dataset.filtered(threshold_filter_spec().with_conditions('flow rate > 3000')), re-evaluates only
+        # that condition, over the already-cast columns
+        # ------------------------------------------------
+        # spec: (optional) FilterSpec; defaults to threshold_filter_spec()
+        # ================================================
+        spec = threshold_filter_spec() if spec is None else spec
+        keep = self.filter_cache().mask(spec)
+        # the kept rows are still sorted: each block's new bounds are the kept rows before its old ones
+        kept_before = np.r_[0, np.cumsum(keep)]
+        filtered = PartitionedDataset.__new__(PartitionedDataset)
+        filtered.data = self.data if keep.all() else self.data[keep]
+        filtered.times = self.times[keep]
+        filtered._set_blocks({key: (int(kept_before[start]), int(kept_before[end])) for key, (start, end) in self.blocks.items()
+                              if kept_before[end] > kept_before[start]})
+        return filtered
+
+    def calibration_window(self, site_id, stage, approx_time=True, pump_id=None):
+        # view of a calibration stage's rows, selected as select_calib_data does (exact start/end, else the closest same-day time)
+        # ------------------------------------------------
+        # site_id: (int)
+        # stage: one calibration stage in the Ryan sites_info format (see cached_site_info())
+        # approx_time: if the exact start/end time isn't in the data, use the closest time to it
+        # pump_id: (optional) (int) select from one pump's rows instead of the whole site's
+        # ================================================
+        view = self.site(site_id) if pump_id is None else self.pump(site_id, pump_id)
+        start_labels, end_labels = calib_stage_bounds(view, [stage], approx_time=approx_time, time_index=self.time_index(site_id, pump_id))
+        lo = view.index.get_loc(start_labels[0])
+        hi = view.index.get_loc(end_labels[0])
+        block_start, _ = self._block(site_id, pump_id)
+        return self._slice(block_start + lo, block_start + max(lo, hi + 1))
+
+    def calibration_data(self, site_id, calibration_stages, approx_time=True, pump_id=None):
+        # every calibration stage's rows of a site, stacked (one copy, of just the calibration rows)
+        if len(calibration_stages) == 0:
+            return self._slice(0, 0)
+        return pd.concat([self.calibration_window(site_id, stage, approx_time=approx_time, pump_id=pump_id) for stage in calibration_stages])
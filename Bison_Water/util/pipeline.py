@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from util.format_calculations import compute_kpis_for_sites
+from util.pumpcurve import PumpCurveModel
+
+
+def is_shareable(dtype):
+    # plain numeric / bool / datetime64 / timedelta64 columns can live in shared memory; everything else is pickled
+    return isinstance(dtype, np.dtype) and dtype.kind in 'biufmM'
+
+
+def share_array(array):
+    # copies an array into a new shared memory block; output: the block and the spec a worker needs to reattach to it
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    return block, (block.name, array.dtype.str, array.shape)
+
+
+def site_frame_from_shared(shared_specs, start, end, other_columns, columns, index):
+    # rebuilds one site's dataframe from rows [start, end) of the shared column arrays (copied out, so the caller may mutate it)
+    site_columns = {}
+    attached = []
+    for col, (block_name, dtype, shape) in shared_specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        attached.append(block)
+        site_columns[col] = np.array(np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)[start:end], copy=True)
+    for block in attached:
+        block.close()
+    for col in other_columns.columns:
+        site_columns[col] = other_columns[col].to_numpy()
+    return pd.DataFrame({col: site_columns[col] for col in columns}, index=index)
+
+
+def site_kpi_worker(task):
+    # runs compute_kpis_for_sites for one site inside a worker process
+    site_id, shared_specs, start, end, other_columns, columns, index, kpi_kwargs, return_site_data = task
+    site_data = site_frame_from_shared(shared_specs, start, end, other_columns, columns, index)
+    site_data, site_pump_kpis, sampling_interval = compute_kpis_for_sites(site_data, site_id, **kpi_kwargs)
+    return site_id, site_pump_kpis, sampling_interval, site_data if return_site_data else None
+
+
+def compute_kpis_all_sites(data, site_ids, kpis=['kWh/BBL','Flow Rate'], site_pump_curves=None, sites_info=None,
+                           n_workers=None, columns=None, return_site_data=False):
+    # multi-core version of the notebooks' per-site loop: groups the data by site once, then computes each site's KPIs
+    # in a process pool, with the numeric columns handed to the workers through shared memory instead of pickled copies
+    # ------------------------------------------------
+    # data: dataframe of all site info (as loaded by cached_bison_data and filtered by threshold_filtering)
+    # site_ids: list of (int) site_ids
+    # kpis, site_pump_curves, sites_info: as in compute_kpis_for_sites; site_pump_curves is a dictionary of site_id: pump curve
+    # n_workers: (optional) number of worker processes; defaults to one per core (capped at the number of sites)
+    # columns: (optional) only send these columns to the workers, e.g. leave out string timestamps the KPIs don't use
+    # return_site_data: also return each site's per-row KPI dataframe (these are pickled back from the workers)
+    # output: kpis_all_sites (the dictionary kpi_charts consumes), dictionary of site_id: sampling interval,
+        # and a dictionary of site_id: site dataframe (None unless return_site_data)
+    # ================================================
+    if columns is not None:
+        data = data[[col for col in data.columns if col in columns or col == 'site_id']]
+    data = data[data['site_id'].isin(site_ids)]
+
+    # group by site once: a stable sort makes each site one contiguous block of rows
+    site_order = np.argsort(data['site_id'].to_numpy(), kind='stable')
+    data_sorted = data.iloc[site_order]
+    sorted_site_ids = data_sorted['site_id'].to_numpy()
+    block_starts = np.flatnonzero(np.r_[True, sorted_site_ids[1:] != sorted_site_ids[:-1]]) if len(data_sorted) else np.array([], dtype=int)
+    block_ends = np.r_[block_starts[1:], len(data_sorted)]
+
+    # pump curves are compiled once here rather than once per worker
+    pump_curve_models = {}
+    for site_id in site_ids:
+        pump_curve = None if site_pump_curves is None else site_pump_curves.get(site_id)
+        if pump_curve is not None and not isinstance(pump_curve, PumpCurveModel):
+            pump_curve = PumpCurveModel.from_curve_data(pump_curve)
+        pump_curve_models[site_id] = pump_curve
+
+    shared_columns = [col for col in data_sorted.columns if is_shareable(data_sorted[col].dtype)]
+    other_columns = [col for col in data_sorted.columns if col not in shared_columns]
+    blocks = []
+    shared_specs = {}
+    kpis_all_sites = {site_id: None for site_id in site_ids}
+    sampling_intervals = {}
+    site_datas = {} if return_site_data else None
+    try:
+        for col in shared_columns:
+            block, shared_specs[col] = share_array(data_sorted[col].to_numpy())
+            blocks.append(block)
+
+        tasks = []
+        for start, end in zip(block_starts, block_ends):
+            site_id = sorted_site_ids[start]
+            kpi_kwargs = dict(kpis=kpis, site_pump_curves=pump_curve_models.get(site_id), sites_info=sites_info)
+            tasks.append((site_id, shared_specs, start, end, data_sorted[other_columns].iloc[start:end], list(data_sorted.columns),
+                          data_sorted.index[start:end], kpi_kwargs, return_site_data))
+        tasks.sort(key=lambda task: task[3] - task[2], reverse=True) # biggest sites first so one doesn't straggle at the end
+
+        n_workers = min(n_workers or os.cpu_count() or 1, max(len(tasks), 1))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for site_id, site_pump_kpis, sampling_interval, site_data in executor.map(site_kpi_worker, tasks):
+                kpis_all_sites[site_id] = site_pump_kpis
+                sampling_intervals[site_id] = sampling_interval
+                if return_site_data:
+                    site_datas[site_id] = site_data
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return kpis_all_sites, sampling_intervals, site_datas
@@ -1,5 +1,4 @@
 import matplotlib.pyplot as plt
-from copy import deepcopy
 import numpy as np
 import plotly.express as px
 
@@ -53,8 +52,7 @@ def plot_ts_gt(sitegts, freq_data_, site_id, site_bounds): # call this on a per
     # ================================================
     
     # this is as many different colors you can assign to frequencies in calibration; add more as needed
-    freq_data = deepcopy(freq_data_)
-    freq_data.replace(0, np.nan, inplace=True)
+    freq_data = freq_data_.replace(0, np.nan) # returns a new series; the caller's column is left as is
     colors = ['c','m','y','r','g','b','lime','violet']
     site_gt = sitegts[site_id]
     fig = plt.figure(figsize=(30,4))
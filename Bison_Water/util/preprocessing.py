@@ -1,33 +1,144 @@
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from util.profiling import profile_stage
+from util.filters import threshold_filter_spec
 
 
-def find_closest_time(data, query_date, query_time='00:00:00'):
+PANDAS_MAJOR = int(pd.__version__.split('.')[0])
+
+
+def copy_on_write_enabled():
+    # under pandas' copy-on-write mode (always on from pandas 3) a slice is a lazy view: it's only copied if someone writes to it
+    return PANDAS_MAJOR >= 3 or getattr(pd.options.mode, 'copy_on_write', False) is True
+
+
+def enable_copy_on_write():
+    # turns copy-on-write on for pandas 2.x (a no-op on pandas 3, where it can't be turned off), so PartitionedDataset and the
+    # KPI functions hand out views instead of copies -- nothing calls this for you; call it once at the top of a notebook
+    # NOTE: this is session-wide -- chained assignment like df['col'][mask] = x stops writing through to df
+    if PANDAS_MAJOR == 2:
+        pd.options.mode.copy_on_write = True
+
+
+def view_of(frame):
+    # frame itself if copy-on-write makes it safe to hand out as a view, otherwise a copy (what the callers used to deepcopy)
+    return frame if copy_on_write_enabled() else frame.copy()
+
+
+def time_axis(data):
+    # the datetime64 time axis of a dataframe: 'timestamp_datetime' if cached_bison_data added it, otherwise 'timestamp'
+    # (parsed, unless it's already datetime64 as in a compact or columnar cache)
+    if 'timestamp_datetime' in data.columns:
+        return data['timestamp_datetime']
+    if pd.api.types.is_datetime64_any_dtype(data['timestamp']):
+        return data['timestamp']
+    return pd.to_datetime(data['timestamp'])
+
+
+def time_deltas(data):
+    # time since the previous row: the 'delta_t' column if cached_bison_data added it, otherwise computed from the time axis
+    # NOTE: computed here, the deltas are between the rows of data as passed in (e.g. after filtering), not the rows as loaded
+    if 'delta_t' in data.columns:
+        return data['delta_t']
+    return time_axis(data).diff()
+
+
+class TimestampIndex:
+    # sorted datetime64 index over a dataframe's rows, answering nearest-timestamp and range queries by binary search
+    # build it once per site and pass it to find_closest_time / select_calib_data to skip re-scanning the dataframe
+    # ------------------------------------------------
+    # data: dataframe of the site you're looking at (needs 'timestamp' or 'timestamp_datetime')
+    # ================================================
+
+    def __init__(self, data):
+        times = time_axis(data).to_numpy(dtype='datetime64[ns]')
+        positions = np.flatnonzero(~np.isnat(times))
+        order = positions[np.argsort(times[positions], kind='stable')] # stable, so equal timestamps keep their row order
+        self.times = times[order]
+        self.positions = order # row positions (for iloc) in time order
+        self.labels = data.index.to_numpy()[order] # dataframe index labels (for loc) in time order
+
+    def __len__(self):
+        return len(self.times)
+
+    def _nearest(self, query, lo, hi):
+        # sorted position of the row closest to query among sorted positions [lo, hi); ties go to the earlier row
+        p = min(max(np.searchsorted(self.times, query, side='left'), lo), hi)
+        candidates = [c for c in (p - 1, p) if lo <= c < hi]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda c: abs(self.times[c] - query)) # min keeps the first on a tie
+        return np.searchsorted(self.times, self.times[best], side='left') # first row with that timestamp
+
+    def closest_time(self, query_date, query_time='00:00:00'):
+        # same contract as find_closest_time: only rows on query_date are considered
+        query_datetime = np.datetime64(datetime.strptime(query_date+" "+query_time, "%Y-%m-%d %H:%M:%S"), 'ns')
+        day_start = np.datetime64(query_date, 'D').astype('datetime64[ns]')
+        lo = np.searchsorted(self.times, day_start, side='left')
+        hi = np.searchsorted(self.times, day_start + np.timedelta64(1, 'D'), side='left')
+        best = self._nearest(query_datetime, lo, hi)
+        if best is None:
+            raise IndexError("No timestamps found on {}".format(query_date))
+        return pd.Timestamp(self.times[best]).to_pydatetime(), self.labels[best]
+
+    def find(self, query):
+        # index label of the first row exactly at query (str or datetime), or None
+        query = np.datetime64(pd.Timestamp(query), 'ns')
+        p = np.searchsorted(self.times, query, side='left')
+        if p < len(self.times) and self.times[p] == query:
+            return self.labels[p]
+        return None
+
+    def find_many(self, queries):
+        # vectorized find(): index labels of the first row exactly at each query, and a mask of which queries were found
+        queries = pd.to_datetime(pd.Series(queries)).to_numpy(dtype='datetime64[ns]')
+        if len(self.times) == 0:
+            return np.full(len(queries), None, dtype=object), np.zeros(len(queries), dtype=bool)
+        p = np.minimum(np.searchsorted(self.times, queries, side='left'), len(self.times) - 1)
+        found = self.times[p] == queries
+        return np.where(found, self.labels[p], None), found
+
+    def range_slice(self, start, end):
+        # slice into the sorted arrays for rows with start <= timestamp <= end
+        lo = np.searchsorted(self.times, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = np.searchsorted(self.times, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return slice(lo, hi)
+
+    def range_labels(self, start, end):
+        # index labels of rows with start <= timestamp <= end, in time order
+        return self.labels[self.range_slice(start, end)]
+
+
+def build_site_time_indexes(data):
+    # one TimestampIndex per site, grouping the dataframe only once
+    # ------------------------------------------------
+    # data: dataframe of all site info
+    # output: dictionary of site_id: TimestampIndex
+    # ================================================
+    return {site_id: TimestampIndex(site_data) for site_id, site_data in data.groupby('site_id', sort=False, observed=True)}
+
+
+def find_closest_time(data, query_date, query_time='00:00:00', time_index=None):
     # find the closest entry to the query date and time in the dataframe
     # ------------------------------------------------
         # data: dataframe of the site you're looking at
         # query_date: %Y-%m-%d format
         # query time: %H:%M:%S format
+        # time_index: (optional) a prebuilt TimestampIndex of data, so repeated lookups don't rebuild it
         # output: closest entry in the dataframe timestamp (datetime object), its corresponding dataframe index (int)
     # ================================================
-    date_subset = data[data['timestamp'].str.contains(query_date)]
-    query_datetime = datetime.strptime(query_date+" "+query_time, "%Y-%m-%d %H:%M:%S")
-    closest_timestamp = datetime.strptime(date_subset.iloc[0]['timestamp'], "%Y-%m-%d %H:%M:%S")
-    closest_timeidx = date_subset.iloc[0].name
-
-    for i, row in date_subset.iterrows():
-        curr_date = datetime.strptime(row['timestamp'], "%Y-%m-%d %H:%M:%S")
-        if abs(query_datetime-curr_date) < abs(query_datetime-closest_timestamp):
-            closest_timestamp = curr_date
-            closest_timeidx = i
-    return closest_timestamp, closest_timeidx # errs on the side of being later
+    if time_index is None:
+        time_index = TimestampIndex(data)
+    return time_index.closest_time(query_date, query_time=query_time) # on a tie, the earlier row wins
 
 
 # =======================================================================================
 
 # Code originally from Ryan Mercer; ported (01/15/2025) and cleaned here
 # Function to process voltage and current columns
+@profile_stage('voltage/current merge')
 def process_voltage_and_current(df): # syncdatabase_011525 may not have this run
     # Handle voltage columns
     voltage_cols = ['volts', 'voltsa', 'voltsb', 'voltsc']
@@ -53,23 +164,22 @@ def remove_NaN_cols(df):
     return df
 
 
-def threshold_filtering(df):
-    # Define pump-related variables
-    flow_column = 'flow rate'
+@profile_stage('threshold filter')
+def threshold_filtering(df, spec=None, cache=None):
+    # keeps the samples within the pump's operating thresholds: 30-65 Hz and 5000-30000 BBL/day unless a site overrides them
+    # ------------------------------------------------
+    # df: dataframe of all site info
+    # spec: (optional) FilterSpec to apply instead; defaults to threshold_filter_spec() (the fleet's thresholds, with the
+        # site registry's per-site "filters"), see filters.py
+    # cache: (optional) a FilterCache of df, so re-filtering with changed thresholds doesn't re-cast the columns
+    # output: df's passing rows, with a 'frequency int' column
+    # ================================================
     frequency_float_column = 'frequency'
     frequency_int_column = 'frequency int'
+    # If needed: spec.with_conditions('pressure > 1300')
+    spec = threshold_filter_spec() if spec is None else spec
 
-    freq_min = 30
-    freq_max = 65
-
-    # Apply filtering masks on the main DataFrame (df)
-    mask = (df[frequency_float_column].astype(float) >= freq_min) & (df[frequency_float_column].astype(float) <= freq_max)
-    mask &= df[flow_column].astype(float) < 30000
-    mask &= df[flow_column].astype(float) > 5000
-    # If needed:
-    # mask &= df[pressure_column].astype(float) > 1300
-
-    df = df[mask]
+    df = spec.apply(df, cache=cache) # nothing to drop: shares the columns rather than copying them
 
     df[frequency_int_column] = df[frequency_float_column].round().astype('Int64')
-    return df
\ No newline at end of file
+    return df
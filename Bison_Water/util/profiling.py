@@ -0,0 +1,196 @@
+import contextvars
+import functools
+import inspect
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+# Stage-level instrumentation for the KPI pipeline: wall time, rows in/out/dropped, and peak memory per stage and per site
+# usage:
+#     enable_profiling(track_memory=True)
+#     ... run the pipeline (cached_bison_data, threshold_filtering, compute_kpis_for_sites, ...) ...
+#     profiling_results()            # dataframe, one row per stage call
+#     export_profile("profile.json")
+# while disabled, an instrumented function costs one global lookup on top of the plain call, so it can stay on in production
+# NOTE: stages run in worker processes (compute_kpis_all_sites) are not recorded -- profile the workers' own runs instead
+
+_PROFILER = None # the active profiler, None while profiling is disabled
+_LAST_RECORDS = [] # records of the last profiler, readable after it's disabled
+_SITE = contextvars.ContextVar('profile_site', default=None)
+
+
+class _Profiler:
+    def __init__(self, track_memory):
+        self.track_memory = track_memory
+        self.started_tracemalloc = track_memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        self.records = []
+        self.stack = [] # open stages, innermost last: [record, memory at start, peak of finished children]
+
+    def open(self, stage, rows_in):
+        record = {'stage': stage, 'site_id': _SITE.get(), 'depth': len(self.stack), 'start': time.time(),
+                  'seconds': None, 'rows_in': rows_in, 'rows_out': None, 'rows_dropped': None, 'peak_mb': None}
+        memory_start = 0
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack: # keep the parent's peak so far before resetting it for this stage
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            tracemalloc.reset_peak()
+            memory_start = current
+        self.stack.append([record, memory_start, 0])
+        record['_t0'] = time.perf_counter()
+        return record
+
+    def close(self, record, rows_out):
+        record['seconds'] = time.perf_counter() - record.pop('_t0')
+        _, memory_start, child_peak = self.stack.pop()
+        if self.track_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+            record['peak_mb'] = (peak - memory_start) / 2**20
+            if self.stack:
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+        if rows_out is not None:
+            record['rows_out'] = rows_out
+        if record['rows_in'] is not None and record['rows_out'] is not None:
+            record['rows_dropped'] = record['rows_in'] - record['rows_out']
+        self.records.append(record)
+
+    def stop(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+
+def enable_profiling(track_memory=True):
+    # starts recording (clearing any earlier records)
+    # ------------------------------------------------
+    # track_memory: also record each stage's peak memory with tracemalloc (slows allocation-heavy stages somewhat)
+    # ================================================
+    global _PROFILER
+    if _PROFILER is not None:
+        _PROFILER.stop()
+    _PROFILER = _Profiler(track_memory)
+
+
+def disable_profiling():
+    # stops recording; the records stay readable with profiling_results() until profiling is enabled again
+    # output: the records, as profiling_results() gives them
+    global _PROFILER, _LAST_RECORDS
+    if _PROFILER is not None:
+        _PROFILER.stop()
+        _LAST_RECORDS = _PROFILER.records
+    _PROFILER = None
+    return profiling_results()
+
+
+def profiling_enabled():
+    return _PROFILER is not None
+
+
+@contextmanager
+def profiling(track_memory=True):
+    # profiles the body of a with block, e.g. `with profiling(): ...` then profiling_results()
+    enable_profiling(track_memory=track_memory)
+    try:
+        yield
+    finally:
+        disable_profiling()
+
+
+PROFILE_COLUMNS = ['stage', 'site_id', 'depth', 'start', 'seconds', 'rows_in', 'rows_out', 'rows_dropped', 'peak_mb']
+
+
+def profiling_results():
+    # output: dataframe with one row per stage call, in the order the stages finished
+        # columns: stage, site_id, depth (nesting level), start (epoch seconds), seconds, rows_in, rows_out, rows_dropped, peak_mb
+    # ================================================
+    records = _PROFILER.records if _PROFILER is not None else _LAST_RECORDS
+    return pd.DataFrame(records, columns=PROFILE_COLUMNS)
+
+
+def export_profile(path=None):
+    # output: the records as a JSON string (also written to path, if given)
+    profile_json = profiling_results().to_json(orient='records', indent=2)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(profile_json)
+    return profile_json
+
+
+def count_rows(value):
+    # rows of a stage's input or output: a dataframe, or the first dataframe of a returned tuple
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple) and value and isinstance(value[0], (pd.DataFrame, pd.Series)):
+        return len(value[0])
+    return None
+
+
+@contextmanager
+def profile_site(site_id):
+    # tags every stage run inside the with block with site_id
+    token = _SITE.set(site_id)
+    try:
+        yield
+    finally:
+        _SITE.reset(token)
+
+
+class _NoStage:
+    rows_out = None
+
+
+class _Stage:
+    def __init__(self, record):
+        self.record = record
+        self.rows_out = None
+
+
+@contextmanager
+def profile_block(stage, rows_in=None):
+    # profiles an inline block as a stage; set .rows_out on the yielded object to record the rows it produced
+    if _PROFILER is None:
+        yield _NoStage()
+        return
+    profiler = _PROFILER
+    handle = _Stage(profiler.open(stage, rows_in))
+    try:
+        yield handle
+    finally:
+        profiler.close(handle.record, handle.rows_out)
+
+
+def profile_stage(stage, site_arg=None):
+    # decorator: profiles every call of the function as a stage, counting the rows of its first dataframe argument
+    # and of the dataframe it returns (or the first one of a returned tuple)
+    # ------------------------------------------------
+    # stage: (str) stage name, e.g. 'kWh/BBL'
+    # site_arg: (optional) name of the function's site_id argument; its value tags this stage and every stage nested in it
+    # ================================================
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _PROFILER
+            if profiler is None:
+                return func(*args, **kwargs)
+            token = None
+            if site_arg is not None:
+                bound = signature.bind_partial(*args, **kwargs)
+                if site_arg in bound.arguments:
+                    token = _SITE.set(bound.arguments[site_arg])
+            rows_in = next((count_rows(arg) for arg in list(args) + list(kwargs.values()) if count_rows(arg) is not None), None)
+            record = profiler.open(stage, rows_in)
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                profiler.close(record, count_rows(result))
+                if token is not None:
+                    _SITE.reset(token)
+        return wrapper
+    return decorator
@@ -0,0 +1,249 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.interpolate
+from scipy.optimize import brentq
+
+
+# in-process cache of built models, keyed by a hash of the pump curve data
+_MODEL_CACHE = {}
+BEP_POINTS = ['Min', 'BEP', 'Max'] # efficiency lines every speed line needs to intersect to get a health score line
+
+
+def find_intersection_point(func1, func2, x_min, x_max):  # from Ryan
+    def func_diff(x):
+        return func1(x) - func2(x)
+    try:
+        x_intersect = brentq(func_diff, x_min, x_max)
+        y_intersect = func1(x_intersect)
+        return x_intersect, y_intersect
+    except ValueError:
+        return None
+
+
+def compute_health_scores(freqs, flow_rates, speed_line_freqs, health_score_functions):
+    # vectorized replacement for the old per-row compute_health_score apply in calc_perc_BEP
+    # every sample is blended between its two neighbouring speed lines, weighted by how close its frequency is to each line
+    # values match the per-row version exactly: a missing speed line or a NaN flow rate gives NaN
+    # ------------------------------------------------
+    # freqs: (np.array <float>) frequency of each sample; assumed already within [min, max] of the speed lines
+    # flow_rates: (np.array <float>) flow rate of each sample
+    # speed_line_freqs: (np.array <float>) the numeric frequency of each speed line, sorted ascending
+    # health_score_functions: dictionary of speed line label: flow rate -> perc_from_BEP interpolation function
+    # output: (np.array <float>) perc_from_BEP for each sample
+    # ================================================
+    n_lines = len(speed_line_freqs)
+    health_scores = np.full(len(freqs), np.nan)
+    if len(freqs) == 0 or n_lines == 0:
+        return health_scores
+
+    # Find two nearest speed lines -- the same searchsorted rule the per-row version used
+    idx = np.searchsorted(speed_line_freqs, freqs)
+    idx_1 = np.clip(idx - 1, 0, n_lines - 1)
+    idx_2 = np.clip(idx, 0, n_lines - 1)
+    at_min = freqs <= speed_line_freqs.min()
+    at_max = freqs >= speed_line_freqs.max()
+    idx_1[at_min], idx_2[at_min] = 0, 0
+    idx_1[at_max], idx_2[at_max] = n_lines - 1, n_lines - 1
+    f1 = speed_line_freqs[idx_1]
+    f2 = speed_line_freqs[idx_2]
+
+    # Compute weights
+    same_line = f1 == f2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight1 = np.where(same_line, 1.0, (f2 - freqs) / (f2 - f1))
+        weight2 = np.where(same_line, 0.0, (freqs - f1) / (f2 - f1))
+
+    # Get health scores at each flow rate, one interpolation call per speed line
+    health_score_f1 = np.full(len(freqs), np.nan)
+    health_score_f2 = np.full(len(freqs), np.nan)
+    for i, speed_line_freq in enumerate(speed_line_freqs):
+        rows_1 = idx_1 == i
+        rows_2 = idx_2 == i
+        if not (rows_1.any() or rows_2.any()):
+            continue
+        line_str = str(int(speed_line_freq)) if speed_line_freq == int(speed_line_freq) else str(speed_line_freq)
+        if line_str not in health_score_functions:
+            print(f"Speed line {line_str} not found")
+            continue # those samples stay NaN
+        health_score_f1[rows_1] = health_score_functions[line_str](flow_rates[rows_1])
+        health_score_f2[rows_2] = health_score_functions[line_str](flow_rates[rows_2])
+
+    # Compute final health score
+    health_scores = weight1 * health_score_f1 + weight2 * health_score_f2
+    return health_scores
+
+
+def hash_file(filepath):
+    # sha256 of a file's bytes; used to key cached pump curve models so an edited curve CSV is rebuilt
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PumpCurveModel:
+    # a pump curve compiled once into flat arrays so calc_perc_BEP never repeats the brentq root-finding
+    # ------------------------------------------------
+    # speed_line_labels: (list <str>) speed line labels as they appear in the pump curve CSV, sorted by frequency
+    # speed_line_freqs: (np.array <float>) numeric frequency of each speed line
+    # bep_points: (np.array) shape (n_lines, 3, 2) -- the (flow, tdh) Min/BEP/Max intersections per speed line; NaN if missing
+    # table_flow, table_score: (np.array <float>) the health-score interpolation tables of every speed line, concatenated
+    # table_offsets: (np.array <int>) speed line i owns table_flow[table_offsets[i]:table_offsets[i+1]]; empty if it was skipped
+    # ================================================
+
+    def __init__(self, speed_line_labels, speed_line_freqs, bep_points, table_flow, table_score, table_offsets):
+        self.speed_line_labels = list(speed_line_labels)
+        self.speed_line_freqs = np.asarray(speed_line_freqs, dtype=float)
+        self.bep_points = np.asarray(bep_points, dtype=float)
+        self.table_flow = np.asarray(table_flow, dtype=float)
+        self.table_score = np.asarray(table_score, dtype=float)
+        self.table_offsets = np.asarray(table_offsets, dtype=np.int64)
+        self._health_score_functions = None
+
+    @classmethod
+    def from_curve_data(cls, df_pump_data, use_cache=True): # from Ryan -- moved here from calc_perc_BEP
+        # builds the model from pump curve data in the type/label/x/y format of the pump curve CSVs
+        # ------------------------------------------------
+        # df_pump_data: dataframe of one pump curve, see load_pump_curves()
+        # use_cache: reuse a model already built in this session from identical curve data
+        # output: PumpCurveModel
+        # ================================================
+        key = hashlib.sha256(pd.util.hash_pandas_object(df_pump_data, index=False).values.tobytes()).hexdigest()
+        if use_cache and key in _MODEL_CACHE:
+            return _MODEL_CACHE[key]
+
+        # Separate speed and efficiency lines
+        speed_data = df_pump_data[df_pump_data['type'] == 'speed']
+        efficiency_data = df_pump_data[df_pump_data['type'] == 'efficiency']
+
+        # Get unique labels for speed and efficiency lines
+        speed_lines = sorted(speed_data['label'].unique(), key=lambda x: float(x))
+        efficiency_lines = [line for line in sorted(efficiency_data['label'].unique()) if 'triangle' not in line.lower()]
+
+        # Create interpolation functions for each speed line
+        speed_line_funcs = {}
+        for label in speed_lines:
+            line_data = speed_data[speed_data['label'] == label].sort_values('x')
+            speed_line_funcs[label] = scipy.interpolate.interp1d(line_data['x'].values, line_data['y'].values, bounds_error=False, fill_value='extrapolate')
+
+        # Create interpolation functions for each efficiency line
+        efficiency_line_funcs = {}
+        for label in efficiency_lines:
+            line_data = efficiency_data[efficiency_data['label'] == label].sort_values('x')
+            efficiency_line_funcs[label] = scipy.interpolate.interp1d(line_data['x'].values, line_data['y'].values, bounds_error=False, fill_value='extrapolate')
+
+        # Find intersection points between speed lines and efficiency lines
+        intersection_points = {}
+        for speed_line in speed_lines:
+            speed_func = speed_line_funcs[speed_line]
+            x_speed_min = speed_data[speed_data['label'] == speed_line]['x'].min()
+            x_speed_max = speed_data[speed_data['label'] == speed_line]['x'].max()
+            intersection_points[speed_line] = {}
+            for efficiency_line in efficiency_lines:
+                eff_func = efficiency_line_funcs[efficiency_line]
+                x_eff_min = efficiency_data[efficiency_data['label'] == efficiency_line]['x'].min()
+                x_eff_max = efficiency_data[efficiency_data['label'] == efficiency_line]['x'].max()
+                x_min = max(x_speed_min, x_eff_min)
+                x_max = min(x_speed_max, x_eff_max)
+                if x_min < x_max:
+                    intersection = find_intersection_point(speed_func, eff_func, x_min, x_max)
+                    if intersection is not None:
+                        intersection_points[speed_line][efficiency_line] = intersection
+                    else:
+                        print(f"No intersection found between speed line {speed_line} and efficiency line {efficiency_line}")
+                else:
+                    print(f"No overlapping x range between speed line {speed_line} and efficiency line {efficiency_line}")
+
+        # Interpolate between Min to BEP and BEP to Max for each speed line, flattened into one table
+        bep_points = np.full((len(speed_lines), len(BEP_POINTS), 2), np.nan)
+        table_flow, table_score, table_offsets = [], [], [0]
+        for i, speed_line in enumerate(speed_lines):
+            line_flow, line_score = np.array([]), np.array([])
+            if all(key in intersection_points[speed_line] for key in BEP_POINTS):
+                min_point, bep_point, max_point = [intersection_points[speed_line][key] for key in BEP_POINTS]
+                bep_points[i] = [min_point, bep_point, max_point]
+
+                # Combine Min -> BEP and BEP -> Max
+                x_interp = np.concatenate([np.linspace(min_point[0], bep_point[0], 100), np.linspace(bep_point[0], max_point[0], 100)])
+                health_score = np.concatenate([np.linspace(-100, 0, 100), np.linspace(0, 100, 100)])
+                df_line = pd.DataFrame({'flow_rate': x_interp, 'perc_from_BEP': health_score})
+                df_line = df_line.drop_duplicates(subset='flow_rate').sort_values('flow_rate')
+                line_flow, line_score = df_line['flow_rate'].values, df_line['perc_from_BEP'].values
+            else:
+                print(f"Missing intersection points for speed line {speed_line}, skipping")
+            table_flow.append(line_flow)
+            table_score.append(line_score)
+            table_offsets.append(table_offsets[-1] + len(line_flow))
+
+        model = cls(speed_lines, [float(speed_line) for speed_line in speed_lines], bep_points,
+                    np.concatenate(table_flow + [np.array([])]), np.concatenate(table_score + [np.array([])]), table_offsets)
+        _MODEL_CACHE[key] = model
+        return model
+
+    @classmethod
+    def from_csv(cls, curve_path, cache_dir=None):
+        # loads a pump curve CSV as a model; with a cache_dir, the built model is persisted as <sha256 of the CSV>.npz
+        # so later runs (and runs on new data for the same site) load it instead of redoing the root-finding
+        # ------------------------------------------------
+        # curve_path: path to a PumpCurve_*_DataPoints.csv file
+        # cache_dir: (optional) directory of persisted models
+        # output: PumpCurveModel
+        # ================================================
+        curve_hash = hash_file(curve_path)
+        if curve_hash in _MODEL_CACHE:
+            return _MODEL_CACHE[curve_hash]
+        cache_path = os.path.join(cache_dir, curve_hash + ".npz") if cache_dir is not None else None
+        if cache_path is not None and os.path.exists(cache_path):
+            model = cls.load(cache_path)
+        else:
+            model = cls.from_curve_data(pd.read_csv(curve_path))
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                model.save(cache_path)
+        _MODEL_CACHE[curve_hash] = model
+        return model
+
+    def save(self, filepath):
+        np.savez(filepath, speed_line_labels=np.array(self.speed_line_labels, dtype=str), speed_line_freqs=self.speed_line_freqs,
+                 bep_points=self.bep_points, table_flow=self.table_flow, table_score=self.table_score, table_offsets=self.table_offsets)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as arrays:
+            return cls(arrays['speed_line_labels'].tolist(), arrays['speed_line_freqs'], arrays['bep_points'],
+                       arrays['table_flow'], arrays['table_score'], arrays['table_offsets'])
+
+    @property
+    def freq_min(self):
+        return self.speed_line_freqs.min()
+
+    @property
+    def freq_max(self):
+        return self.speed_line_freqs.max()
+
+    @property
+    def health_score_functions(self):
+        # speed line label: flow rate -> perc_from_BEP interpolation function, rebuilt from the flat tables on first use
+        if self._health_score_functions is None:
+            self._health_score_functions = {}
+            for i, label in enumerate(self.speed_line_labels):
+                start, end = self.table_offsets[i], self.table_offsets[i + 1]
+                if end > start:
+                    flow_rate, health_score = self.table_flow[start:end], self.table_score[start:end]
+                    self._health_score_functions[label] = scipy.interpolate.interp1d(
+                        flow_rate, health_score, bounds_error=False, fill_value=(health_score[0], health_score[-1])
+                    )
+        return self._health_score_functions
+
+    def score(self, freqs, flow_rates):
+        # perc_from_BEP for arrays of frequency and flow rate, see compute_health_scores()
+        return compute_health_scores(np.asarray(freqs, dtype=float), np.asarray(flow_rates, dtype=float),
+                                     self.speed_line_freqs, self.health_score_functions)
+
+    def __getstate__(self): # the interp1d objects are rebuilt from the tables rather than pickled
+        state = self.__dict__.copy()
+        state['_health_score_functions'] = None
+        return state
@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+
+
+# Optimal-frequency recommendations from the per-frequency KPI charts (the kpis_all_sites dictionary that
+# compute_kpis_for_sites / compute_kpis_all_sites / StreamingKPIAggregator produce), for every site at once:
+#     recommendations = recommend_frequencies(kpis_all_sites, weights={'kWh/BBL': 2, 'Flow Rate': 1, 'perc_from_BEP': 1})
+#     recommendations['sites']       # one row per site: its recommended frequency, score, and KPIs there
+#     recommendations['fleet']       # the single frequency that's best across the fleet
+# a frequency is Pareto-optimal if no other frequency of the same site is at least as good on every objective and better
+# on one; among those, the recommendation is the one with the best weighted score of the objectives, each rescaled to
+# 0 (the site's worst) .. 1 (the site's best)
+
+# chart KPI: (the chart column it's judged on, whether bigger is better) -- BEP KPIs are judged on their distance from BEP
+OBJECTIVES = {'Flow Rate': ('Flow Rate', True),
+              'kWh/BBL': ('kWh/BBL', False),
+              'perc_from_BEP': ('abs_perc_from_BEP', False),
+              'norm_perc_from_BEP': ('abs_norm_perc_from_BEP', False)}
+DEFAULT_WEIGHTS = {'Flow Rate': 1, 'kWh/BBL': 1, 'perc_from_BEP': 1}
+
+
+def kpi_table(kpis_all_sites, site_ids=None):
+    # every site's chart in one long dataframe
+    # ------------------------------------------------
+    # kpis_all_sites: dictionary of site_id: {frequency: {KPI: average}} (sites with no chart, None, are skipped)
+    # site_ids: (optional) only these sites
+    # output: dataframe with site_id, frequency, and a column per KPI, sorted by site_id then frequency
+    # ================================================
+    site_ids = list(kpis_all_sites) if site_ids is None else site_ids
+    rows = [{'site_id': site_id, 'frequency': freq, **freq_kpis}
+            for site_id in site_ids if kpis_all_sites.get(site_id)
+            for freq, freq_kpis in kpis_all_sites[site_id].items()]
+    table = pd.DataFrame(rows)
+    if len(table) == 0:
+        return pd.DataFrame(columns=['site_id', 'frequency'])
+    for kpi, (col, _) in OBJECTIVES.items(): # charts written before the abs_ columns existed
+        if col not in table.columns and kpi in table.columns and col != kpi:
+            table[col] = table[kpi].abs()
+    return table.sort_values(['site_id', 'frequency'], kind='stable').reset_index(drop=True)
+
+
+def resolve_objectives(table, weights=None):
+    # output: dictionary of chart column: (weight, bigger is better) for the weighted objectives the table has
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    objectives = {}
+    for kpi, weight in weights.items():
+        if kpi not in OBJECTIVES:
+            raise ValueError("Unknown objective {!r}; use one of {}".format(kpi, list(OBJECTIVES)))
+        col, maximize = OBJECTIVES[kpi]
+        if weight > 0 and col in table.columns:
+            objectives[col] = (float(weight), maximize)
+    if not objectives:
+        raise ValueError("None of the objectives {} are in the KPI charts".format(list(weights)))
+    return objectives
+
+
+def pareto_optimal(values, groups):
+    # which rows aren't dominated by another row of the same group, for all groups in one vectorized pass
+    # ------------------------------------------------
+    # values: (np.array <float>, rows x objectives) oriented so bigger is better; a row with a NaN is never optimal
+    # groups: (np.array) group of each row; rows of a group must be contiguous
+    # output: (np.array <bool>) per row
+    # ================================================
+    n = len(values)
+    complete = ~np.isnan(values).any(axis=1)
+    if n == 0:
+        return complete
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    # every (candidate, other) pair within a group: candidate i repeated once per row of its group
+    row_sizes = np.repeat(sizes, sizes)
+    candidates = np.repeat(np.arange(n), row_sizes)
+    within = np.arange(len(candidates)) - np.repeat(np.cumsum(row_sizes) - row_sizes, row_sizes)
+    others = np.repeat(np.repeat(starts, sizes), row_sizes) + within
+    other_values, candidate_values = values[others], values[candidates]
+    dominates = (complete[others] & np.all(other_values >= candidate_values, axis=1) & np.any(other_values > candidate_values, axis=1))
+    dominated = np.bincount(candidates[dominates], minlength=n) > 0
+    return complete & ~dominated
+
+
+def oriented_values(table, objectives):
+    # the objectives' columns as a (rows x objectives) array, negated where smaller is better
+    return np.column_stack([table[col].to_numpy(dtype=float) * (1 if maximize else -1) for col, (_, maximize) in objectives.items()])
+
+
+def missing_objectives(table, objectives, groups):
+    # (np.array <bool>, rows x objectives) the objectives a row's whole group has no values of -- e.g. the BEP KPIs of a site
+    # without a pump curve -- which that group is judged without
+    return pd.DataFrame(np.isnan(oriented_values(table, objectives))).groupby(groups, sort=False).transform('all').to_numpy()
+
+
+def score_frequencies(table, objectives, groups):
+    # weighted score of every row: each objective rescaled within its group to 0 (worst) .. 1 (best), then weighted
+    # (an objective a group can't tell apart -- one frequency, or all equal -- counts as 1 for all of its rows; one it has
+    # no values of is left out of its weighted mean)
+    weights = np.array([weight for weight, _ in objectives.values()])
+    oriented = oriented_values(table, objectives)
+    frame = pd.DataFrame(oriented)
+    grouped = frame.groupby(groups, sort=False)
+    low, high = grouped.transform('min').to_numpy(), grouped.transform('max').to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = np.where(high > low, (oriented - low) / (high - low), 1.0)
+    scaled[np.isnan(oriented)] = np.nan
+    missing = missing_objectives(table, objectives, groups)
+    scaled[missing] = 0.0
+    row_weights = np.where(missing, 0.0, weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (scaled * weights).sum(axis=1) / row_weights.sum(axis=1)
+
+
+def best_frequencies(table, kpis=['kWh/BBL','Flow Rate']):
+    # the single-KPI best frequency of every site (kpi_charts' game_kpi): max flow rate, min kWh/BBL, min |BEP|
+    # ties go to the lowest frequency
+    # ------------------------------------------------
+    # table: dataframe from kpi_table()
+    # output: dictionary of site_id: {KPI: (int) frequency} (a KPI a site has no values of, e.g. BEP without a pump curve, is left out)
+    # ================================================
+    best = {site_id: {} for site_id in table['site_id'].unique().tolist()}
+    for kpi in kpis:
+        col, maximize = OBJECTIVES[kpi]
+        if col not in table.columns:
+            continue
+        values = table[col].astype(float).dropna() # idxmax raises on a site whose values are all NaN
+        rows = (values if maximize else -values).groupby(table.loc[values.index, 'site_id'], sort=False).idxmax()
+        for site_id, row in rows.items():
+            best[site_id][kpi] = int(table.at[row, 'frequency'])
+    return best
+
+
+def recommend_frequencies(kpis_all_sites, weights=None, site_ids=None, min_site_coverage=0.5):
+    # Pareto-optimal and recommended frequencies per site and for the fleet as a whole
+    # ------------------------------------------------
+    # kpis_all_sites: dictionary of site_id: {frequency: {KPI: average}}
+    # weights: (optional) dictionary of KPI: weight over 'Flow Rate', 'kWh/BBL', 'perc_from_BEP', 'norm_perc_from_BEP';
+        # defaults to DEFAULT_WEIGHTS (KPIs the charts don't have are left out; weight 0 leaves one out)
+    # site_ids: (optional) only these sites
+    # min_site_coverage: a fleet-wide frequency must be charted at at least this fraction of the sites
+    # output: dictionary of
+        # 'frequencies': kpi_table() with 'pareto' (bool) and 'score' (0..1) columns
+        # 'sites': one row per site -- its recommended frequency, score, number of Pareto-optimal frequencies, and KPIs there
+        # 'best_by_kpi': best_frequencies() of the weighted KPIs
+        # 'fleet_frequencies': one row per frequency -- the sites charting it, their mean KPIs and mean score, 'pareto'
+        # 'fleet': the recommended fleet-wide frequency and its mean score (None if no frequency is charted widely enough)
+    # ================================================
+    table = kpi_table(kpis_all_sites, site_ids=site_ids)
+    if len(table) == 0:
+        return {'frequencies': table, 'sites': pd.DataFrame(), 'best_by_kpi': {}, 'fleet_frequencies': pd.DataFrame(), 'fleet': None}
+    objectives = resolve_objectives(table, weights)
+    groups = table['site_id'].to_numpy()
+    judged = oriented_values(table, objectives)
+    judged[missing_objectives(table, objectives, groups)] = 0.0 # the same for all of the site's rows: dominates nothing
+    table['pareto'] = pareto_optimal(judged, groups)
+    table['score'] = score_frequencies(table, objectives, groups)
+
+    # per site: the best-scoring Pareto-optimal frequency
+    front = table[table['pareto']]
+    picks = front.loc[front.groupby('site_id', sort=False)['score'].idxmax()]
+    sites = picks[['site_id', 'frequency', 'score'] + list(objectives)].rename(columns={'frequency': 'recommended_frequency'})
+    sites = sites.merge(front.groupby('site_id').size().rename('n_pareto').reset_index(), on='site_id').reset_index(drop=True)
+
+    # fleet: the sites' rescaled scores averaged per frequency, so a big site's flow rate doesn't outweigh a small site's
+    n_sites = table['site_id'].nunique()
+    fleet = table.groupby('frequency').agg(n_sites=('site_id', 'nunique'), score=('score', 'mean'),
+                                           **{col: (col, 'mean') for col in objectives}).reset_index()
+    fleet = fleet[fleet['n_sites'] >= min_site_coverage * n_sites].reset_index(drop=True)
+    fleet['pareto'] = pareto_optimal(oriented_values(fleet, objectives), np.zeros(len(fleet), dtype=int))
+    fleet_front = fleet[fleet['pareto'] & fleet['score'].notna()]
+    fleet_pick = None
+    if len(fleet_front):
+        best = fleet_front.loc[fleet_front['score'].idxmax()]
+        fleet_pick = {'frequency': float(best['frequency']), 'score': float(best['score']), 'n_sites': int(best['n_sites'])}
+    best_by_kpi = best_frequencies(table, kpis=[kpi for kpi in OBJECTIVES if OBJECTIVES[kpi][0] in objectives])
+    return {'frequencies': table, 'sites': sites, 'best_by_kpi': best_by_kpi, 'fleet_frequencies': fleet, 'fleet': fleet_pick}
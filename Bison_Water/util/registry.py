@@ -0,0 +1,128 @@
+import os
+import json
+from collections.abc import Mapping
+from copy import deepcopy
+
+
+# The site registry: every site's metadata, historian device id, pump curve file, and calibration stages, plus the
+# historian's measurement path mappings, in one config file (sites.json next to the notebooks) instead of hardcoded tables
+# onboarding a site is one more entry in "sites":
+#     {"site_id": ..., "site_name": "... SWD", "short_name": ..., "device_id": ..., "enable": false, "num_pumps": 1,
+#      "site_dir_name": ..., "pump_curve_file": "PumpCurve_..._DataPoints.csv" (or null), "calibration_stages": [...]}
+# a device that is one pump of a multi-pump station also gets "station": <station name> and "pump_id": <its pump number there>
+# a site whose thresholds differ from the fleet's gets "filters": a list of conditions like "flow rate > 3000" (see filters.py)
+# the config is parsed once per process (and again only if the file changes); see load_site_registry()
+
+SITES_CONFIG_PATH = os.environ.get('BISON_SITES_CONFIG',
+                                   os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sites.json'))
+
+# parsed registries, keyed by config path: (file modification time, SiteRegistry)
+_REGISTRY_CACHE = {}
+
+
+class SiteRegistry:
+    # the parsed site config
+    # ------------------------------------------------
+    # config: dictionary with "pump_curve_dir", "measurements", and "sites" (see the top of this file)
+    # config_dir: (optional) directory a relative pump_curve_dir is resolved against
+    # NOTE: the BISON_PUMP_CURVE_DIR environment variable overrides the config's pump_curve_dir
+    # ================================================
+
+    def __init__(self, config, config_dir=None):
+        self.sites = {int(site['site_id']): site for site in config['sites']}
+        self.measurements = config.get('measurements', {})
+        pump_curve_dir = os.environ.get('BISON_PUMP_CURVE_DIR', config.get('pump_curve_dir', ''))
+        if config_dir is not None and not os.path.isabs(pump_curve_dir):
+            pump_curve_dir = os.path.join(config_dir, pump_curve_dir)
+        self.pump_curve_dir = pump_curve_dir
+
+    def __contains__(self, site_id):
+        return site_id in self.sites
+
+    def site_ids(self):
+        return list(self.sites)
+
+    def device_ids(self):
+        # historian device ids to fetch (a site without a device_id isn't fetched)
+        return [site['device_id'] for site in self.sites.values() if site.get('device_id') is not None]
+
+    def site_names(self):
+        # dictionary of site_id: short name, for the sites that have one
+        return {site_id: site['short_name'] for site_id, site in self.sites.items() if site.get('short_name')}
+
+    def pump_ids(self):
+        # dictionary of site_id: the pump_id its device's rows get at ingest (1 unless the site is one pump of a station)
+        return {site_id: int(site.get('pump_id', 1)) for site_id, site in self.sites.items()}
+
+    def filter_overrides(self):
+        # dictionary of site_id: list of filter conditions overriding threshold_filtering's for that site (see filters.py)
+        return {site_id: list(site['filters']) for site_id, site in self.sites.items() if site.get('filters')}
+
+    def stations(self):
+        # dictionary of station name: list of its sites' site_ids (one per pump), for the sites that are pumps of a station
+        stations = {}
+        for site_id, site in self.sites.items():
+            if site.get('station'):
+                stations.setdefault(site['station'], []).append(site_id)
+        return stations
+
+    def pump_curve_path(self, site_id):
+        # path of a site's pump curve CSV, or None if it has none
+        curve_file = self.sites[site_id].get('pump_curve_file')
+        if not curve_file:
+            return None
+        return curve_file if os.path.isabs(curve_file) else os.path.join(self.pump_curve_dir, curve_file)
+
+    def site_info(self, site_id):
+        # a site's info in the Ryan sites_info format (a fresh copy, so callers can edit it)
+        site = self.sites[site_id]
+        return {'enable': site.get('enable', False), 'site_name': site['site_name'], 'site_id': site_id,
+                'num_pumps': site.get('num_pumps', 1), 'site_dir_name': site.get('site_dir_name', ''),
+                'pump_curve_path': self.pump_curve_path(site_id),
+                'calibration_stages': deepcopy(site.get('calibration_stages', []))}
+
+
+def load_site_registry(path=None):
+    # the site registry, parsed once and cached (re-parsed only if the file has changed since)
+    # ------------------------------------------------
+    # path: (optional) config file; defaults to SITES_CONFIG_PATH (the BISON_SITES_CONFIG environment variable, or sites.json)
+    # output: SiteRegistry
+    # ================================================
+    path = os.path.abspath(SITES_CONFIG_PATH if path is None else path)
+    modified = os.path.getmtime(path)
+    cached = _REGISTRY_CACHE.get(path)
+    if cached is None or cached[0] != modified:
+        with open(path) as f:
+            cached = (modified, SiteRegistry(json.load(f), config_dir=os.path.dirname(path)))
+        _REGISTRY_CACHE[path] = cached
+    return cached[1]
+
+
+class LazyPumpCurves(Mapping):
+    # dictionary of site_id: pump curve that reads each curve only when it's first looked up, then keeps it
+    # ------------------------------------------------
+    # site_ids: list of (int) site_ids
+    # load: function of a site_id giving its pump curve (or None)
+    # ================================================
+
+    def __init__(self, site_ids, load):
+        self._site_ids = list(dict.fromkeys(site_ids))
+        self._load = load
+        self._curves = {}
+
+    def __getitem__(self, site_id):
+        if site_id not in self._site_ids:
+            raise KeyError(site_id)
+        if site_id not in self._curves:
+            self._curves[site_id] = self._load(site_id)
+        return self._curves[site_id]
+
+    def __iter__(self):
+        return iter(self._site_ids)
+
+    def __len__(self):
+        return len(self._site_ids)
+
+    def loaded(self):
+        # site_ids whose curves have been read so far
+        return list(self._curves)
@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+from util.preprocessing import time_axis
+from util.dataloader import KPI_COLUMNS
+from util.partition import PartitionedDataset
+
+
+# Mixed sampling intervals: some sites report every minute (Union City, Canadian), others every five (Siegrist, Calumet),
+# and any of them can drop out for hours. This puts a site (or the fleet) on a uniform time grid, so downstream KPIs get
+# evenly spaced rows -- one row per interval -- whatever the site's native rate:
+#     profile = sampling_profile(dataset)                    # each site's real sampling-interval distribution, summarized
+#     grid = resample_sites(dataset, interval='5min')        # every site on a 5-minute grid
+#     compute_kpis_for_sites(grid[grid['site_id']==site_id], site_id)    # the one-hour minimum is 12 rows, for every site
+# a sampling interval is the time between consecutive samples of one pump, rounded to the nearest resolution (a minute)
+
+RESAMPLE_AGGREGATIONS = ['mean', 'median', 'min', 'max', 'first', 'last', 'sum']
+
+
+def sampling_intervals(data, resolution='1min'):
+    # the time between consecutive samples, rounded to the nearest resolution
+    # ------------------------------------------------
+    # data: dataframe of one pump's rows (needs 'timestamp' or 'timestamp_datetime'), or its time axis as a series
+    # resolution: what the intervals are rounded to
+    # output: (np.array <float>) intervals in minutes, one per consecutive pair of timestamps (in time order)
+    # ================================================
+    times = (data if isinstance(data, pd.Series) else time_axis(data)).to_numpy(dtype='datetime64[ns]')
+    times = np.sort(times[~np.isnat(times)])
+    step = pd.Timedelta(resolution).value
+    deltas = np.diff(times.astype('int64'))
+    return np.round(deltas / step) * step / 6e10
+
+
+def sampling_interval_distribution(data, resolution='1min'):
+    # the distribution of the sampling interval -- multimodal where a site switches rate or drops out
+    # ------------------------------------------------
+    # data: dataframe of one pump's rows, or its time axis as a series
+    # resolution: what the intervals are rounded to
+    # output: dataframe indexed by interval (minutes) with 'count', 'fraction' (of the intervals), and 'time_fraction'
+        # (of the time spanned), most common interval first
+    # ================================================
+    intervals = sampling_intervals(data, resolution=resolution)
+    values, counts = np.unique(intervals, return_counts=True)
+    distribution = pd.DataFrame({'count': counts, 'fraction': counts / max(len(intervals), 1),
+                                 'time_fraction': values * counts / max(intervals.sum(), 1e-12)},
+                                index=pd.Index(values, name='interval_minutes'))
+    return distribution.sort_values('count', ascending=False, kind='stable')
+
+
+def dominant_sampling_interval(data, resolution='1min'):
+    # the most common sampling interval in minutes (ties go to the shorter one); NaN with fewer than two samples
+    intervals = sampling_intervals(data, resolution=resolution)
+    intervals = intervals[intervals > 0]
+    if len(intervals) == 0:
+        return np.nan
+    values, counts = np.unique(intervals, return_counts=True)
+    return float(values[np.argmax(counts)]) # np.unique sorts ascending, and argmax keeps the first of a tie
+
+
+def sampling_profile(data, site_ids=None, gap='15min', resolution='1min'):
+    # every pump's sampling summarized: its dominant interval, the spread around it, and its outages
+    # ------------------------------------------------
+    # data: dataframe of all site info, or a PartitionedDataset of it
+    # site_ids: (optional) only these sites
+    # gap: an interval at least this long is an outage
+    # output: dataframe with a row per (site_id, pump_id): samples, first, last, dominant_interval, dominant_fraction (of the
+        # intervals at the dominant one), median_interval, mean_interval (what estimate_sampling_interval used to report),
+        # p95_interval, gaps (outages), gap_hours (time lost to them), and coverage (the time spanned that isn't an outage)
+    # ================================================
+    dataset = data if isinstance(data, PartitionedDataset) else PartitionedDataset(data)
+    gap_minutes = pd.Timedelta(gap).total_seconds() / 60
+    rows = []
+    for site_id, pump_id in dataset.blocks:
+        if site_ids is not None and site_id not in site_ids:
+            continue
+        pump_times = pd.Series(dataset.times[slice(*dataset.blocks[(site_id, pump_id)])])
+        intervals = sampling_intervals(pump_times, resolution=resolution)
+        row = {'site_id': site_id, 'pump_id': pump_id, 'samples': len(pump_times), 'first': pump_times.min(),
+               'last': pump_times.max(), 'dominant_interval': dominant_sampling_interval(pump_times, resolution=resolution)}
+        if len(intervals):
+            outages = intervals[intervals >= gap_minutes]
+            row.update({'dominant_fraction': float(np.mean(intervals == row['dominant_interval'])),
+                        'median_interval': float(np.median(intervals)), 'mean_interval': float(np.mean(intervals)),
+                        'p95_interval': float(np.percentile(intervals, 95)), 'gaps': len(outages),
+                        'gap_hours': float(outages.sum() / 60),
+                        'coverage': float(1 - outages.sum() / intervals.sum()) if intervals.sum() > 0 else np.nan})
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['site_id', 'pump_id', 'samples', 'first', 'last', 'dominant_interval', 'dominant_fraction',
+                                       'median_interval', 'mean_interval', 'p95_interval', 'gaps', 'gap_hours', 'coverage'])
+
+
+def samples_in(duration, interval):
+    # how many grid rows a duration spans at a sampling interval -- e.g. format_sitegts' duration_len is samples_in('2h', '5min')
+    return int(pd.Timedelta(duration) / pd.Timedelta(interval))
+
+
+def _gap_runs(empty):
+    # length of the run of empty bins each bin is part of (0 for a non-empty bin)
+    run_ids = np.cumsum(empty & ~np.r_[False, empty[:-1]]) # a new id at the start of every run
+    lengths = np.bincount(run_ids[empty], minlength=run_ids[-1] + 1)
+    return np.where(empty, lengths[run_ids], 0)
+
+
+def resample_uniform(data, interval=None, columns=KPI_COLUMNS, agg='mean', fill=None, max_gap='15min', origin=None):
+    # puts one pump's rows on a uniform time grid: one row per interval, aggregating the samples that fall in it
+    # ------------------------------------------------
+    # data: dataframe of one pump's rows (a single-pump site, or PartitionedDataset.pump()) with a time axis
+    # interval: grid spacing, e.g. '1min' or '5min'; defaults to the data's dominant sampling interval
+    # columns: sensor columns to carry over (ones data doesn't have are skipped)
+    # agg: how the samples in an interval are combined -- one of RESAMPLE_AGGREGATIONS, or a dictionary of column: aggregation
+    # fill: what goes in an interval with no samples -- None (left NaN), 'ffill' (the last value), or 'interpolate' (linear);
+        # only gaps of at most max_gap are filled, so an outage stays an outage
+    # max_gap: the longest gap fill bridges
+    # origin: (optional) timestamp the grid is anchored at; defaults to the first sample's time, floored to the interval
+    # output: dataframe with timestamp (the start of each interval), site_id / pump_id (if data has them), the columns,
+        # 'samples' (how many samples the interval aggregates), and 'filled' (whether its values were filled in)
+    # ================================================
+    if 'pump_id' in data.columns and data['pump_id'].nunique() > 1:
+        raise ValueError("resample_uniform takes one pump's rows; use resample_sites() for a multi-pump site")
+    times = time_axis(data).to_numpy(dtype='datetime64[ns]')
+    known = ~np.isnat(times)
+    columns = [col for col in columns if col in data.columns]
+    keys = {col: data[col].iloc[0] for col in ['site_id', 'pump_id'] if col in data.columns and len(data)}
+    if not known.any():
+        return pd.DataFrame(columns=['timestamp'] + list(keys) + columns + ['samples', 'filled'])
+
+    if interval is None:
+        dominant = dominant_sampling_interval(data)
+        interval = '{}min'.format(dominant if dominant > 0 else 1) # NaN (a single sample) compares False too
+    step = pd.Timedelta(interval)
+    ticks = times[known].astype('int64')
+    start = pd.Timestamp(ticks.min()).floor(step).value if origin is None else pd.Timestamp(origin).value
+    bins = (ticks - start) // step.value
+    in_grid = bins >= 0
+    bins = bins[in_grid]
+    n_bins = int(bins.max()) + 1 if len(bins) else 0
+
+    values = pd.DataFrame({col: data[col].to_numpy()[known][in_grid].astype(float) for col in columns})
+    aggregations = {col: agg for col in columns} if isinstance(agg, str) else {col: agg.get(col, 'mean') for col in columns}
+    for col, col_agg in aggregations.items():
+        if col_agg not in RESAMPLE_AGGREGATIONS:
+            raise ValueError("Unknown aggregation {!r} for {}; use one of {}".format(col_agg, col, RESAMPLE_AGGREGATIONS))
+    grid = values.groupby(bins, sort=True).agg(aggregations) if columns else pd.DataFrame(index=np.unique(bins))
+    grid = grid.reindex(np.arange(n_bins))
+    samples = np.bincount(bins, minlength=n_bins)
+
+    empty = samples == 0
+    filled = np.zeros(n_bins, dtype=bool)
+    if fill is not None and empty.any():
+        fillable = empty & (_gap_runs(empty) * step <= pd.Timedelta(max_gap))
+        if fill == 'ffill':
+            filler = grid.ffill()
+        elif fill == 'interpolate':
+            filler = grid.interpolate(method='linear', limit_area='inside')
+        else:
+            raise ValueError("fill must be None, 'ffill', or 'interpolate', not {!r}".format(fill))
+        grid = grid.mask(pd.Series(fillable, index=grid.index), filler, axis=0)
+        filled = fillable & grid.notna().any(axis=1).to_numpy()
+
+    resampled = pd.DataFrame({'timestamp': pd.to_datetime(start + np.arange(n_bins) * step.value)})
+    for col, value in keys.items():
+        resampled[col] = value
+    for col in columns:
+        resampled[col] = grid[col].to_numpy()
+    resampled['samples'] = samples
+    resampled['filled'] = filled
+    return resampled
+
+
+def resample_sites(data, interval=None, site_ids=None, **kwargs):
+    # puts every pump of the fleet on a uniform grid (see resample_uniform)
+    # ------------------------------------------------
+    # data: dataframe of all site info, or a PartitionedDataset of it
+    # interval: grid spacing for every site, e.g. '5min'; defaults to each pump's own dominant sampling interval
+    # site_ids: (optional) only these sites
+    # kwargs: passed to resample_uniform (columns, agg, fill, max_gap)
+    # output: dataframe of every pump's grid, sorted by site_id, pump_id, then timestamp -- ready for PartitionedDataset
+    # ================================================
+    dataset = data if isinstance(data, PartitionedDataset) else PartitionedDataset(data)
+    grids = []
+    for site_id, pump_id in dataset.blocks:
+        if site_ids is not None and site_id not in site_ids:
+            continue
+        pump_grid = resample_uniform(dataset.pump(site_id, pump_id), interval=interval, **kwargs)
+        pump_grid['site_id'] = site_id
+        pump_grid['pump_id'] = pump_id
+        grids.append(pump_grid)
+    if not grids:
+        return pd.DataFrame(columns=['timestamp', 'site_id', 'pump_id', 'samples', 'filled'])
+    return pd.concat(grids, ignore_index=True)
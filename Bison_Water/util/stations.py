@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+from util.preprocessing import time_axis
+from util.dataloader import KPI_COLUMNS
+from util.partition import PartitionedDataset
+from util.registry import load_site_registry
+
+
+# Multi-pump stations: a station's pumps (one site with several pump_ids, or several sites -- devices -- the site
+# registry groups into a station, like 1509 SWD's 48137 and 48138) are time-aligned into one frame, and the station's
+# flow, power, and kWh/BBL are computed from all its pumps at once
+# usage:
+#     site_ids = load_site_registry().stations()['1509 SWD']
+#     aligned = align_pumps(station_pumps(dataset, site_ids))
+#     station_data = calc_station_kWh_BBL(aligned)
+#     _, station_kpis, _ = compute_kpis_for_station(station_data, '1509 SWD')   # see format_calculations.py
+
+
+def station_pumps(data, site_ids):
+    # every pump of the given sites, in time order
+    # ------------------------------------------------
+    # data: dataframe of all site info, or a PartitionedDataset of it
+    # site_ids: list of (int) site_ids making up the station
+    # output: dictionary of pump_id: that pump's rows
+    # NOTE: pump_ids must be unique across the station -- give each device its own "pump_id" in sites.json
+        # a single-pump site is keyed by its registry pump_id, so caches written before ingest assigned them still work
+    # ================================================
+    dataset = data if isinstance(data, PartitionedDataset) else PartitionedDataset(data[data['site_id'].isin(site_ids)])
+    registry_pump_ids = load_site_registry().pump_ids()
+    pumps = {}
+    for site_id in site_ids:
+        if site_id not in dataset.site_blocks:
+            continue
+        site_pump_ids = dataset.pump_ids(site_id)
+        for pump_id in site_pump_ids:
+            key = registry_pump_ids.get(site_id, pump_id) if len(site_pump_ids) == 1 else pump_id
+            if key in pumps:
+                raise ValueError("Pump {} of site {} is already a pump of this station; set each site's pump_id in sites.json".format(key, site_id))
+            pumps[key] = dataset.pump(site_id, pump_id)
+    return pumps
+
+
+def align_pumps(pumps, tolerance='2min', columns=KPI_COLUMNS, reference=None):
+    # time-aligns a station's pumps: each pump's sample nearest to every reference timestamp (within tolerance)
+    # ------------------------------------------------
+    # pumps: dictionary of pump_id: that pump's rows (see station_pumps())
+    # tolerance: the furthest a pump's sample can be from a reference timestamp; further, and that pump is missing (NaN) there
+    # columns: sensor columns to align
+    # reference: (optional) pump_id whose timestamps are the station's time axis; defaults to the pump with the most samples
+    # output: dataframe indexed by the reference timestamps, with (column, pump_id) columns -- e.g. aligned['flow rate']
+        # is one column per pump
+    # ================================================
+    if reference is None:
+        reference = max(pumps, key=lambda pump_id: len(pumps[pump_id]))
+    reference_times = time_axis(pumps[reference]).to_numpy(dtype='datetime64[ns]')
+    grid = pd.DataFrame({'timestamp': np.sort(reference_times[~np.isnat(reference_times)])})
+    aligned = {}
+    for pump_id, pump_data in pumps.items():
+        pump = pd.DataFrame({'timestamp': time_axis(pump_data).to_numpy(dtype='datetime64[ns]'),
+                             **{col: pump_data[col].to_numpy(dtype=float) for col in columns if col in pump_data.columns}})
+        pump = pump[pump['timestamp'].notna()].sort_values('timestamp', kind='stable')
+        merged = pd.merge_asof(grid, pump, on='timestamp', direction='nearest', tolerance=pd.Timedelta(tolerance))
+        for col in columns:
+            aligned[(col, pump_id)] = merged[col].to_numpy() if col in merged.columns else np.full(len(grid), np.nan)
+    aligned = pd.DataFrame(aligned, index=pd.DatetimeIndex(grid['timestamp'], name='timestamp'))
+    aligned.columns = pd.MultiIndex.from_tuples(aligned.columns, names=['column', 'pump_id'])
+    return aligned
+
+
+def calc_station_kWh_BBL(aligned, missing='drop', derived_columns=False):
+    # station-level energy per barrel of every aligned sample: the power of all the station's pumps over the flow of all of them
+    # validity follows calc_kWh_BBL: a pump's sample needs frequency, amps, volts, and a flow rate under 40000, and a station
+    # sample next to an invalid one is dropped too -- so a one-pump station gives calc_kWh_BBL's values
+    # ------------------------------------------------
+    # aligned: dataframe from align_pumps()
+    # missing: what to do when some of the pumps have no valid sample at a timestamp (e.g. stopped, and filtered out) --
+        # 'drop' the station sample, or count those pumps as contributing nothing ('zero')
+    # derived_columns: also keep the 'power_kW', 'energy_kWh', and 'volume_bbl' columns
+    # output: dataframe of the valid station samples: timestamp, frequency (mean of the running pumps), flow rate (total),
+        # pumps_running, kWh/BBL, and each pump's frequency as 'frequency <pump_id>'
+    # ================================================
+    frequency = aligned['frequency']
+    flow = aligned['flow rate']
+    volts = aligned['volts']
+    amps = aligned['amps']
+    pump_valid = frequency.notna() & amps.notna() & volts.notna() & flow.notna() & (flow < 40000)
+    if missing == 'drop':
+        valid = pump_valid.all(axis=1)
+    elif missing == 'zero':
+        valid = pump_valid.any(axis=1)
+    else:
+        raise ValueError("missing must be 'drop' or 'zero', not {!r}".format(missing))
+    valid &= ~(~valid).shift(1, fill_value=False) & ~(~valid).shift(-1, fill_value=False) # and neither neighbour is invalid
+
+    delta_t_s = aligned.index.to_series().diff().dt.total_seconds()
+    pf = 1.0 # power factor, as in calc_kWh_BBL
+    power_kW = (pf * np.sqrt(3) * volts * amps / 1000).where(pump_valid, 0).sum(axis=1)
+    flow_total = flow.where(pump_valid, 0).sum(axis=1)
+    energy_kWh = power_kW * delta_t_s / 3600
+    volume_bbl = flow_total * delta_t_s / 86400
+
+    station = pd.DataFrame({'timestamp': aligned.index, 'frequency': frequency.where(pump_valid).mean(axis=1),
+                            'flow rate': flow_total, 'pumps_running': pump_valid.sum(axis=1)}, index=aligned.index)
+    for pump_id in frequency.columns:
+        station['frequency {}'.format(pump_id)] = frequency[pump_id].where(pump_valid[pump_id])
+    if derived_columns:
+        station['power_kW'] = power_kW
+        station['energy_kWh'] = energy_kWh
+        station['volume_bbl'] = volume_bbl
+    station['kWh/BBL'] = (energy_kWh / volume_bbl).where(delta_t_s.notna() & (delta_t_s > 0) & (volume_bbl > 0))
+    return station[valid.to_numpy()].reset_index(drop=True)
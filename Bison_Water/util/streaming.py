@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+from util.resampling import sampling_intervals
+from util.filters import FilterSpec, KWH_VALIDITY_CONDITIONS
+
+
+STREAM_COLUMNS = ['timestamp', 'frequency', 'flow rate', 'amps', 'volts']
+STREAMING_KPIS = {'Flow Rate': 'flow rate', 'kWh/BBL': 'kWh/BBL'} # chart KPI: the per-sample column it averages
+
+
+class StreamingKPIAggregator:
+    # online version of calc_kWh_BBL followed by compute_kpis_for_sites' per-frequency chart, for live telemetry
+    # samples arrive one at a time or in micro-batches; per (site, frequency) it keeps running counts, sums, and Welford
+    # variance, so the chart can be emitted at any moment without rescanning history
+    # calc_kWh_BBL drops a sample if it or either neighbour fails the validity check, so each site's newest sample is held
+    # back (one-sample lookahead) until the next one arrives, or until flush() at the end of a stream
+    # ------------------------------------------------
+    # kpis: the chart KPIs to keep, any of 'kWh/BBL' and 'Flow Rate'
+    # max_flow: flow rates at or above this are invalid, as in calc_kWh_BBL
+    # NOTE: samples for a site must arrive in time order; anything at or before the site's last timestamp is ignored
+    # ================================================
+
+    def __init__(self, kpis=['kWh/BBL','Flow Rate'], max_flow=40000):
+        self.kpis = [kpi for kpi in kpis if kpi in STREAMING_KPIS]
+        self.max_flow = max_flow
+        self.validity = FilterSpec(KWH_VALIDITY_CONDITIONS).with_conditions('flow rate < {}'.format(max_flow)) # neighbours are checked across batches here
+        self.pending = {} # site_id: the newest sample, not yet decided valid or not
+        self.prev_initial_valid = {} # site_id: whether the sample before the pending one passed the initial validity check
+        self.stats = {} # (site_id, frequency): {'count': n, column: [n, mean, M2]}
+        self.kept_times = {} # site_id: [first kept timestamp, last kept timestamp, kept count]
+        self.kept_intervals = {} # site_id: {interval between consecutive kept samples (min.): count} -- for the sampling interval
+
+    def add(self, site_id, timestamp, frequency, flow_rate, amps, volts):
+        # adds a single sample
+        self.update(pd.DataFrame({'site_id': [site_id], 'timestamp': [pd.Timestamp(timestamp)], 'frequency': [frequency],
+                                  'flow rate': [flow_rate], 'amps': [amps], 'volts': [volts]}))
+
+    def update(self, samples):
+        # adds a micro-batch of samples
+        # ------------------------------------------------
+        # samples: dataframe with site_id, timestamp, frequency, flow rate, amps, and volts columns (any number of sites)
+        # ================================================
+        for site_id, site_samples in samples.groupby('site_id', sort=False, observed=True):
+            self._update_site(site_id, site_samples.sort_values('timestamp', kind='stable'))
+
+    def _update_site(self, site_id, site_samples):
+        batch = pd.DataFrame({col: site_samples[col].to_numpy() for col in STREAM_COLUMNS})
+        batch['timestamp'] = pd.to_datetime(batch['timestamp'])
+        batch['frequency'] = batch['frequency'].astype(float).round() # round freqs to nearest whole
+        batch['flow rate'] = batch['flow rate'].astype(float)
+        batch['amps'] = batch['amps'].astype(float)
+        batch['volts'] = batch['volts'].astype(float)
+        if 'Flow Rate' in self.kpis:
+            batch['flow rate'] = batch['flow rate'].round() # round flow rate to nearest whole
+        pending = self.pending.get(site_id)
+        if pending is not None:
+            batch = batch[batch['timestamp'] > pending['timestamp'].iloc[0]]
+        if len(batch) == 0:
+            return
+
+        # delta_t against the previous sample, whether or not that one was valid (as cached_bison_data computes it)
+        batch['delta_t'] = batch['timestamp'].diff()
+        if pending is not None:
+            batch.loc[batch.index[0], 'delta_t'] = batch['timestamp'].iloc[0] - pending['timestamp'].iloc[0]
+            batch = pd.concat([pending, batch], ignore_index=True)
+
+        initial_valid = self._initial_valid(batch)
+        # a sample is decided once its next sample is known -- all but the last row of the batch
+        prev_valid = np.r_[self.prev_initial_valid.get(site_id, True), initial_valid[:-1]]
+        next_valid = np.r_[initial_valid[1:], True]
+        valid = (initial_valid & prev_valid & next_valid)[:-1]
+
+        self.pending[site_id] = batch.iloc[-1:].reset_index(drop=True)
+        if len(batch) > 1:
+            self.prev_initial_valid[site_id] = bool(initial_valid[-2])
+        self._accumulate(site_id, batch.iloc[:-1][valid])
+
+    def _initial_valid(self, samples):
+        return self.validity.mask(samples)
+
+    def _accumulate(self, site_id, decided):
+        if len(decided) == 0:
+            return
+        # kWh/BBL exactly as calc_kWh_BBL derives it
+        pf = 1.0 #power factor changes by motors
+        delta_t_s = decided['delta_t'].dt.total_seconds()
+        power_kW = (pf*np.sqrt(3)*decided['volts'] * decided['amps']) / 1000
+        energy_kWh = power_kW * delta_t_s / 3600
+        volume_bbl = decided['flow rate'] * delta_t_s / 86400
+        computable = decided['delta_t'].notna() & (delta_t_s > 0) & (volume_bbl > 0)
+        decided = decided.assign(**{'kWh/BBL': (energy_kWh / volume_bbl).where(computable)})
+
+        first, last, kept = self.kept_times.get(site_id, [decided['timestamp'].iloc[0], None, 0])
+        self.kept_times[site_id] = [first, decided['timestamp'].iloc[-1], kept + len(decided)]
+        kept_times = decided['timestamp'] if last is None else pd.concat([pd.Series([last]), decided['timestamp']])
+        intervals = self.kept_intervals.setdefault(site_id, {})
+        for interval, count in zip(*np.unique(sampling_intervals(kept_times), return_counts=True)):
+            intervals[interval] = intervals.get(interval, 0) + int(count)
+
+        columns = [STREAMING_KPIS[kpi] for kpi in self.kpis]
+        grouped = decided.groupby('frequency')[columns]
+        batch_counts = grouped.size()
+        batch_n, batch_mean, batch_var = grouped.count(), grouped.mean(), grouped.var(ddof=0)
+        for freq in batch_counts.index:
+            freq_stats = self.stats.setdefault((site_id, freq), {'count': 0, **{col: [0, 0.0, 0.0] for col in columns}})
+            freq_stats['count'] += int(batch_counts[freq])
+            for col in columns:
+                n_b = int(batch_n.at[freq, col])
+                if n_b == 0:
+                    continue
+                # Welford / Chan et al. merge of the running (n, mean, M2) with this batch's
+                n_a, mean_a, m2_a = freq_stats[col]
+                mean_b, m2_b = batch_mean.at[freq, col], batch_var.at[freq, col] * n_b
+                n = n_a + n_b
+                delta = mean_b - mean_a
+                freq_stats[col] = [n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n]
+
+    def flush(self):
+        # end of stream: decides every site's held-back sample; it has no next neighbour, so like the last row of a batch run
+        # it only needs to pass its own check and have a valid previous sample
+        for site_id, pending in list(self.pending.items()):
+            initial_valid = bool(self._initial_valid(pending)[0])
+            if initial_valid and self.prev_initial_valid.get(site_id, True):
+                self._accumulate(site_id, pending)
+            self.prev_initial_valid[site_id] = initial_valid
+        self.pending = {}
+
+    def sampling_interval(self, site_id):
+        # estimate_sampling_interval over the kept samples: the most common interval between them (ties go to the shorter one)
+        intervals = {interval: count for interval, count in self.kept_intervals.get(site_id, {}).items() if interval > 0}
+        if not intervals:
+            return 1
+        dominant = min(intervals, key=lambda interval: (-intervals[interval], interval))
+        return int(max(1, dominant))
+
+    def site_chart(self, site_id, with_std=False):
+        # the site's current per-frequency KPI chart, in compute_kpis_for_sites' site_pump_kpis format
+        # ------------------------------------------------
+        # site_id: (int) the site_id
+        # with_std: also report each KPI's running standard deviation as '<kpi> std'
+        # output: dictionary of frequency: {kpi: value}, and the sampling interval used for the one-hour minimum
+        # ================================================
+        sampling_interval = self.sampling_interval(site_id)
+        site_pump_kpis = {}
+        for (stats_site_id, freq), freq_stats in sorted(self.stats.items(), key=lambda item: item[0][1]):
+            if stats_site_id != site_id or freq_stats['count'] < 60/sampling_interval: # one hour
+                continue
+            freq_kpis = {}
+            for kpi in ['Flow Rate', 'kWh/BBL']:
+                if kpi not in self.kpis:
+                    continue
+                n, mean, m2 = freq_stats[STREAMING_KPIS[kpi]]
+                freq_kpis[kpi] = np.round(mean, 3) if n > 0 else np.nan
+                if with_std:
+                    freq_kpis[kpi + ' std'] = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+            site_pump_kpis[freq] = freq_kpis
+        return site_pump_kpis, sampling_interval
+
+    def charts(self):
+        # every site's current chart, as the kpis_all_sites dictionary kpi_charts consumes
+        site_ids = {site_id for site_id, _ in self.stats}
+        return {site_id: self.site_chart(site_id)[0] for site_id in site_ids}
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from util.preprocessing import process_voltage_and_current
+
+
+# Synthetic SWD telemetry -- deterministic stand-ins for the Redshift historian data and the pump curve CSVs,
+# so the util package can be exercised (and benchmarked, see benchmarks/run_benchmarks.py) without the private data
+
+
+def synthetic_pump_curve(bep_flow=20000, shutoff_head=4500, speed_lines=(40, 45, 50, 55, 60), rated_freq=60, n_points=40):
+    # builds a pump curve in the type/label/x/y format of the PumpCurve_*_DataPoints.csv files (see load_pump_curves())
+    # speed lines follow the affinity laws (flow ~ freq, head ~ freq^2) from a parabolic head curve at the rated frequency;
+    # the Min/BEP/Max efficiency lines are the affinity parabolas through 60% / 100% / 130% of the BEP flow
+    # ------------------------------------------------
+    # bep_flow: (float) flow rate (BBL/day) at the BEP at the rated frequency
+    # shutoff_head: (float) head at zero flow at the rated frequency
+    # speed_lines: frequencies (Hz) to draw speed lines for
+    # rated_freq: (float) the frequency the head curve is defined at
+    # n_points: (int) points per line
+    # output: dataframe with 'type', 'label', 'x', 'y' columns
+    # ================================================
+    max_flow = 1.8 * bep_flow # runout flow at the rated frequency
+    k = shutoff_head / max_flow**2 # head = shutoff_head - k * flow^2
+    rows = []
+    for freq in speed_lines:
+        ratio = freq / rated_freq
+        x = np.linspace(0.05, 1.0, n_points) * max_flow * ratio
+        y = shutoff_head * ratio**2 - k * x**2
+        rows.append(pd.DataFrame({'type': 'speed', 'label': str(freq), 'x': x, 'y': y}))
+    for label, fraction in [('Min', 0.6), ('BEP', 1.0), ('Max', 1.3)]:
+        point_flow = fraction * bep_flow
+        point_head = shutoff_head - k * point_flow**2
+        x = np.linspace(0.5, 1.1, n_points) * point_flow # covers the whole speed line range below the rated frequency
+        rows.append(pd.DataFrame({'type': 'efficiency', 'label': label, 'x': x, 'y': point_head * (x / point_flow)**2}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def synthetic_pump_series(rng, n_rows, start, sampling_minutes, bep_flow, calibration_freqs=(46, 48, 50, 52, 54, 56),
+                          calibration_minutes=115, dropout_rate=0.002, nan_rate=0.002):
+    # one pump's telemetry: a calibration sweep, then frequency steps held for 30 min to 6 h, with flow, 3-phase amps and volts
+    # ------------------------------------------------
+    # rng: np.random.Generator
+    # n_rows: (int) rows to generate
+    # start: (pd.Timestamp) first sample time
+    # sampling_minutes: (int) nominal minutes between samples
+    # bep_flow: (float) the pump's BEP flow at 60 Hz, as in synthetic_pump_curve()
+    # calibration_freqs, calibration_minutes: the sweep at the start of the series (one stage per frequency)
+    # dropout_rate: chance per sample of a communication dropout (a gap of 10 min to 4 h with no samples)
+    # nan_rate: chance per sample and sensor of a missing reading
+    # output: dataframe of the pump's samples, list of its calibration stages in the Ryan sites_info format
+    # ================================================
+    # sample times: the nominal interval with small jitter, plus dropout gaps
+    step_s = np.full(n_rows, 60.0 * sampling_minutes)
+    step_s[0] = 0
+    step_s[1:] += rng.integers(-2, 3, n_rows - 1)
+    dropouts = rng.random(n_rows) < dropout_rate
+    step_s[dropouts] += rng.integers(10, 240, dropouts.sum()) * 60
+    times = start + pd.to_timedelta(np.cumsum(step_s), unit='s')
+
+    # frequency: a calibration sweep, then steps between 40 and 60 Hz
+    stage_rows = max(1, calibration_minutes // sampling_minutes)
+    calib_rows = min(n_rows, stage_rows * len(calibration_freqs))
+    freq_target = np.empty(n_rows)
+    freq_target[:calib_rows] = np.repeat(calibration_freqs, stage_rows)[:calib_rows]
+    filled = calib_rows
+    while filled < n_rows:
+        hold = int(rng.integers(30, 360) // sampling_minutes) + 1
+        freq_target[filled:filled + hold] = rng.choice(np.arange(40, 61))
+        filled += hold
+    frequency = freq_target + rng.normal(0, 0.15, n_rows)
+
+    calibration_stages = []
+    for i, freq in enumerate(calibration_freqs):
+        if (i + 1) * stage_rows > n_rows:
+            break
+        calibration_stages.append({'frequency': int(freq), 'start_time': times[i * stage_rows].strftime('%Y-%m-%d %H:%M:%S'),
+                                   'end_time': times[(i + 1) * stage_rows - 1].strftime('%Y-%m-%d %H:%M:%S')})
+
+    # flow follows the affinity law around an operating point that drifts slowly off BEP; power ~ freq^3
+    operating_ratio = 0.95 + 0.25 * np.sin(np.cumsum(rng.normal(0, 0.01, n_rows)))
+    flow = bep_flow * frequency / 60 * operating_ratio + rng.normal(0, 300, n_rows)
+    volts = 480 * frequency / 60
+    amps = 120 * (frequency / 60)**2 * operating_ratio
+    phases = {}
+    for phase in ['a', 'b', 'c']:
+        phases['volts' + phase] = volts * (1 + rng.normal(0, 0.005)) + rng.normal(0, 1.5, n_rows)
+        phases['amps' + phase] = amps * (1 + rng.normal(0, 0.02)) + rng.normal(0, 1.0, n_rows)
+
+    series = pd.DataFrame({'timestamp': times, 'frequency': frequency, 'flow rate': flow,
+                           'volts': np.nan, 'amps': np.nan, **phases})
+    for col in ['frequency', 'flow rate', 'voltsa', 'voltsb', 'voltsc', 'ampsa', 'ampsb', 'ampsc']:
+        series.loc[rng.random(n_rows) < nan_rate, col] = np.nan
+    return series, calibration_stages
+
+
+def synthetic_bison_data(n_rows, n_sites=4, pumps_per_site=(1, 2), sampling_minutes=(1, 5), start='2024-12-16 00:00:00', seed=0):
+    # a multi-site, multi-pump fleet in the layout fetch_bison_data caches (voltage and current already averaged)
+    # ------------------------------------------------
+    # n_rows: (int) total rows across all sites and pumps
+    # n_sites: (int) number of sites; site_ids start at 90001
+    # pumps_per_site: pump counts cycled through by site (e.g. (1, 2) alternates single- and two-pump sites)
+    # sampling_minutes: sampling intervals cycled through by site, so a fleet mixes 1- and 5-minute data
+    # start: first sample time of every pump
+    # seed: (int) random seed -- the same arguments always give the same data
+    # output: dataframe sorted by site_id, pump_id, and timestamp (string timestamps, as in the CSV cache),
+        # sites_info in the Ryan format (see cached_site_info()), and a dictionary of site_id: pump curve
+    # ================================================
+    rng = np.random.default_rng(seed)
+    pumps = [(90001 + site, pump) for site in range(n_sites) for pump in range(1, pumps_per_site[site % len(pumps_per_site)] + 1)]
+    rows_per_pump = np.full(len(pumps), n_rows // len(pumps))
+    rows_per_pump[:n_rows % len(pumps)] += 1
+
+    frames = []
+    sites_info = {}
+    site_pump_curves = {}
+    for (site_id, pump_id), pump_rows in zip(pumps, rows_per_pump):
+        site_index = site_id - 90001
+        bep_flow = 18000 + 1000 * (site_index % 5)
+        if site_id not in sites_info:
+            site_pump_curves[site_id] = synthetic_pump_curve(bep_flow=bep_flow)
+            sites_info[site_id] = {'enable': True, 'site_name': 'Synthetic {} SWD'.format(site_id), 'site_id': site_id,
+                                   'num_pumps': pumps_per_site[site_index % len(pumps_per_site)], 'calibration_stages': []}
+        series, calibration_stages = synthetic_pump_series(rng, int(pump_rows), pd.Timestamp(start),
+                                                           sampling_minutes[site_index % len(sampling_minutes)], bep_flow)
+        if pump_id == 1:
+            sites_info[site_id]['calibration_stages'] = calibration_stages
+        series.insert(0, 'facility_name', sites_info[site_id]['site_name'])
+        series.insert(0, 'pump_id', pump_id)
+        series.insert(0, 'site_id', site_id)
+        frames.append(series)
+
+    data = pd.concat(frames, ignore_index=True)
+    data['timestamp'] = data['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return process_voltage_and_current(data), sites_info, site_pump_curves